@@ -8,6 +8,7 @@
 
 from rest_framework import permissions, exceptions
 
+from re2o.acl import acl_check
 from . import acl
 
 
@@ -18,7 +19,27 @@ def can_see_api(*_, **__):
         A function that takes a user as an argument and returns
         an ACL tuple that assert this user can see the API.
     """
-    return lambda user: acl.can_view(user)
+    return lambda user: acl_check(user, acl, 'can_view')
+
+
+def _check_perm(perm, user):
+    """Apply an ACL function to a user.
+
+    The methods of the models and instances go through
+    `re2o.acl.acl_check`, so their result is shared with the other checks
+    of the request.
+
+    Args:
+        perm: The ACL function.
+        user: The user to check.
+
+    Returns:
+        The ACL tuple returned by the function.
+    """
+    target = getattr(perm, '__self__', None)
+    if target is not None:
+        return acl_check(user, target, perm.__name__)
+    return perm(user)
 
 
 def _get_param_in_view(view, param_name):
@@ -115,7 +136,7 @@ class ACLPermission(permissions.BasePermission):
 
         perms = self.get_required_permissions(request.method, view)
 
-        return all(perm(request.user)[0] for perm in perms)
+        return all(_check_perm(perm, request.user)[0] for perm in perms)
 
 
 class AutodetectACLPermission(permissions.BasePermission):
@@ -225,7 +246,7 @@ class AutodetectACLPermission(permissions.BasePermission):
         queryset = self._queryset(view)
         perms = self.get_required_permissions(request.method, queryset.model)
 
-        return all(perm(request.user)[0] for perm in perms)
+        return all(_check_perm(perm, request.user)[0] for perm in perms)
 
     def has_object_permission(self, request, view, obj):
         """Check that the user has the object-based permissions to perform
@@ -248,7 +269,7 @@ class AutodetectACLPermission(permissions.BasePermission):
 
         perms = self.get_required_object_permissions(request.method, obj)
 
-        if not all(perm(request.user)[0] for perm in perms):
+        if not all(_check_perm(perm, request.user)[0] for perm in perms):
             # If the user does not have permissions we need to determine if
             # they have read permissions to see 403, or not, and simply see
             # a 404 response.
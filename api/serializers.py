@@ -785,9 +785,19 @@ class SwitchBaySerializer(NamespacedHMSerializer):
 
 
 class PortsSerializer(NamespacedHMSerializer):
-    """Serialize `machines.models.Ipv6List` objects.
-    """
-    get_port_profile = ProfilSerializer(read_only=True)
+    """Serialize `topologie.models.Port` objects, with their effective
+    profile. The profile is resolved with the `profile_resolver` of the
+    context when there is one (see `SwitchPortView`).
+    """
+    get_port_profile = serializers.SerializerMethodField()
+
+    def get_get_port_profile(self, port):
+        resolver = self.context.get('profile_resolver')
+        if resolver is None:
+            profile = port.get_port_profile
+        else:
+            profile = resolver.resolve(port)
+        return ProfilSerializer(profile, context=self.context).data
 
 
     class Meta:
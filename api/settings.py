@@ -33,3 +33,8 @@ API_APPS = (
 
 # The expiration time for an authentication token
 API_TOKEN_DURATION = 86400  # 24 hours
+
+# The maximum number of rows imported by a request to users/import, which
+# runs within the request: larger batches go through the import_users
+# management command
+API_IMPORT_MAX_ROWS = 1000
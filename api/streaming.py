@@ -0,0 +1,68 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018 Maël Kervella
+
+"""Defines the streaming helpers of the API
+
+Large exports (DHCP leases, ...) are written straight from a database
+cursor to the HTTP response, as NDJSON (one JSON object per line) or CSV,
+without instantiating a serializer per object.
+"""
+
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class _EchoBuffer(object):
+    """A file-like object whose `write` returns the written value, so that
+    `csv.writer` can be used as a line generator."""
+
+    def write(self, value):
+        return value
+
+
+def _ndjson_lines(rows):
+    """Yields each row (a dict) as a JSON line."""
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def _csv_lines(rows, fields):
+    """Yields a header line followed by each row (a dict) as a CSV line."""
+    writer = csv.writer(_EchoBuffer())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([
+            '' if row.get(field) is None else row.get(field)
+            for field in fields
+        ])
+
+
+def stream_rows(rows, fields, stream_format='ndjson'):
+    """Builds a streaming response from an iterable of dicts.
+
+    Args:
+        rows: An iterable of dicts, ideally a lazy generator on top of
+            `QuerySet.iterator()`.
+        fields: The ordered keys of the rows, used for the CSV header.
+        stream_format: Either `ndjson` or `csv`.
+
+    Returns:
+        A `StreamingHttpResponse` with the matching content type.
+    """
+    if stream_format == 'csv':
+        lines = _csv_lines(rows, fields)
+    else:
+        lines = _ndjson_lines(rows)
+    return StreamingHttpResponse(
+        lines,
+        content_type=STREAM_FORMATS[stream_format]
+    )
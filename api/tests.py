@@ -17,6 +17,7 @@ import machines.models as machines
 import preferences.models as preferences
 import topologie.models as topologie
 import users.models as users
+from .streaming import STREAM_FORMATS
 
 
 class APIEndpointsTestCase(APITestCase):
@@ -149,10 +150,18 @@ class APIEndpointsTestCase(APITestCase):
         '/api/users/whitelist/',
         '/api/users/whitelist/1/',
         '/api/dns/zones/',
+        '/api/dns/reverse-zones/',
         '/api/dhcp/hostmacip/',
+        '/api/dhcp/hostmacip/?stream=ndjson',
+        '/api/dhcp/hostmacip/?stream=csv',
+        '/api/dhcp/hostmacip/?cursor=0',
+        '/api/dhcp/hostmacip/?since=2018-01-01T00:00:00Z',
         '/api/mailing/standard',
         '/api/mailing/club',
         '/api/services/regen/',
+        '/api/stats/daily/',
+        '/api/stats/daily/?stream=csv',
+        '/api/stats/daily/?metric=adherents&since=2018-01-01&until=2018-12-31',
     ]
     not_found_endpoints = [
         '/api/cotisations/article/4242/',
@@ -654,8 +663,14 @@ class APIEndpointsTestCase(APITestCase):
                self.auth_perm_endpoints
 
         def assert_more(response, url, format):
-            """Assert the response is valid json when format is json"""
-            if format is 'json':
+            """Assert the response is valid json when format is json, and
+            that every line of a NDJSON stream is valid json"""
+            if response.streaming:
+                content = b''.join(response.streaming_content).decode()
+                if response['Content-Type'] == STREAM_FORMATS['ndjson']:
+                    for line in content.splitlines():
+                        json.loads(line)
+            elif format is 'json':
                 json.loads(response.content.decode())
 
         self.check_responses_code(urls, codes.ok,
@@ -98,12 +98,18 @@ router.register_view(r'switchs/ports-config', views.SwitchPortView),
 router.register_view(r'switchs/role', views.RoleView),
 # Reminder
 router.register_view(r'reminder/get-users', views.ReminderView),
+# Invoices control
+router.register_view(r'cotisations/control', views.InvoiceControlView),
+# Users import
+router.register_view(r'users/import', views.UserImportView),
 # DNS
 router.register_view(r'dns/zones', views.DNSZonesView),
 router.register_view(r'dns/reverse-zones', views.DNSReverseZonesView),
 # MAILING
 router.register_view(r'mailing/standard', views.StandardMailingView),
 router.register_view(r'mailing/club', views.ClubMailingView),
+# STATISTICS
+router.register_view(r'stats/daily', views.DailyStatsView),
 # TOKEN AUTHENTICATION
 router.register_view(r'token-auth', views.ObtainExpiringAuthToken)
 
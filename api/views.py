@@ -11,23 +11,30 @@ the response (JSON or other), the CSRF exempting, ...
 """
 
 import datetime
+import hashlib
 
 from django.conf import settings
 from django.db.models import Q
-from rest_framework import viewsets, generics, views
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework import viewsets, generics, views, status
+from rest_framework.exceptions import ParseError
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.response import Response
 
 import cotisations.models as cotisations
+import logs.models as logs
 import machines.models as machines
 import preferences.models as preferences
 import topologie.models as topologie
 import users.models as users
 from re2o.utils import all_active_interfaces, all_has_access
+from users.importer import UserImport
 from . import serializers
 from .pagination import PageSizedPagination
 from .permissions import ACLPermission
+from .streaming import STREAM_FORMATS, stream_rows
 
 
 # COTISATIONS
@@ -46,6 +53,41 @@ class FactureViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = serializers.BaseInvoiceSerializer
 
 
+class InvoiceControlView(views.APIView):
+    """Sets the `control` and `valid` states of many
+    `cotisations.models.Facture` at once (see `Facture.bulk_set_state`).
+
+    The body is a list of objects with an `id` and the new `control`
+    and/or `valid` values, as JSON booleans. Returns the number of invoices
+    changed.
+    """
+    permission_classes = (ACLPermission,)
+    perms_map = {'POST': [
+        cotisations.Facture.can_view_all,
+        cotisations.Facture.can_change_control
+    ]}
+
+    def post(self, request, format=None):
+        if not isinstance(request.data, list):
+            raise ParseError('Expected a list of invoices')
+        states = {}
+        for item in request.data:
+            try:
+                pk = int(item['id'])
+            except (KeyError, TypeError, ValueError):
+                raise ParseError('Invalid invoice: %s' % (item,))
+            states[pk] = {}
+            for field in ('control', 'valid'):
+                if field not in item:
+                    continue
+                if not isinstance(item[field], bool):
+                    raise ParseError('Invalid %s for invoice %d: expected a '
+                                     'boolean' % (field, pk))
+                states[pk][field] = item[field]
+        changed = cotisations.Facture.bulk_set_state(states, request.user)
+        return Response({'changed': changed})
+
+
 class VenteViewSet(viewsets.ReadOnlyModelViewSet):
     """Exposes list and details of `cotisations.models.Vente` objects.
     """
@@ -526,6 +568,58 @@ class EMailAddressViewSet(viewsets.ReadOnlyModelViewSet):
             return users.EMailAddress.objects.none()
 
 
+class UserImportView(views.APIView):
+    """Imports members in bulk (see `users.importer.UserImport`).
+
+    The body is an object with the `rows` to import (objects with the
+    columns of `users.importer.FIELDS`), and optionally the name of the
+    `payment` method of the invoices, `dry_run` to only validate the rows and
+    `mail` (default true) to send the welcome and invoice emails.
+    Returns the errors of the rows, or a summary of the import.
+
+    The import runs within the request, in the transaction of the
+    revision middleware: at most `API_IMPORT_MAX_ROWS` rows are accepted,
+    larger batches go through the `import_users` management command.
+    """
+    permission_classes = (ACLPermission,)
+    perms_map = {'POST': [users.Adherent.can_import]}
+
+    def post(self, request, format=None):
+        rows = request.data.get('rows') \
+            if isinstance(request.data, dict) else None
+        if not isinstance(rows, list) or \
+                not all(isinstance(row, dict) for row in rows):
+            raise ParseError('Expected a list of rows')
+        if len(rows) > settings.API_IMPORT_MAX_ROWS:
+            raise ParseError(
+                'Too many rows: at most %d, use the import_users command '
+                'for larger batches' % settings.API_IMPORT_MAX_ROWS
+            )
+        for option in ('mail', 'dry_run'):
+            if not isinstance(request.data.get(option, False), bool):
+                raise ParseError('Invalid %s: expected a boolean' % option)
+        importer = UserImport(
+            rows,
+            payment=request.data.get('payment'),
+            mail=request.data.get('mail', True)
+        )
+        if request.data.get('dry_run'):
+            valid = importer.validate()
+        else:
+            valid = importer.run()
+        if not valid:
+            return Response(
+                {'errors': [
+                    {'line': line, 'message': message}
+                    for line, message in importer.errors
+                ]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if request.data.get('dry_run'):
+            return Response({'valid': len(importer.plan)})
+        return Response(importer.summary())
+
+
 # SERVICE REGEN
 
 
@@ -555,6 +649,12 @@ class SwitchPortView(generics.ListAPIView):
 
     serializer_class = serializers.SwitchPortSerializer
 
+    def get_serializer_context(self):
+        """The default profiles are loaded once for every port"""
+        context = super(SwitchPortView, self).get_serializer_context()
+        context['profile_resolver'] = topologie.PortProfileResolver()
+        return context
+
 # Rappel fin adhésion
 
 class ReminderView(generics.ListAPIView):
@@ -594,12 +694,116 @@ class LocalEmailUsersView(generics.ListAPIView):
 class HostMacIpView(generics.ListAPIView):
     """Exposes the associations between hostname, mac address and IPv4 in
     order to build the DHCP lease files.
+
+    Query parameters:
+        stream: `ndjson` or `csv`, streams the whole export straight from
+            the database cursor instead of paginating serialized objects.
+        cursor: A cursor, as returned in the `X-Change-Cursor` header.
+            Only the interfaces added, changed or removed since then are
+            streamed, with an `action` field set to `update` or `delete`.
+            The changes of the last minute before the cursor are sent
+            again, so that no late transaction is missed. A cursor older
+            than the retention of the journal gets a 410 response : the
+            client must do a full export again.
+        since: An ISO 8601 timestamp, used like `cursor`.
     """
     serializer_class = serializers.HostMacIpSerializer
+    stream_fields = ('id', 'hostname', 'extension', 'mac_address', 'ipv4')
 
     def get_queryset(self):
         return all_active_interfaces()
 
+    def _rows(self, queryset, action=None):
+        """Yields the export rows as dicts, from a values_list iterator"""
+        values = queryset.values_list(
+            'pk',
+            'domain__name',
+            'domain__extension__name',
+            'mac_address',
+            'ipv4__ipv4',
+        ).iterator()
+        for pk, hostname, extension, mac_address, ipv4 in values:
+            row = {
+                'id': pk,
+                'hostname': hostname,
+                'extension': extension,
+                'mac_address': str(mac_address),
+                'ipv4': ipv4,
+            }
+            if action:
+                row['action'] = action
+            yield row
+
+    def _delta_rows(self, changed_ids):
+        """Yields the changed active interfaces, then the removed ones"""
+        active_ids = set()
+        for row in self._rows(
+                self.get_queryset().filter(pk__in=changed_ids),
+                action='update'):
+            active_ids.add(row['id'])
+            yield row
+        for pk in sorted(changed_ids - active_ids):
+            yield {'id': pk, 'action': 'delete'}
+
+    @staticmethod
+    def _parse_delta(params):
+        """Returns the cursor (or None) and the date of the `cursor` or
+        `since` parameter, or None if the cursor was pruned"""
+        cursor = params.get('cursor')
+        if cursor is not None:
+            if not cursor.isdigit():
+                raise ParseError('Invalid cursor parameter: %s' % cursor)
+            cursor = int(cursor)
+            return cursor, machines.InterfaceChange.cursor_date(cursor)
+        since = params.get('since')
+        date = parse_datetime(since)
+        if date is None:
+            raise ParseError('Invalid since parameter: %s' % since)
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return None, date
+
+    def _changed_ids(self, cursor, date):
+        """Interfaces touched since the cursor or the date, including the
+        ones whose owner's membership, ban or whitelist started or ended
+        in the meantime."""
+        changed_ids = machines.InterfaceChange.changed_since(date, cursor)
+        now = timezone.now()
+        expired = users.UserAccessState.bounds_between_q(
+            date - machines.InterfaceChange.LAG, now
+        )
+        changed_ids.update(machines.Interface.objects.filter(
+            machine__user__in=users.User.objects.filter(expired)
+        ).values_list('pk', flat=True))
+        return changed_ids
+
+    def list(self, request, *args, **kwargs):
+        stream_format = request.query_params.get('stream')
+        delta = 'cursor' in request.query_params or \
+            'since' in request.query_params
+        if stream_format is None and not delta:
+            return super(HostMacIpView, self).list(request, *args, **kwargs)
+        stream_format = stream_format or 'ndjson'
+        if stream_format not in STREAM_FORMATS:
+            raise ParseError('Unknown stream format: %s' % stream_format)
+        # Read before the export so that no change can be missed
+        cursor = machines.InterfaceChange.last_cursor()
+        if not delta:
+            rows = self._rows(self.get_queryset())
+            fields = self.stream_fields
+        else:
+            since_cursor, date = self._parse_delta(request.query_params)
+            if date is None:
+                return Response(
+                    {'detail': 'Cursor expired, a full export is needed'},
+                    status=status.HTTP_410_GONE
+                )
+            rows = self._delta_rows(self._changed_ids(since_cursor, date))
+            fields = self.stream_fields + ('action',)
+        response = stream_rows(rows, fields, stream_format)
+        response['X-Change-Cursor'] = str(cursor)
+        return response
+
 
 # Firewall
 
@@ -616,7 +820,52 @@ class InterfacePortsOpenView(generics.ListAPIView):
 # DNS
 
 
-class DNSZonesView(generics.ListAPIView):
+class CachedZonesMixin(object):
+    """Serves the zones from `machines.models.DNSZoneCache`, rendering only
+    the zones marked as dirty by the signals. The response carries an ETag
+    built from the zones serials and honours If-None-Match, so polling
+    unchanged zones costs a single query.
+    """
+    zone_type = None
+
+    def _cached_zones(self):
+        """Returns the up-to-date caches of every zone, rendering the
+        dirty or missing ones with the serializer."""
+        zone_cache = machines.DNSZoneCache
+        zone_cache.invalidate_expired()
+        zone_ids = list(self.get_queryset().values_list('pk', flat=True))
+        caches = zone_cache.get_zones(self.zone_type, zone_ids)
+        stale_ids = [
+            zone_id for zone_id in zone_ids if caches[zone_id].dirty
+        ]
+        for zone in self.get_queryset().filter(pk__in=stale_ids):
+            caches[zone.pk].update(dict(self.get_serializer(zone).data))
+        (zone_cache.objects
+         .filter(zone_type=self.zone_type)
+         .exclude(zone_id__in=zone_ids)
+         .delete())
+        return [caches[zone_id] for zone_id in sorted(zone_ids)]
+
+    def list(self, request, *args, **kwargs):
+        caches = self._cached_zones()
+        etag = '"%s"' % hashlib.sha1(
+            ','.join(cache.etag for cache in caches).encode('utf-8')
+        ).hexdigest()
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = [cache.get_data() for cache in caches]
+            page = self.paginate_queryset(data)
+            if page is not None:
+                response = self.get_paginated_response(page)
+            else:
+                response = Response(data)
+        response['ETag'] = etag
+        return response
+
+
+class DNSZonesView(CachedZonesMixin, generics.ListAPIView):
     """Exposes the detailed information about each extension (hostnames,
     IPs, DNS records, etc.) in order to build the DNS zone files.
     """
@@ -629,14 +878,16 @@ class DNSZonesView(generics.ListAPIView):
                 .prefetch_related('srv_set').prefetch_related('srv_set__target')
                 .all())
     serializer_class = serializers.DNSZonesSerializer
+    zone_type = machines.DNSZoneCache.FORWARD
 
 
-class DNSReverseZonesView(generics.ListAPIView):
+class DNSReverseZonesView(CachedZonesMixin, generics.ListAPIView):
     """Exposes the detailed information about each extension (hostnames,
     IPs, DNS records, etc.) in order to build the DNS zone files.
     """
     queryset = (machines.IpType.objects.all())
     serializer_class = serializers.DNSReverseZonesSerializer
+    zone_type = machines.DNSZoneCache.REVERSE
 
 
 # MAILING
@@ -666,6 +917,62 @@ class ClubMailingView(generics.ListAPIView):
     serializer_class = serializers.MailingSerializer
 
 
+# STATISTICS
+
+
+class DailyStatsView(views.APIView):
+    """Exposes the daily series of `logs.models.DailyRollup`, one row per
+    day with one column per metric, streamed as NDJSON (the default) or
+    CSV.
+
+    Query parameters: `stream` (`ndjson` or `csv`), `metric` (repeated,
+    every metric by default), `since` and `until` (`YYYY-MM-DD`).
+    """
+    permission_classes = (ACLPermission,)
+    perms_map = {'GET': [logs.DailyRollup.can_view_all]}
+
+    @staticmethod
+    def _parse_day(value, name):
+        """Parses a `since` or `until` query parameter."""
+        day = parse_date(value)
+        if day is None:
+            raise ParseError('Invalid %s parameter: %s' % (name, value))
+        return day
+
+    @staticmethod
+    def _rows(queryset):
+        """Groups the (day, metric, value) rows by day."""
+        row = None
+        for day, metric, value in queryset.values_list(
+                'day', 'metric', 'value').order_by('day').iterator():
+            if row is None or row['day'] != day.isoformat():
+                if row is not None:
+                    yield row
+                row = {'day': day.isoformat()}
+            row[metric] = value
+        if row is not None:
+            yield row
+
+    def get(self, request, format=None):
+        stream_format = request.query_params.get('stream', 'ndjson')
+        if stream_format not in STREAM_FORMATS:
+            raise ParseError('Unknown stream format: %s' % stream_format)
+        queryset = logs.DailyRollup.objects.all()
+        metrics = request.query_params.getlist('metric')
+        if metrics:
+            queryset = queryset.filter(metric__in=metrics)
+        since = request.query_params.get('since')
+        if since is not None:
+            queryset = queryset.filter(day__gte=self._parse_day(since, 'since'))
+        until = request.query_params.get('until')
+        if until is not None:
+            queryset = queryset.filter(day__lte=self._parse_day(until, 'until'))
+        fields = ('day',) + tuple(sorted(
+            queryset.values_list('metric', flat=True).order_by().distinct()
+        ))
+        return stream_rows(self._rows(queryset), fields, stream_format)
+
+
 # TOKEN AUTHENTICATION
 
 
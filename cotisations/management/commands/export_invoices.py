@@ -0,0 +1,83 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Hugo Levy-Falk
+
+"""
+Exports the PDFs of the valid invoices of a year into a zip archive. The
+invoices are compiled in parallel by the LaTeX pool (see cotisations.tex,
+TEX_WORKERS).
+"""
+
+import zipfile
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cotisations.models import Facture
+from cotisations.tex import WORKERS, pdf_tag, submit_pdf
+from cotisations.utils import invoice_context
+from preferences.models import CotisationsOption
+
+
+class Command(BaseCommand):
+    """ The command object for `export_invoices` """
+    help = "Export the PDFs of the valid invoices of a year into a zip file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--year',
+            type=int,
+            default=timezone.now().year - 1,
+            help="Year of the invoices (default: last year)",
+        )
+        parser.add_argument(
+            '--output',
+            default=None,
+            help="Path of the zip file (default: invoices_<year>.zip)",
+        )
+
+    def handle(self, *args, **options):
+        year = options['year']
+        output = options['output'] or 'invoices_%d.zip' % year
+        templatename = CotisationsOption.get_cached_value(
+            'invoice_template'
+        ).template.name.split('/')[-1]
+        invoices = Facture.objects.filter(
+            date__year=year,
+            valid=True
+        ).select_related(
+            'user__adherent__room',
+            'user__club__room',
+            'paiement'
+        ).prefetch_related('vente_set').order_by('date', 'pk')
+        # A window of compilations is queued ahead of the one being
+        # written, so that the pool stays busy without holding every PDF
+        window = []
+        count = 0
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for invoice in invoices:
+                window.append((invoice, submit_pdf(
+                    templatename,
+                    invoice_context(invoice),
+                    pdf_tag(invoice.id)
+                )))
+                if len(window) > 4 * WORKERS:
+                    count += self.write(archive, *window.pop(0))
+            for invoice, future in window:
+                count += self.write(archive, invoice, future)
+        self.stdout.write("%d invoices exported to %s" % (count, output))
+
+    def write(self, archive, invoice, future):
+        """Adds the PDF of an invoice to the archive, returns 1 if it could
+        be compiled"""
+        try:
+            pdf = future.result()
+        except RuntimeError as error:
+            self.stderr.write("Invoice %d: %s" % (invoice.id, error))
+            return 0
+        archive.writestr(
+            'invoice_%s_%d.pdf' % (invoice.date.strftime('%Y%m%d'), invoice.id),
+            pdf
+        )
+        return 1
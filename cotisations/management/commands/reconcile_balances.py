@@ -0,0 +1,93 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Hugo Levy-Falk
+
+"""
+Checks the balance ledger (see cotisations.models.UserBalance) against
+the balances computed from the invoices, and against the sum of its own
+entries. With --fix, the differences are corrected by appending entries.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from cotisations.models import (
+    BalanceEntry,
+    Facture,
+    UserBalance,
+    balance_totals
+)
+
+
+class Command(BaseCommand):
+    """ The command object for `reconcile_balances` """
+    help = "Check the balance ledger against the invoices"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            default=False,
+            help="Append the entries correcting the differences",
+        )
+
+    def handle(self, *args, **options):
+        expected = balance_totals(
+            Facture.objects.all(),
+            group='facture__facture__user'
+        )
+        ledger = defaultdict(Decimal, UserBalance.objects.values_list(
+            'user', 'balance'
+        ))
+        entries = defaultdict(Decimal, BalanceEntry.objects.values(
+            'user'
+        ).annotate(total=Sum('amount')).order_by().values_list(
+            'user', 'total'
+        ))
+        wrong = 0
+        for user_id in sorted(set(expected) | set(ledger) | set(entries)):
+            if expected[user_id] == ledger[user_id] == entries[user_id]:
+                continue
+            wrong += 1
+            self.stdout.write(
+                "User %d: balance %s, ledger entries %s, invoices %s" % (
+                    user_id, ledger[user_id], entries[user_id],
+                    expected[user_id]
+                )
+            )
+            if options['fix']:
+                self.fix(user_id)
+        self.stdout.write("%d balances out of %d are wrong" % (
+            wrong, len(set(expected) | set(ledger) | set(entries))))
+
+    @staticmethod
+    def fix(user_id):
+        """Brings the ledger of a user back to the balance of their
+        invoices : the running total is reset to the sum of the entries,
+        the invoices are synchronised, and what remains (e.g. entries of
+        deleted invoices) is cancelled by a reconciliation entry"""
+        with transaction.atomic():
+            balance = UserBalance.lock(user_id)
+            balance.balance = BalanceEntry.objects.filter(
+                user=user_id
+            ).aggregate(total=Sum('amount'))['total'] or Decimal(0)
+            balance.save()
+            UserBalance.sync_invoices(Facture.objects.filter(
+                user=user_id
+            ).values_list('pk', flat=True))
+            expected = balance_totals(
+                Facture.objects.filter(user=user_id),
+                group='facture__facture__user'
+            )[user_id]
+            difference = expected - UserBalance.lock(user_id).balance
+            if difference:
+                UserBalance.record(
+                    user_id,
+                    difference,
+                    comment="Reconciliation"
+                )
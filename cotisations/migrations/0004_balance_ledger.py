@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-05-12 16:48
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_ledger(apps, schema_editor):
+    """Record one ledger entry per valid invoice changing a balance, and
+    the resulting balance of each user"""
+    db_alias = schema_editor.connection.alias
+    Facture = apps.get_model('cotisations', 'Facture')
+    Vente = apps.get_model('cotisations', 'Vente')
+    UserBalance = apps.get_model('cotisations', 'UserBalance')
+    BalanceEntry = apps.get_model('cotisations', 'BalanceEntry')
+    total = models.Sum(
+        models.F('prix') * models.F('number'),
+        output_field=models.DecimalField()
+    )
+    purchases = Vente.objects.using(db_alias).filter(
+        facture__facture__valid=True
+    )
+    amounts = defaultdict(Decimal)
+    for row in purchases.filter(name='solde').values('facture').annotate(
+            total=total).order_by():
+        amounts[row['facture']] += row['total']
+    for row in purchases.filter(
+            facture__facture__paiement__is_balance=True
+    ).values('facture').annotate(total=total).order_by():
+        amounts[row['facture']] -= row['total']
+    balances = defaultdict(Decimal)
+    entries = []
+    for pk, user_id, date in Facture.objects.using(db_alias).filter(
+            valid=True
+    ).order_by('date', 'pk').values_list('pk', 'user', 'date'):
+        if not amounts.get(pk):
+            continue
+        balances[user_id] += amounts[pk]
+        entries.append(BalanceEntry(
+            user_id=user_id,
+            invoice_id=pk,
+            amount=amounts[pk],
+            balance=balances[user_id],
+            date=date
+        ))
+    BalanceEntry.objects.using(db_alias).bulk_create(entries, batch_size=1000)
+    UserBalance.objects.using(db_alias).bulk_create(
+        [
+            UserBalance(user_id=user_id, balance=balance)
+            for user_id, balance in balances.items()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cotisations', '0003_drop_view_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBalance',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='balance')),
+            ],
+            options={
+                'verbose_name': 'user balance',
+                'verbose_name_plural': 'user balances',
+            },
+        ),
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='amount')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='balance')),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('comment', models.CharField(blank=True, max_length=255)),
+                ('invoice', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='balance_entries', to='cotisations.Facture')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'balance entry',
+                'verbose_name_plural': 'balance entries',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='balanceentry',
+            index_together=set([('user', 'id')]),
+        ),
+        migrations.RunPython(fill_ledger, migrations.RunPython.noop),
+    ]
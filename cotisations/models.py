@@ -17,11 +17,14 @@ each.
 """
 
 from __future__ import unicode_literals
+import uuid
+from collections import defaultdict
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 
-from django.db import models
-from django.db.models import Q, Max
-from django.db.models.signals import post_save, post_delete
+from django.db import models, transaction
+from django.db.models import Case, Max, Q, Value, When
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
 from django.forms import ValidationError
 from django.core.validators import MinValueValidator
@@ -30,18 +33,31 @@ from django.utils.translation import ugettext_lazy as _
 from django.urls import reverse
 from django.shortcuts import redirect
 from django.contrib import messages
+from reversion import revisions as reversion
 
 from preferences.models import CotisationsOption
 from machines.models import regen
+from re2o.acl import acl_check
 from re2o.field_permissions import FieldPermissionModelMixin
 from re2o.mixins import AclMixin, RevMixin
+from re2o.models import Job
 
-from cotisations.utils import (
-    find_payment_method, send_mail_invoice, send_mail_voucher
-)
+from cotisations.tex import invalidate_pdf, pdf_tag
+from cotisations.utils import find_payment_method
 from cotisations.validators import check_no_balance
 
 
+def editable_owners(user_request, user_ids):
+    """The ids among user_ids of the users user_request can edit, each user
+    being checked once"""
+    from users.models import User
+    owners = User.objects.filter(pk__in=set(user_ids))
+    return [
+        owner.pk for owner in owners
+        if acl_check(user_request, owner, 'can_edit')[0]
+    ]
+
+
 class BaseInvoice(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
     date = models.DateTimeField(
         auto_now_add=True,
@@ -155,7 +171,9 @@ class Facture(BaseInvoice):
         if not user_request.has_perm('cotisations.change_facture'):
             return False, _("You don't have the right to edit an invoice.")
         elif not user_request.has_perm('cotisations.change_all_facture') and \
-                not self.user.can_edit(user_request, *args, **kwargs)[0]:
+                not acl_check(
+                    user_request, self.user, 'can_edit', *args, **kwargs
+                )[0]:
             return False, _("You don't have the right to edit this user's "
                             "invoices.")
         elif not user_request.has_perm('cotisations.change_all_facture') and \
@@ -169,7 +187,9 @@ class Facture(BaseInvoice):
         if not user_request.has_perm('cotisations.delete_facture'):
             return False, _("You don't have the right to delete an invoice.")
         elif not user_request.has_perm('cotisations.change_all_facture') and \
-                not self.user.can_edit(user_request, *args, **kwargs)[0]:
+                not acl_check(
+                    user_request, self.user, 'can_edit', *args, **kwargs
+                )[0]:
             return False, _("You don't have the right to delete this user's "
                             "invoices.")
         elif not user_request.has_perm('cotisations.change_all_facture') and \
@@ -191,6 +211,27 @@ class Facture(BaseInvoice):
         else:
             return True, None
 
+    @staticmethod
+    def filter_deletable(user_request, queryset):
+        """Restricts queryset to the invoices user_request can delete,
+        following can_delete : the users' rights are checked once per
+        owner instead of once per invoice"""
+        if not user_request.has_perm('cotisations.delete_facture'):
+            return queryset.none()
+        if user_request.has_perm('cotisations.change_all_facture'):
+            return queryset
+        queryset = queryset.filter(control=False, valid=True)
+        return queryset.filter(user__in=editable_owners(
+            user_request,
+            queryset.values_list('user', flat=True).order_by().distinct()
+        ))
+
+    @staticmethod
+    def filter_viewable(user_request, queryset):
+        """Restricts queryset to the invoices user_request can view, when
+        they can't view them all : their own valid invoices"""
+        return queryset.filter(user=user_request, valid=True)
+
     @staticmethod
     def can_change_control(user_request, *_args, **_kwargs):
         """ Returns True if the user can change the 'controlled' status of
@@ -224,6 +265,33 @@ class Facture(BaseInvoice):
         self.__original_valid = self.valid
         self.__original_control = self.control
 
+    def save_purchases(self, purchases):
+        """Saves the new purchases of this invoice.
+
+        Their subscription periods are chained by a `SubscriptionPlanner`
+        from one read of the user's end dates, and the balance, the access
+        state and the LDAP entry of the user are refreshed once for the
+        invoice instead of once per purchase.
+
+        :param purchases: The unsaved `Vente` objects.
+        """
+        planner = SubscriptionPlanner(self.user)
+        with transaction.atomic():
+            for purchase in purchases:
+                purchase.facture = self
+                purchase.planner = planner
+                purchase.save()
+                del purchase.planner
+            UserBalance.sync_invoices([self.pk])
+            if any(purchase.type_cotisation for purchase in purchases):
+                self.user.refresh_access_state()
+                self.user.set_active()
+                self.user.ldap_sync_later(
+                    base=True,
+                    access_refresh=True,
+                    mac_refresh=False
+                )
+
     def get_subscription(self):
         """Returns every subscription associated with this invoice."""
         return Cotisation.objects.filter(
@@ -240,12 +308,109 @@ class Facture(BaseInvoice):
     def save(self, *args, **kwargs):
         super(Facture, self).save(*args, **kwargs)
         if not self.__original_valid and self.valid:
-            send_mail_invoice(self)
+            Job.enqueue(
+                'cotisations.tasks.mail_invoice',
+                'invoice:%d' % self.pk,
+                invoice_id=self.pk
+            )
         if self.is_subscription() \
                 and not self.__original_control \
                 and self.control \
                 and CotisationsOption.get_cached_value('send_voucher_mail'):
-            send_mail_voucher(self)
+            Job.enqueue(
+                'cotisations.tasks.mail_voucher',
+                'invoice:%d' % self.pk,
+                invoice_id=self.pk
+            )
+
+    @classmethod
+    def bulk_set_state(cls, states, user_request=None):
+        """Sets the 'controlled' and 'validated' states of many invoices.
+
+        Unlike saving each invoice, the invoices are updated with one
+        statement, the batch is recorded in one revision, and the balance,
+        the access state and the LDAP entry of each affected user are
+        refreshed once.
+
+        :param states: A dict mapping invoice ids to a dict with the new
+            'control' and/or 'valid' values.
+        :param user_request: The user recorded in the revision.
+        :return: The number of invoices changed.
+        """
+        from users.models import User
+        changed = {}
+        for pk, user_id, control, valid in cls.objects.filter(
+                pk__in=states
+        ).values_list('pk', 'user', 'control', 'valid'):
+            new_control = bool(states[pk].get('control', control))
+            new_valid = bool(states[pk].get('valid', valid))
+            if (new_control, new_valid) != (control, valid):
+                changed[pk] = (user_id, control, valid, new_control, new_valid)
+        if not changed:
+            return 0
+
+        def flag(index):
+            """The CASE setting a flag to its new value"""
+            ids = [pk for pk, state in changed.items() if state[index]]
+            if not ids:
+                return Value(False)
+            return Case(
+                When(pk__in=ids, then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField()
+            )
+
+        user_ids = {state[0] for state in changed.values()}
+        validated = [pk for pk, state in changed.items()
+                     if state[4] and not state[2]]
+        controlled = [pk for pk, state in changed.items()
+                      if state[3] and not state[1]]
+        with transaction.atomic(), reversion.create_revision():
+            cls.objects.filter(pk__in=changed).update(
+                control=flag(3),
+                valid=flag(4)
+            )
+            for invoice in cls.objects.filter(pk__in=changed):
+                reversion.add_to_revision(invoice)
+            reversion.set_comment("Controle")
+            if user_request is not None:
+                reversion.set_user(user_request)
+            UserBalance.sync_invoices(changed)
+            User.mass_refresh_access_state(user_ids)
+            for user in User.objects.filter(
+                    facture__in=validated,
+                    state__in=[
+                        User.STATE_NOT_YET_ACTIVE,
+                        User.STATE_ARCHIVE,
+                        User.STATE_FULL_ARCHIVE
+                    ]
+            ).distinct():
+                user.set_active()
+            Job.enqueue(
+                'users.tasks.ldap_sync_users',
+                'invoices:%s' % uuid.uuid4().hex,
+                user_ids=sorted(user_ids)
+            )
+            for pk in validated:
+                Job.enqueue(
+                    'cotisations.tasks.mail_invoice',
+                    'invoice:%d' % pk,
+                    invoice_id=pk
+                )
+            if controlled and \
+                    CotisationsOption.get_cached_value('send_voucher_mail'):
+                for pk in set(Vente.objects.filter(
+                        facture__in=controlled,
+                        type_cotisation__in=['All', 'Adhesion']
+                ).values_list('facture', flat=True)):
+                    Job.enqueue(
+                        'cotisations.tasks.mail_voucher',
+                        'invoice:%d' % pk,
+                        invoice_id=pk
+                    )
+        for pk in changed:
+            invalidate_pdf(pdf_tag(pk))
+        return len(changed)
 
     def __str__(self):
         return str(self.user) + ' ' + str(self.date)
@@ -257,10 +422,11 @@ def facture_post_save(**kwargs):
     Synchronise the LDAP user after an invoice has been saved.
     """
     facture = kwargs['instance']
+    facture.user.refresh_access_state()
     if facture.valid:
         user = facture.user
         user.set_active()
-        user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+        user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
 
 
 @receiver(post_delete, sender=Facture)
@@ -269,7 +435,8 @@ def facture_post_delete(**kwargs):
     Synchronise the LDAP user after an invoice has been deleted.
     """
     user = kwargs['instance'].user
-    user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+    user.refresh_access_state()
+    user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
 
 
 class CustomInvoice(BaseInvoice):
@@ -343,6 +510,39 @@ class CostEstimate(CustomInvoice):
         return True, None
 
 
+class SubscriptionPlanner(object):
+    """
+    Plans the subscription periods of the purchases of an invoice. Each
+    period starts at the end of the last one of the same kind (membership
+    or connection), starting from a single read of the user's current end
+    dates, instead of aggregating the user's subscriptions again for each
+    purchase.
+    """
+
+    def __init__(self, user, now=None):
+        state = user.get_access_state()
+        self.now = now or timezone.now()
+        self.ends = {
+            'Adhesion': state.end_adhesion,
+            'Connexion': state.end_connexion,
+        }
+
+    def next_period(self, type_cotisation, months):
+        """Returns the start and end of the next period of a subscription
+        type ('Adhesion', 'Connexion' or 'All'), and records its end. As
+        in `Vente.create_cotis`, an 'All' period follows the connection."""
+        kind = 'Adhesion' if type_cotisation == 'Adhesion' else 'Connexion'
+        start = max(self.ends[kind] or self.now, self.now)
+        end = start + relativedelta(months=months)
+        if type_cotisation == 'All':
+            kinds = ('Adhesion', 'Connexion')
+        else:
+            kinds = (type_cotisation,)
+        for kind in kinds:
+            self.ends[kind] = max(self.ends[kind] or end, end)
+        return start, end
+
+
 # TODO : change Vente to Purchase
 class Vente(RevMixin, AclMixin, models.Model):
     """
@@ -426,11 +626,12 @@ class Vente(RevMixin, AclMixin, models.Model):
                 months=self.duration*self.number)
         return
 
-    def create_cotis(self, date_start=False):
+    def create_cotis(self, date_start=False, planner=None):
         """
         Update and create a 'cotisation' related object if there is a
         cotisation_type defined (which means the article sold represents
-        a cotisation)
+        a cotisation). With a `SubscriptionPlanner`, the period follows the
+        ones already planned for the invoice.
         """
         try:
             invoice = self.facture.facture
@@ -439,6 +640,13 @@ class Vente(RevMixin, AclMixin, models.Model):
         if not hasattr(self, 'cotisation') and self.type_cotisation:
             cotisation = Cotisation(vente=self)
             cotisation.type_cotisation = self.type_cotisation
+            if planner is not None and not date_start:
+                cotisation.date_start, cotisation.date_end = \
+                    planner.next_period(
+                        self.type_cotisation,
+                        self.duration*self.number
+                    )
+                return
             if date_start:
                 end_cotisation = Cotisation.objects.filter(
                     vente__in=Vente.objects.filter(
@@ -482,8 +690,8 @@ class Vente(RevMixin, AclMixin, models.Model):
         if not user_request.has_perm('cotisations.change_vente'):
             return False, _("You don't have the right to edit the purchases.")
         elif (not user_request.has_perm('cotisations.change_all_facture') and
-              not self.facture.user.can_edit(
-                  user_request, *args, **kwargs
+              not acl_check(
+                  user_request, self.facture.user, 'can_edit', *args, **kwargs
         )[0]):
             return False, _("You don't have the right to edit this user's "
                             "purchases.")
@@ -497,7 +705,9 @@ class Vente(RevMixin, AclMixin, models.Model):
     def can_delete(self, user_request, *args, **kwargs):
         if not user_request.has_perm('cotisations.delete_vente'):
             return False, _("You don't have the right to delete a purchase.")
-        if not self.facture.user.can_edit(user_request, *args, **kwargs)[0]:
+        if not acl_check(
+                user_request, self.facture.user, 'can_edit', *args, **kwargs
+        )[0]:
             return False, _("You don't have the right to delete this user's "
                             "purchases.")
         if self.facture.control or not self.facture.valid:
@@ -514,6 +724,21 @@ class Vente(RevMixin, AclMixin, models.Model):
         else:
             return True, None
 
+    @staticmethod
+    def filter_deletable(user_request, queryset):
+        """Restricts queryset to the purchases user_request can delete,
+        following can_delete : the users' rights are checked once per
+        owner instead of once per purchase"""
+        if not user_request.has_perm('cotisations.delete_vente'):
+            return queryset.none()
+        queryset = queryset.filter(facture__control=False, facture__valid=True)
+        return queryset.filter(facture__user__in=editable_owners(
+            user_request,
+            queryset.values_list(
+                'facture__user', flat=True
+            ).order_by().distinct()
+        ))
+
     def __str__(self):
         return str(self.name) + ' ' + str(self.facture)
 
@@ -533,12 +758,16 @@ def vente_post_save(**kwargs):
     if hasattr(purchase, 'cotisation'):
         purchase.cotisation.vente = purchase
         purchase.cotisation.save()
+    planner = getattr(purchase, 'planner', None)
     if purchase.type_cotisation:
-        purchase.create_cotis()
+        purchase.create_cotis(planner=planner)
         purchase.cotisation.save()
+        # Saved by Facture.save_purchases, which syncs the user once
+        if planner is not None:
+            return
         user = purchase.facture.facture.user
         user.set_active()
-        user.ldap_sync(base=True, access_refresh=True, mac_refresh=False)
+        user.ldap_sync_later(base=True, access_refresh=True, mac_refresh=False)
 
 
 # TODO : change vente to purchase
@@ -554,7 +783,28 @@ def vente_post_delete(**kwargs):
         return
     if purchase.type_cotisation:
         user = invoice.user
-        user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+        user.refresh_access_state()
+        user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
+
+
+@receiver([post_save, post_delete], sender=Facture)
+@receiver([post_save, post_delete], sender=CustomInvoice)
+@receiver([post_save, post_delete], sender=CostEstimate)
+def invoice_pdf_changed(**kwargs):
+    """
+    Drops the cached PDFs of an invoice after it has been changed.
+    """
+    invalidate_pdf(pdf_tag(kwargs['instance'].pk))
+
+
+# TODO : change vente to purchase
+@receiver([post_save, post_delete], sender=Vente)
+def vente_pdf_changed(**kwargs):
+    """
+    Drops the cached PDFs of the invoice of a purchase after it has been
+    changed.
+    """
+    invalidate_pdf(pdf_tag(kwargs['instance'].facture_id))
 
 
 class Article(RevMixin, AclMixin, models.Model):
@@ -906,12 +1156,28 @@ class Cotisation(RevMixin, AclMixin, models.Model):
         return str(self.vente)
 
 
+def refresh_cotisation_user(cotisation):
+    """
+    Refresh the access state of the user who owns a cotisation, if the
+    cotisation is still attached to an invoice and not being saved by
+    `Facture.save_purchases`.
+    """
+    try:
+        if getattr(cotisation.vente, 'planner', None) is not None:
+            return
+        user = cotisation.vente.facture.facture.user
+    except (Vente.DoesNotExist, BaseInvoice.DoesNotExist):
+        return
+    user.refresh_access_state()
+
+
 @receiver(post_save, sender=Cotisation)
-def cotisation_post_save(**_kwargs):
+def cotisation_post_save(**kwargs):
     """
     Mark some services as needing a regeneration after the edition of a
     cotisation. Indeed the membership status may have changed.
     """
+    refresh_cotisation_user(kwargs['instance'])
     regen('dns')
     regen('dhcp')
     regen('mac_ip_list')
@@ -919,10 +1185,212 @@ def cotisation_post_save(**_kwargs):
 
 
 @receiver(post_delete, sender=Cotisation)
-def cotisation_post_delete(**_kwargs):
+def cotisation_post_delete(**kwargs):
     """
     Mark some services as needing a regeneration after the deletion of a
     cotisation. Indeed the membership status may have changed.
     """
+    refresh_cotisation_user(kwargs['instance'])
     regen('mac_ip_list')
     regen('mailing')
+
+
+def balance_totals(invoices, group='facture'):
+    """
+    Computes the effect on the users' balance of the purchases of the
+    valid invoices of a queryset : the balance credits (the 'solde'
+    articles) minus the purchases paid with the balance.
+
+    Args:
+        invoices: A queryset of `Facture`.
+        group: The `Vente` field the totals are grouped by, the invoice by
+            default, or 'facture__facture__user' to get them per user.
+
+    Returns:
+        A dict mapping the values of `group` to the totals.
+    """
+    total = models.Sum(
+        models.F('prix') * models.F('number'),
+        output_field=models.DecimalField()
+    )
+    purchases = Vente.objects.filter(facture__in=invoices.filter(valid=True))
+    totals = defaultdict(Decimal)
+    for row in purchases.filter(name='solde').values(group).annotate(
+            total=total).order_by():
+        totals[row[group]] += row['total']
+    for row in purchases.filter(
+            facture__facture__paiement__is_balance=True
+    ).values(group).annotate(total=total).order_by():
+        totals[row[group]] -= row['total']
+    return totals
+
+
+class UserBalance(models.Model):
+    """
+    The balance of a user : the running total of their `BalanceEntry`.
+    Its row is locked while the balance changes, so that a purchase paid
+    with the balance is checked and recorded atomically.
+    """
+
+    user = models.OneToOneField(
+        'users.User',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='balance'
+    )
+    balance = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=0,
+        verbose_name=_("balance")
+    )
+
+    class Meta:
+        verbose_name = _("user balance")
+        verbose_name_plural = _("user balances")
+
+    @classmethod
+    def current(cls, user_id):
+        """Returns the balance of a user, with one primary key lookup."""
+        balance = cls.objects.filter(user_id=user_id).values_list(
+            'balance', flat=True
+        ).first()
+        return balance if balance is not None else Decimal(0)
+
+    @classmethod
+    def lock(cls, user_id):
+        """Returns the balance row of a user, locked until the end of the
+        current transaction."""
+        cls.objects.get_or_create(user_id=user_id)
+        return cls.objects.select_for_update().get(user_id=user_id)
+
+    @classmethod
+    def record(cls, user_id, amount, invoice_id=None, comment=""):
+        """Appends an entry to the ledger of a user and updates their
+        running total. Must be called in a transaction."""
+        balance = cls.lock(user_id)
+        balance.balance += amount
+        balance.save()
+        return BalanceEntry.objects.create(
+            user_id=user_id,
+            invoice_id=invoice_id,
+            amount=amount,
+            balance=balance.balance,
+            comment=comment
+        )
+
+    @classmethod
+    def sync_invoices(cls, invoice_ids, deleted=False):
+        """
+        Appends to the ledgers the changes of the effect of some invoices
+        on the balance of their users since it was last recorded.
+
+        Args:
+            invoice_ids: The ids of the invoices.
+            deleted: True if the invoices are being deleted, their effect
+                is then cancelled.
+        """
+        invoice_ids = list(invoice_ids)
+        with transaction.atomic():
+            owners = dict(Facture.objects.filter(
+                pk__in=invoice_ids
+            ).values_list('pk', 'user'))
+            # The rows are locked in a consistent order before reading
+            # what was recorded, so that concurrent syncs serialize
+            for user_id in sorted(set(owners.values())):
+                cls.lock(user_id)
+            changes = defaultdict(Decimal)
+            if not deleted:
+                expected = balance_totals(
+                    Facture.objects.filter(pk__in=invoice_ids)
+                )
+                for invoice_id, user_id in owners.items():
+                    changes[(user_id, invoice_id)] += expected[invoice_id]
+            for invoice_id, user_id, total in BalanceEntry.objects.filter(
+                    invoice__in=invoice_ids
+            ).values_list('invoice', 'user').annotate(
+                total=models.Sum('amount')
+            ).order_by():
+                changes[(user_id, invoice_id)] -= total
+            for user_id, invoice_id in sorted(changes):
+                amount = changes[(user_id, invoice_id)]
+                if amount:
+                    cls.record(user_id, amount, invoice_id)
+
+    def __str__(self):
+        return "%s %s" % (self.user, self.balance)
+
+
+class BalanceEntry(models.Model):
+    """
+    An entry of the balance ledger of a user : the change of their balance
+    caused by an invoice (or a reconciliation), and the running total after
+    it. The ledger is append-only.
+    """
+
+    user = models.ForeignKey(
+        'users.User',
+        on_delete=models.CASCADE,
+        related_name='balance_entries'
+    )
+    invoice = models.ForeignKey(
+        'Facture',
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='balance_entries'
+    )
+    amount = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        verbose_name=_("amount")
+    )
+    balance = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        verbose_name=_("balance")
+    )
+    date = models.DateTimeField(default=timezone.now)
+    comment = models.CharField(max_length=255, blank=True)
+
+    class Meta:
+        index_together = (("user", "id"),)
+        verbose_name = _("balance entry")
+        verbose_name_plural = _("balance entries")
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            raise ValueError("The balance entries can't be modified.")
+        return super(BalanceEntry, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return "%s %s %s" % (self.user, self.date, self.amount)
+
+
+@receiver(post_save, sender=Facture)
+def facture_balance_changed(**kwargs):
+    """
+    Records the effect on the balance of an invoice after it has been
+    saved.
+    """
+    UserBalance.sync_invoices([kwargs['instance'].pk])
+
+
+@receiver(pre_delete, sender=Facture)
+def facture_balance_deleted(**kwargs):
+    """
+    Cancels the effect on the balance of an invoice being deleted.
+    """
+    UserBalance.sync_invoices([kwargs['instance'].pk], deleted=True)
+
+
+# TODO : change vente to purchase
+@receiver([post_save, post_delete], sender=Vente)
+def vente_balance_changed(**kwargs):
+    """
+    Records the effect on the balance of the invoice of a purchase after it
+    has been changed, unless it is saved by `Facture.save_purchases`.
+    """
+    if getattr(kwargs['instance'], 'planner', None) is not None:
+        return
+    UserBalance.sync_invoices([kwargs['instance'].facture_id])
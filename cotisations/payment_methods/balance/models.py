@@ -4,12 +4,12 @@
 # Copyright © 2018  Hugo Levy-Falk
 
 from django.contrib import messages
-from django.db import models
+from django.db import models, transaction
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
-from cotisations.models import Paiement
+from cotisations.models import Paiement, UserBalance
 from cotisations.payment_methods.mixins import PaymentMethodMixin
 
 
@@ -57,20 +57,24 @@ class BalancePayment(PaymentMethodMixin, models.Model):
         """
         user = invoice.user
         total_price = invoice.prix_total()
-        if user.solde - total_price < self.minimum_balance:
-            messages.error(
+        # The balance row stays locked until the invoice is validated and
+        # recorded in the ledger, so that two purchases can't both spend it
+        with transaction.atomic():
+            balance = UserBalance.lock(user.pk).balance
+            if balance - total_price < self.minimum_balance:
+                messages.error(
+                    request,
+                    _("Your balance is too low for this operation.")
+                )
+                return redirect(reverse(
+                    'users:profil',
+                    kwargs={'userid': user.id}
+                ))
+            return invoice.paiement.end_payment(
+                invoice,
                 request,
-                _("Your balance is too low for this operation.")
+                use_payment_method=False
             )
-            return redirect(reverse(
-                'users:profil',
-                kwargs={'userid': user.id}
-            ))
-        return invoice.paiement.end_payment(
-            invoice,
-            request,
-            use_payment_method=False
-        )
 
     def valid_form(self, form):
         """Checks that there is not already a balance payment method."""
@@ -0,0 +1,33 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Hugo Levy-Falk
+
+"""cotisations.tasks
+The jobs of the cotisations app, run by the worker (see re2o.models.Job).
+"""
+
+from __future__ import unicode_literals
+
+from .models import Facture
+from .utils import send_mail_invoice, send_mail_voucher
+
+
+def mail_invoice(invoice_id):
+    """Sends the pdf of a validated invoice"""
+    invoice = Facture.objects.filter(pk=invoice_id).first()
+    if invoice is not None:
+        send_mail_invoice(invoice)
+
+
+def mail_invoices(invoice_ids):
+    """Sends the pdf of several validated invoices (bulk imports)"""
+    for invoice in Facture.objects.filter(pk__in=invoice_ids).order_by('pk'):
+        send_mail_invoice(invoice)
+
+
+def mail_voucher(invoice_id):
+    """Sends the voucher of a controlled subscription invoice"""
+    invoice = Facture.objects.filter(pk=invoice_id).first()
+    if invoice is not None:
+        send_mail_voucher(invoice)
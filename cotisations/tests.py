@@ -9,6 +9,245 @@
 The tests for the Cotisations module.
 """
 
-# from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from users.models import User
+from . import models
+
+
+def create_user(username):
+    """A user for the tests"""
+    return User.objects.create_user(
+        username,
+        "%s@example.net" % username,
+        username,
+        surname=username,
+    )
+
+
+# The jobs (mails, pdf, ldap) are queued instead of being run
+@override_settings(ASYNC_JOBS=True)
+class UserBalanceTestCase(TestCase):
+    """The balance ledger follows the invoices of a user"""
+
+    def setUp(self):
+        self.user = create_user("balanceuser")
+        self.cash = models.Paiement.objects.create(moyen="balance_cash")
+        self.balance = models.Paiement.objects.create(
+            moyen="balance_balance",
+            is_balance=True
+        )
+
+    def invoice(self, paiement, name, price, number=1):
+        """A valid invoice with one purchase"""
+        invoice = models.Facture.objects.create(
+            user=self.user,
+            paiement=paiement,
+            valid=True
+        )
+        models.Vente.objects.create(
+            facture=invoice,
+            name=name,
+            prix=Decimal(price),
+            number=number
+        )
+        return invoice
+
+    def assertBalance(self, amount):
+        """The running total and the sum of the ledger entries"""
+        amount = Decimal(amount)
+        self.assertEqual(models.UserBalance.current(self.user.pk), amount)
+        self.assertEqual(
+            models.BalanceEntry.objects.filter(user=self.user).aggregate(
+                total=Sum('amount'))['total'] or Decimal(0),
+            amount
+        )
+
+    def test_create(self):
+        self.invoice(self.cash, 'solde', '10', number=2)
+        self.assertBalance('20')
+        self.invoice(self.balance, 'article', '5')
+        self.assertBalance('15')
+
+    def test_invalidate_and_validate(self):
+        invoice = self.invoice(self.cash, 'solde', '10')
+        invoice.valid = False
+        invoice.save()
+        self.assertBalance('0')
+        invoice = models.Facture.objects.get(pk=invoice.pk)
+        invoice.valid = True
+        invoice.save()
+        self.assertBalance('10')
+
+    def test_bulk_set_state(self):
+        invoice = self.invoice(self.cash, 'solde', '10')
+        models.Facture.bulk_set_state({invoice.pk: {'valid': False}})
+        self.assertBalance('0')
+        models.Facture.bulk_set_state({invoice.pk: {'valid': True}})
+        self.assertBalance('10')
+
+    def test_delete(self):
+        self.invoice(self.cash, 'solde', '10')
+        invoice = self.invoice(self.balance, 'article', '4')
+        self.assertBalance('6')
+        invoice.delete()
+        self.assertBalance('10')
+
+    def test_sync_is_idempotent(self):
+        invoice = self.invoice(self.cash, 'solde', '10')
+        entries = models.BalanceEntry.objects.count()
+        models.UserBalance.sync_invoices([invoice.pk])
+        self.assertEqual(models.BalanceEntry.objects.count(), entries)
+        self.assertBalance('10')
+
+
+@override_settings(ASYNC_JOBS=True)
+class ReconcileBalancesTestCase(TestCase):
+    """The reconcile_balances command finds and fixes the ledgers"""
+
+    def setUp(self):
+        self.user = create_user("reconcileuser")
+        cash = models.Paiement.objects.create(moyen="reconcile_cash")
+        invoice = models.Facture.objects.create(
+            user=self.user,
+            paiement=cash,
+            valid=True
+        )
+        models.Vente.objects.create(
+            facture=invoice,
+            name='solde',
+            prix=Decimal('10'),
+            number=1
+        )
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command('reconcile_balances', *args, stdout=out)
+        return out.getvalue()
+
+    def test_consistent_ledger(self):
+        self.assertIn("0 balances out of 1 are wrong", self.reconcile())
+
+    def test_fix_running_total(self):
+        models.UserBalance.objects.filter(user=self.user).update(
+            balance=Decimal('99')
+        )
+        self.assertIn("1 balances out of 1 are wrong", self.reconcile())
+        self.reconcile('--fix')
+        self.assertEqual(
+            models.UserBalance.current(self.user.pk),
+            Decimal('10')
+        )
+        self.assertIn("0 balances out of 1 are wrong", self.reconcile())
+
+    def test_fix_stray_entry(self):
+        models.UserBalance.record(self.user.pk, Decimal('5'), comment="Stray")
+        self.assertIn("1 balances out of 1 are wrong", self.reconcile())
+        self.reconcile('--fix')
+        self.assertEqual(
+            models.UserBalance.current(self.user.pk),
+            Decimal('10')
+        )
+        self.assertTrue(models.BalanceEntry.objects.filter(
+            user=self.user,
+            comment="Reconciliation",
+            amount=Decimal('-5')
+        ).exists())
+        self.assertIn("0 balances out of 1 are wrong", self.reconcile())
+
+
+@override_settings(ASYNC_JOBS=True)
+class SubscriptionPlannerTestCase(TestCase):
+    """The periods planned for the purchases of an invoice are the ones
+    the purchases get when they are saved one by one (create_cotis)"""
+
+    PURCHASES = [
+        ('All', 1, 1),
+        ('Adhesion', 12, 1),
+        ('Connexion', 1, 2),
+        ('All', 2, 1),
+        ('Adhesion', 1, 1),
+    ]
+
+    def setUp(self):
+        self.cash = models.Paiement.objects.create(moyen="planner_cash")
+        self.base = timezone.now() + timedelta(days=1)
+
+    def subscribed_user(self, username):
+        """A user whose membership and connection end at fixed dates"""
+        user = create_user(username)
+        invoice = models.Facture.objects.create(
+            user=user,
+            paiement=self.cash,
+            valid=True
+        )
+        for type_cotisation, days in (('Adhesion', 30), ('Connexion', 10)):
+            purchase = models.Vente.objects.create(
+                facture=invoice,
+                name=type_cotisation,
+                prix=Decimal('1'),
+                number=1,
+                duration=1,
+                type_cotisation=type_cotisation
+            )
+            models.Cotisation.objects.filter(vente=purchase).update(
+                date_start=self.base - timedelta(days=1),
+                date_end=self.base + timedelta(days=days)
+            )
+        user.refresh_access_state()
+        return user
+
+    def purchase(self, invoice, type_cotisation, duration, number):
+        return models.Vente(
+            facture=invoice,
+            name=type_cotisation,
+            prix=Decimal('1'),
+            number=number,
+            duration=duration,
+            type_cotisation=type_cotisation
+        )
+
+    @staticmethod
+    def periods(invoice):
+        return list(models.Cotisation.objects.filter(
+            vente__facture=invoice
+        ).order_by('vente').values_list(
+            'type_cotisation', 'date_start', 'date_end'
+        ))
+
+    def test_planned_periods_match_create_cotis(self):
+        user = self.subscribed_user("planneruser")
+        invoice = models.Facture.objects.create(
+            user=user,
+            paiement=self.cash,
+            valid=True
+        )
+        invoice.save_purchases([
+            self.purchase(invoice, *purchase) for purchase in self.PURCHASES
+        ])
+
+        reference_user = self.subscribed_user("createcotisuser")
+        reference = models.Facture.objects.create(
+            user=reference_user,
+            paiement=self.cash,
+            valid=True
+        )
+        for purchase in self.PURCHASES:
+            # Read again, as a purchase added on its own
+            self.purchase(
+                models.Facture.objects.get(pk=reference.pk),
+                *purchase
+            ).save()
+
+        self.assertEqual(self.periods(invoice), self.periods(reference))
+        user = User.objects.get(pk=user.pk)
+        reference_user = User.objects.get(pk=reference_user.pk)
+        self.assertEqual(user.end_adhesion(), reference_user.end_adhesion())
+        self.assertEqual(user.end_connexion(), reference_user.end_connexion())
@@ -8,30 +8,79 @@
 """tex.py
 Module in charge of rendering some LaTex templates.
 Used to generated PDF invoice.
+
+The LaTeX source is rendered in the calling process, then compiled by
+pdflatex in a bounded pool (at most TEX_WORKERS compilations at once per
+process), each in its own temporary directory. The PDFs are cached under
+the hash of their LaTeX source : the same template with the same context
+is only compiled once. The keys of the PDFs of an invoice also hold a
+version of the invoice, changed when it changes (see invalidate_pdf).
 """
 
+import hashlib
 import os
 import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.template.loader import get_template
 from django.utils.text import slugify
 
 from preferences.models import CotisationsOption
-from re2o.settings import BASE_DIR
 
 TEMP_PREFIX = getattr(settings, 'TEX_TEMP_PREFIX', 'render_tex-')
 CACHE_PREFIX = getattr(settings, 'TEX_CACHE_PREFIX', 'render-tex')
 CACHE_TIMEOUT = getattr(settings, 'TEX_CACHE_TIMEOUT', 86400)  # 1 day
+WORKERS = getattr(settings, 'TEX_WORKERS', 2)
+TIMEOUT = getattr(settings, 'TEX_TIMEOUT', 60)  # seconds per pdflatex run
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_pool():
+    """The pool compiling the LaTeX sources, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+def pdf_tag(invoice_id):
+    """The tag of the PDFs rendered for an invoice (or a voucher)"""
+    return 'invoice-%d' % invoice_id
+
+
+def _tag_key(tag):
+    return '%s-tag-%s' % (CACHE_PREFIX, tag)
+
+
+def _tag_version(tag):
+    """The current version of the PDFs rendered under tag, created if
+    needed. cache.add is atomic : concurrent renderings agree on it"""
+    key = _tag_key(tag)
+    cache.add(key, uuid.uuid4().hex, CACHE_TIMEOUT)
+    return cache.get(key) or ''
+
+
+def invalidate_pdf(tag):
+    """Drops the PDFs rendered under tag : they are not read anymore once
+    the version of the tag changed, and expire from the cache"""
+    cache.set(_tag_key(tag), uuid.uuid4().hex, CACHE_TIMEOUT)
 
 
 def render_invoice(_request, ctx={}):
     """
     Render an invoice using some available information such as the current
     date, the user, the articles, the prices, ...
+    The PDF is tagged with the invoice id `fid` of the context.
     """
     options, _ = CotisationsOption.objects.get_or_create()
     is_estimate = ctx.get('is_estimate', False)
@@ -44,14 +93,15 @@ def render_invoice(_request, ctx={}):
         str(ctx.get('DATE', datetime.now()).day),
     ])
     templatename = options.invoice_template.template.name.split('/')[-1]
-    r = render_tex(_request, templatename, ctx)
+    tag = pdf_tag(ctx['fid']) if 'fid' in ctx else None
+    r = render_tex(_request, templatename, ctx, tag=tag)
     r['Content-Disposition'] = 'attachment; filename="{name}.pdf"'.format(
         name=filename
     )
     return r
 
 
-def render_voucher(_request, ctx={}):
+def render_voucher(_request, ctx={}, tag=None):
     """
     Render a subscribtion voucher.
     """
@@ -66,41 +116,99 @@ def render_voucher(_request, ctx={}):
         str(ctx.get('date_begin', datetime.now()).day),
     ])
     templatename = options.voucher_template.template.name.split('/')[-1]
-    r = render_tex(_request, templatename, ctx)
+    r = render_tex(_request, templatename, ctx, tag=tag)
     r['Content-Disposition'] = 'attachment; filename="{name}.pdf"'.format(
         name=filename
     )
     return r
 
 
-def create_pdf(template, ctx={}):
-    """Creates and returns a PDF from a LaTeX template using pdflatex.
+def compile_pdf(source):
+    """Compiles a LaTeX source with pdflatex, twice for the references,
+    in a temporary directory which also receives the log (instead of a
+    shared out.log).
 
-    It create a temporary file for the PDF then read it to return its content.
+    Args:
+        source: The LaTeX source, as bytes.
+
+    Returns:
+        The content of the PDF.
+
+    Raises:
+        RuntimeError: pdflatex failed, with the end of its log, or timed
+            out.
+    """
+    with tempfile.TemporaryDirectory(prefix=TEMP_PREFIX) as tempdir:
+        for _ in range(2):
+            process = Popen(
+                ['pdflatex', '-output-directory', tempdir],
+                stdin=PIPE,
+                stdout=DEVNULL,
+            )
+            try:
+                process.communicate(source, timeout=TIMEOUT)
+            except TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise RuntimeError("pdflatex timed out")
+        try:
+            with open(os.path.join(tempdir, 'texput.pdf'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            log = ''
+            log_path = os.path.join(tempdir, 'texput.log')
+            if os.path.exists(log_path):
+                with open(log_path, errors='replace') as f:
+                    log = f.read()[-2000:]
+            raise RuntimeError("pdflatex failed:\n" + log)
+
+
+def _store(key):
+    """Callback caching the PDF of a finished compilation"""
+    def store(future):
+        if future.exception() is None:
+            cache.set(key, future.result(), CACHE_TIMEOUT)
+    return store
+
+
+def submit_pdf(template, ctx={}, tag=None):
+    """Renders a LaTeX template and queues its compilation.
 
     Args:
         template: Path to the LaTeX template.
         ctx: Dict with the context for rendering the template.
+        tag: Optional tag of the PDF, to drop it from the cache with
+            `invalidate_pdf`.
 
     Returns:
-        The content of the temporary PDF file generated.
+        A Future of the content of the PDF, already done if it was cached.
     """
-    template = get_template(template)
-    rendered_tpl = template.render(ctx).encode('utf-8')
+    source = get_template(template).render(ctx).encode('utf-8')
+    key = '%s-%s' % (CACHE_PREFIX, hashlib.sha256(source).hexdigest())
+    if tag is not None:
+        key = '%s-%s' % (key, _tag_version(tag))
+    pdf = cache.get(key)
+    if pdf is not None:
+        future = Future()
+        future.set_result(pdf)
+        return future
+    future = render_pool().submit(compile_pdf, source)
+    future.add_done_callback(_store(key))
+    return future
+
+
+def create_pdf(template, ctx={}, tag=None):
+    """Creates and returns a PDF from a LaTeX template using pdflatex.
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        for _ in range(2):
-            with open(BASE_DIR + "/out.log", "w") as f:
-                process = Popen(
-                    ['pdflatex', '-output-directory', tempdir],
-                    stdin=PIPE,
-                    stdout=f,#PIPE,
-                )
-                process.communicate(rendered_tpl)
-        with open(os.path.join(tempdir, 'texput.pdf'), 'rb') as f:
-            pdf = f.read()
+    Args:
+        template: Path to the LaTeX template.
+        ctx: Dict with the context for rendering the template.
+        tag: Optional tag of the PDF (see `submit_pdf`).
 
-    return pdf
+    Returns:
+        The content of the PDF.
+    """
+    return submit_pdf(template, ctx, tag).result()
 
 
 def escape_chars(string):
@@ -117,7 +225,7 @@ def escape_chars(string):
     return r
 
 
-def render_tex(_request, template, ctx={}):
+def render_tex(_request, template, ctx={}, tag=None):
     """Creates a PDF from a LaTex templates using pdflatex.
 
     Calls `create_pdf` and send back an HTTP response for
@@ -127,11 +235,12 @@ def render_tex(_request, template, ctx={}):
         _request: Unused, but allow using this function as a Django view.
         template: Path to the LaTeX template.
         ctx: Dict with the context for rendering the template.
+        tag: Optional tag of the PDF (see `submit_pdf`).
 
     Returns:
         An HttpResponse with type `application/pdf` containing the PDF file.
     """
-    pdf = create_pdf(template, ctx)
+    pdf = create_pdf(template, ctx, tag)
     r = HttpResponse(content_type='application/pdf')
     r.write(pdf)
     return r
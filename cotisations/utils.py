@@ -8,7 +8,7 @@ import os
 from django.template.loader import get_template
 from django.core.mail import EmailMessage
 
-from .tex import create_pdf
+from .tex import create_pdf, pdf_tag
 from preferences.models import AssoOption, GeneralOption, CotisationsOption
 from re2o.settings import LOGO_PATH
 from re2o import settings
@@ -26,8 +26,8 @@ def find_payment_method(payment):
     return None
 
 
-def send_mail_invoice(invoice):
-    """Creates the pdf of the invoice and sends it by email to the client"""
+def invoice_context(invoice):
+    """The context of the LaTeX template of an invoice (Facture)"""
     purchases_info = []
     for purchase in invoice.vente_set.all():
         purchases_info.append({
@@ -36,8 +36,7 @@ def send_mail_invoice(invoice):
             'quantity': purchase.number,
             'total_price': purchase.prix_total
         })
-
-    ctx = {
+    return {
         'paid': True,
         'fid': invoice.id,
         'DATE': invoice.date,
@@ -54,10 +53,16 @@ def send_mail_invoice(invoice):
         'siret': AssoOption.get_cached_value('siret'),
         'email': AssoOption.get_cached_value('contact'),
         'phone': AssoOption.get_cached_value('telephone'),
-        'tpl_path': os.path.join(settings.BASE_DIR, LOGO_PATH)
+        'tpl_path': os.path.join(settings.BASE_DIR, LOGO_PATH),
+        'payment_method': invoice.paiement.moyen,
     }
 
-    pdf = create_pdf('cotisations/factures.tex', ctx)
+
+def send_mail_invoice(invoice):
+    """Creates the pdf of the invoice and sends it by email to the client"""
+    ctx = invoice_context(invoice)
+
+    pdf = create_pdf('cotisations/factures.tex', ctx, pdf_tag(invoice.id))
     template = get_template('cotisations/email_invoice')
 
     ctx = {
@@ -92,7 +97,7 @@ def send_mail_voucher(invoice):
         'date_begin': invoice.get_subscription().earliest('date_start').date_start
     }
     templatename = CotisationsOption.get_cached_value('voucher_template').template.name.split('/')[-1]
-    pdf = create_pdf(templatename, ctx)
+    pdf = create_pdf(templatename, ctx, pdf_tag(invoice.id))
     template = get_template('cotisations/email_subscription_accepted')
 
     ctx = {
@@ -24,7 +24,6 @@ from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 # Import des models, forms et fonctions re2o
-from reversion import revisions as reversion
 from users.models import User
 from re2o.settings import LOGO_PATH
 from re2o import settings
@@ -41,6 +40,7 @@ from re2o.acl import (
     can_view_all,
     can_delete_set,
     can_change,
+    filter_viewable,
 )
 from preferences.models import AssoOption, GeneralOption
 from .models import (
@@ -67,9 +67,9 @@ from .forms import (
     DiscountForm,
     CostEstimateForm,
 )
-from .tex import render_invoice, render_voucher, escape_chars
+from .tex import render_invoice, render_voucher, escape_chars, pdf_tag
 from .payment_methods.forms import payment_method_factory
-from .utils import find_payment_method
+from .utils import find_payment_method, invoice_context
 
 
 @login_required
@@ -132,9 +132,7 @@ def new_facture(request, user, userid):
                 price_ok = True
             if price_ok:
                 new_invoice_instance.save()
-                for p in purchases:
-                    p.facture = new_invoice_instance
-                    p.save()
+                new_invoice_instance.save_purchases(purchases)
 
                 return new_invoice_instance.paiement.end_payment(
                     new_invoice_instance,
@@ -277,38 +275,7 @@ def facture_pdf(request, facture, **_kwargs):
     invoice with the total price, the payment method, the address and the
     legal information for the user.
     """
-    # TODO : change vente to purchase
-    purchases_objects = Vente.objects.all().filter(facture=facture)
-    # Get the article list and build an list out of it
-    # contiaining (article_name, article_price, quantity, total_price)
-    purchases_info = []
-    for purchase in purchases_objects:
-        purchases_info.append({
-            'name': purchase.name,
-            'price': purchase.prix,
-            'quantity': purchase.number,
-            'total_price': purchase.prix_total
-        })
-    return render_invoice(request, {
-        'paid': True,
-        'fid': facture.id,
-        'DATE': facture.date,
-        'recipient_name': "{} {}".format(
-            facture.user.name,
-            facture.user.surname
-        ),
-        'address': facture.user.room,
-        'article': purchases_info,
-        'total': facture.prix_total(),
-        'asso_name': AssoOption.get_cached_value('name'),
-        'line1': AssoOption.get_cached_value('adresse1'),
-        'line2': AssoOption.get_cached_value('adresse2'),
-        'siret': AssoOption.get_cached_value('siret'),
-        'email': AssoOption.get_cached_value('contact'),
-        'phone': AssoOption.get_cached_value('telephone'),
-        'tpl_path': os.path.join(settings.BASE_DIR, LOGO_PATH),
-        'payment_method': facture.paiement.moyen,
-    })
+    return render_invoice(request, invoice_context(facture))
 
 
 # TODO : change facture to invoice
@@ -834,7 +801,8 @@ def del_banque(request, instances):
 @can_change(Facture, 'control')
 def control(request):
     """
-    View used to control the invoices all at once.
+    View used to control the invoices all at once. The states of the
+    invoices of the page are applied with `Facture.bulk_set_state`.
     """
     pagination_number = GeneralOption.get_cached_value('pagination_number')
     invoice_list = (Facture.objects.select_related('user').
@@ -845,19 +813,19 @@ def control(request):
         request.GET.get('order'),
         SortTable.COTISATIONS_CONTROL
     )
-    control_invoices_formset = modelformset_factory(
-        Facture,
-        fields=('control', 'valid'),
-        extra=0
-    )
     invoice_list = re2o_paginator(request, invoice_list, pagination_number)
-    control_invoices_form = control_invoices_formset(
-        request.POST or None,
-        queryset=invoice_list.object_list
-    )
-    if control_invoices_form.is_valid():
-        control_invoices_form.save()
-        reversion.set_comment("Controle")
+    if request.method == "POST":
+        states = {}
+        for pk in request.POST.getlist('invoices'):
+            try:
+                pk = int(pk)
+            except ValueError:
+                continue
+            states[pk] = {
+                'control': 'control-%d' % pk in request.POST,
+                'valid': 'valid-%d' % pk in request.POST,
+            }
+        Facture.bulk_set_state(states, request.user)
         messages.success(
             request,
             _("Your changes have been properly taken into account.")
@@ -865,7 +833,6 @@ def control(request):
         return redirect(reverse('cotisations:control'))
     return render(request, 'cotisations/control.html', {
         'facture_list': invoice_list,
-        'controlform': control_invoices_form
     })
 
 
@@ -962,8 +929,9 @@ def index(request):
     View used to display the list of all exisitng invoices.
     """
     pagination_number = GeneralOption.get_cached_value('pagination_number')
-    invoice_list = Facture.objects.select_related('user')\
-        .select_related('paiement').prefetch_related('vente_set')
+    invoice_list = filter_viewable(request.user, Facture.objects.all())\
+        .select_related('user').select_related('paiement')\
+        .prefetch_related('vente_set')
     invoice_list = SortTable.sort(
         invoice_list,
         request.GET.get('col'),
@@ -1059,4 +1027,4 @@ def voucher_pdf(request, invoice, **_kwargs):
         'phone': invoice.user.telephone,
         'date_end': invoice.get_subscription().latest('date_end').date_end,
         'date_begin': invoice.date
-    })
+    }, tag=pdf_tag(invoice.id))
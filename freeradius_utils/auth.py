@@ -21,12 +21,16 @@ Inspiré du travail de Daniel Stan au Crans
 
 import os
 import sys
+import time
 import logging
 import traceback
 import radiusd  # Module magique freeradius (radiusd.py is dummy)
 
 from django.core.wsgi import get_wsgi_application
+from django.db import transaction
 from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from netaddr import INET_PTON, valid_ipv4
 
 proj_path = "/var/www/re2o/"
 # This is so Django knows where to find stuff.
@@ -39,15 +43,24 @@ os.chdir(proj_path)
 # This is so models get loaded.
 application = get_wsgi_application()
 
+from machines.ipindex import IpTypeIndex
 from machines.models import Interface, IpList, Nas, Domain
-from topologie.models import Port, Switch
-from users.models import User
+from topologie.models import (
+    Port, PortProfile, PortProfileResolver, Switch, Room
+)
+from users.models import User, Ban, Whitelist
+from cotisations.models import Cotisation
 from preferences.models import RadiusOption
 
 
 #: Serveur radius de test (pas la prod)
 TEST_SERVER = bool(os.getenv('DBG_FREERADIUS', False))
 
+#: Durée de vie (en secondes) des décisions mises en cache. Les modifications
+#: faites par un autre processus (l'interface web) ne sont vues qu'après
+#: expiration
+CACHE_TTL = int(os.getenv('RADIUS_CACHE_TTL', 30))
+
 
 # Logging
 class RadiusdHandler(logging.Handler):
@@ -73,6 +86,39 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+class DecisionCache(object):
+    """Cache local au processus freeradius, avec expiration.
+    Les entrées sont rangées par espace de noms (nas, port, room, mac) pour
+    pouvoir invalider un espace entier quand un objet lié change."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.store = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_set(self, namespace, key, compute):
+        """Renvoie la valeur en cache, ou la calcule avec `compute`"""
+        now = time.time()
+        entries = self.store.setdefault(namespace, dict())
+        entry = entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *namespaces):
+        """Vide les espaces de noms indiqués (tous si aucun)"""
+        for namespace in namespaces or list(self.store):
+            self.store.pop(namespace, None)
+
+
+decision_cache = DecisionCache(CACHE_TTL)
+
+
 def radius_event(fun):
     """Décorateur pour les fonctions d'interfaces avec radius.
     Une telle fonction prend un uniquement argument, qui est une liste de
@@ -132,7 +178,7 @@ def authorize(data):
     # Toutes les reuquètes non proxifiées
     nas_type = None
     if nas_instance:
-        nas_type = Nas.objects.filter(nas_type=nas_instance.machine_type).first()
+        nas_type = find_nas_type(nas_instance)
     if not nas_type or nas_type.port_access_mode == '802.1X':
         user = data.get('User-Name', '').decode('utf-8', errors='replace')
         user = user.split('@', 1)[0]
@@ -177,7 +223,7 @@ def post_auth(data):
     if not nas_instance:
         logger.info(u"Requete proxifiee, nas inconnu".encode('utf-8'))
         return radiusd.RLM_MODULE_OK
-    nas_type = Nas.objects.filter(nas_type=nas_instance.machine_type).first()
+    nas_type = find_nas_type(nas_instance)
     if not nas_type:
         logger.info(
             u"Type de nas non enregistre dans la bdd!".encode('utf-8')
@@ -253,20 +299,111 @@ def dummy_fun(_):
 
 def detach(_=None):
     """Appelé lors du déchargement du module (enfin, normalement)"""
+    logger.info('Decision cache: %d hits, %d misses' % (
+        decision_cache.hits,
+        decision_cache.misses
+    ))
     print("*** goodbye from auth.py ***")
     return radiusd.RLM_MODULE_OK
 
 
 def find_nas_from_request(nas_id):
     """ Get the nas object from its ID """
-    nas = (Interface.objects
-           .filter(
-               Q(domain=Domain.objects.filter(name=nas_id)) |
-               Q(ipv4=IpList.objects.filter(ipv4=nas_id))
-           )
-           .select_related('machine_type')
-           .select_related('machine__switch__stack'))
-    return nas.first()
+    def compute():
+        if valid_ipv4(nas_id, INET_PTON) and \
+                IpTypeIndex.get().owner(nas_id) is None:
+            # Une ip hors de toutes les plages ne peut être dans IpList
+            return None
+        nas = (Interface.objects
+               .filter(
+                   Q(domain=Domain.objects.filter(name=nas_id)) |
+                   Q(ipv4=IpList.objects.filter(ipv4=nas_id))
+               )
+               .select_related('machine_type')
+               .select_related('machine__switch__stack'))
+        return nas.first()
+    return decision_cache.get_or_set('nas', nas_id, compute)
+
+
+def find_nas_type(nas_instance):
+    """ Get the Nas configuration matching the machine type of the nas """
+    return decision_cache.get_or_set(
+        'nas_type',
+        nas_instance.machine_type_id,
+        lambda: Nas.objects.filter(
+            nas_type=nas_instance.machine_type
+        ).first()
+    )
+
+
+def get_profile_resolver():
+    """Résolveur de profils de ports partagé par les requêtes : les profils
+    par défaut sont rechargés à l'expiration du cache de décisions"""
+    return decision_cache.get_or_set(
+        'port_profiles',
+        None,
+        PortProfileResolver
+    )
+
+
+def find_port_and_profile(nas_machine, port_number):
+    """Renvoie le port du switch et son profil (port, profil), ou
+    (None, None) si le port est inconnu"""
+    def compute():
+        port = (Port.objects
+                .filter(
+                    switch=Switch.objects.filter(machine_ptr=nas_machine),
+                    port=port_number
+                )
+                .select_related('room')
+                .select_related('machine_interface')
+                .select_related('custom_profile__vlan_untagged')
+                .first())
+        if not port:
+            return (None, None)
+        return (port, get_profile_resolver().resolve(port))
+    return decision_cache.get_or_set(
+        'port',
+        (nas_machine.pk, port_number),
+        compute
+    )
+
+
+def find_room_users_state(room):
+    """Renvoie l'état des utilisateurs d'une chambre, sous la forme
+    d'une liste de couples (banni ou désactivé, cotisant ou whitelisté)"""
+    def compute():
+        room_user = User.objects.filter(
+            Q(club__room=room) | Q(adherent__room=room)
+        )
+        return [
+            (
+                user.is_ban() or user.state != User.STATE_ACTIVE,
+                user.is_connected() or user.is_whitelisted()
+            )
+            for user in room_user
+        ]
+    return decision_cache.get_or_set('room', room.pk, compute)
+
+
+def find_interface_and_owner_state(mac_address):
+    """Renvoie (interface, proprio banni, interface active) pour une mac,
+    ou (None, None, None) si la mac est inconnue"""
+    def compute():
+        interface = (Interface.objects
+                     .filter(mac_address=mac_address)
+                     .select_related('machine__user')
+                     .select_related('machine_type__ip_type__vlan')
+                     .select_related('ipv4')
+                     .first())
+        if not interface:
+            return (None, None, None)
+        return (
+            interface,
+            interface.machine.user.is_ban(),
+            interface.is_active
+        )
+    return decision_cache.get_or_set('mac', str(mac_address), compute)
 
 
 def check_user_machine_and_register(nas_type, username, mac_address):
@@ -289,7 +426,9 @@ def check_user_machine_and_register(nas_type, username, mac_address):
         elif not interface.is_active:
             return (False, u"Machine desactivee", '')
         elif not interface.ipv4:
-            interface.assign_ipv4()
+            with transaction.atomic():
+                interface.assign_ipv4()
+                interface.save()
             return (True, u"Ok, Reassignation de l'ipv4", user.pwd_ntlm)
         else:
             return (True, u"Access ok", user.pwd_ntlm)
@@ -356,12 +495,7 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
 
     sw_name = str(getattr(nas_machine, 'short_name', str(nas_machine)))
 
-    port = (Port.objects
-            .filter(
-                switch=Switch.objects.filter(machine_ptr=nas_machine),
-                port=port_number
-            )
-            .first())
+    port, port_profile = find_port_and_profile(nas_machine, port_number)
 
     # Si le port est inconnu, on place sur le vlan defaut
     # Aucune information particulière ne permet de déterminer quelle
@@ -375,9 +509,6 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
             RadiusOption.get_cached_value('unknown_port')!= RadiusOption.REJECT
         )
 
-    # On récupère le profil du port
-    port_profile = port.get_port_profile
-
     # Si un vlan a été précisé dans la config du port,
     # on l'utilise pour VLAN_OK
     if port_profile.vlan_untagged:
@@ -428,9 +559,7 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
                 RadiusOption.get_cached_value('unknown_room')!= RadiusOption.REJECT
             )
 
-        room_user = User.objects.filter(
-            Q(club__room=port.room) | Q(adherent__room=port.room)
-        )
+        room_user = find_room_users_state(room)
         if not room_user:
             return (
                 sw_name,
@@ -439,8 +568,8 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
                 None,
                 False
             )
-        for user in room_user:
-            if user.is_ban() or user.state != User.STATE_ACTIVE:
+        for user_banned, user_access in room_user:
+            if user_banned:
                 return (
                     sw_name,
                     room,
@@ -448,7 +577,7 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
                     None,
                     False
                 )
-            elif not (user.is_connected() or user.is_whitelisted()):
+            elif not user_access:
                 return (
                     sw_name,
                     room,
@@ -462,11 +591,9 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
     # via sa mac dans la bdd
     if port_profile.radius_mode == 'COMMON' or port_profile.radius_mode == 'STRICT':
         # Authentification par mac
-        interface = (Interface.objects
-                     .filter(mac_address=mac_address)
-                     .select_related('machine__user')
-                     .select_related('ipv4')
-                     .first())
+        interface, owner_banned, interface_active = (
+            find_interface_and_owner_state(mac_address)
+        )
         if not interface:
             room = port.room
             # On essaye de register la mac, si l'autocapture a été activée,
@@ -496,7 +623,7 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
         # Enfin on laisse passer sur le vlan pertinent
         else:
             room = port.room
-            if interface.machine.user.is_ban():
+            if owner_banned:
                 return (
                     sw_name,
                     room,
@@ -504,7 +631,7 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
                     getattr(RadiusOption.get_cached_value('banned_vlan'), 'vlan_id', None),
                     RadiusOption.get_cached_value('banned')!= RadiusOption.REJECT
                 )
-            if not interface.is_active:
+            if not interface_active:
                 return (
                     sw_name,
                     room,
@@ -517,7 +644,10 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
             if RadiusOption.get_cached_value('radius_general_policy') == 'MACHINE':
                 DECISION_VLAN = interface.machine_type.ip_type.vlan.vlan_id
             if not interface.ipv4:
-                interface.assign_ipv4()
+                with transaction.atomic():
+                    interface.assign_ipv4()
+                    interface.save()
+                decision_cache.invalidate('mac')
                 return (
                     sw_name,
                     room,
@@ -533,3 +663,32 @@ def decide_vlan_switch(nas_machine, nas_type, port_number,
                     DECISION_VLAN,
                     True
                 )
+
+
+# Invalidation du cache de décisions. Les signaux ne sont reçus que pour les
+# modifications faites dans ce processus (ex: autoregister d'une machine),
+# les autres sont prises en compte à l'expiration des entrées.
+def invalidate_nas_cache(**_kwargs):
+    """Un nas ou une interface a changé"""
+    decision_cache.invalidate('nas', 'nas_type', 'mac')
+
+
+def invalidate_port_cache(**_kwargs):
+    """Un port, un profil ou une chambre a changé"""
+    decision_cache.invalidate('port', 'port_profiles', 'room')
+
+
+def invalidate_access_cache(**_kwargs):
+    """L'accès d'un utilisateur a changé (ban, whitelist, cotisation)"""
+    decision_cache.invalidate('room', 'mac')
+
+
+for signal in (post_save, post_delete):
+    signal.connect(invalidate_nas_cache, sender=Interface)
+    signal.connect(invalidate_nas_cache, sender=Nas)
+    signal.connect(invalidate_port_cache, sender=Port)
+    signal.connect(invalidate_port_cache, sender=PortProfile)
+    signal.connect(invalidate_port_cache, sender=Room)
+    signal.connect(invalidate_access_cache, sender=Ban)
+    signal.connect(invalidate_access_cache, sender=Whitelist)
+    signal.connect(invalidate_access_cache, sender=Cotisation)
@@ -0,0 +1,148 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""logs.archive
+Archivage de l'historique de reversion.
+
+Les révisions antérieures à une date sont déplacées, par lots, de
+reversion.Revision et reversion.Version vers ArchivedRevision (versions en
+json compressé) et ArchivedVersion (l'index des objets). Chaque lot est
+une transaction courte : lecture des lignes, insertion des archives,
+suppression des originaux, de sorte que les tables de reversion ne sont
+jamais verrouillées longtemps et restent petites.
+
+L'historique d'un objet (logs.views.history) lit les deux : les versions
+récentes, puis les versions archivées, toutes plus anciennes.
+"""
+
+from __future__ import unicode_literals
+
+import time
+
+from dateutil.relativedelta import relativedelta
+from django.db import transaction
+from django.utils import timezone
+from reversion.models import Revision, Version
+
+from preferences.models import GeneralOption
+
+from .models import ArchivedRevision, ArchivedVersion
+
+VERSION_FIELDS = (
+    'revision_id',
+    'content_type_id',
+    'object_id',
+    'db',
+    'format',
+    'serialized_data',
+    'object_repr',
+)
+
+
+def retention_limit(months=None):
+    """La date avant laquelle les révisions sont archivées, ou None si
+    l'archivage est désactivé (history_retention_months à 0)"""
+    if months is None:
+        months = GeneralOption.get_cached_value('history_retention_months')
+    if not months:
+        return None
+    return timezone.now() - relativedelta(months=months)
+
+
+def archive_batch(before, batch_size):
+    """Archive au plus batch_size révisions antérieures à before, en une
+    transaction. Retourne le nombre de révisions archivées"""
+    with transaction.atomic():
+        revisions = list(
+            Revision.objects.filter(date_created__lt=before)
+            .order_by('pk')
+            .values('pk', 'date_created', 'user_id', 'comment')
+            [:batch_size]
+        )
+        if not revisions:
+            return 0
+        ids = [revision['pk'] for revision in revisions]
+        versions = {}
+        for version in Version.objects.filter(
+                revision_id__in=ids
+        ).order_by('pk').values(*VERSION_FIELDS).iterator():
+            versions.setdefault(version.pop('revision_id'), []).append(version)
+        ArchivedRevision.objects.bulk_create([
+            ArchivedRevision(
+                id=revision['pk'],
+                date_created=revision['date_created'],
+                user_id=revision['user_id'],
+                comment=revision['comment'],
+                data=ArchivedRevision.pack(versions.get(revision['pk'], []))
+            )
+            for revision in revisions
+        ])
+        ArchivedVersion.objects.bulk_create([
+            ArchivedVersion(
+                revision_id=revision_id,
+                content_type_id=version['content_type_id'],
+                object_id=version['object_id'],
+                object_repr=version['object_repr']
+            )
+            for revision_id, revision_versions in versions.items()
+            for version in revision_versions
+        ], batch_size=1000)
+        Version.objects.filter(revision_id__in=ids).delete()
+        Revision.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def archive_revisions(before, batch_size=500, pause=0, progress=None):
+    """Archive toutes les révisions antérieures à before, par lots de
+    batch_size, en attendant pause secondes entre deux lots. progress est
+    appelé avec le total archivé après chaque lot"""
+    total = 0
+    while True:
+        count = archive_batch(before, batch_size)
+        if not count:
+            return total
+        total += count
+        if progress is not None:
+            progress(total)
+        if pause:
+            time.sleep(pause)
+
+
+class HistoryList(object):
+    """Les versions récentes (queryset de Version) suivies des versions
+    archivées (queryset d'ArchivedVersion), vues comme une seule liste
+    paginable : seules les lignes de la page demandée sont lues"""
+
+    def __init__(self, versions, archived):
+        self.versions = versions
+        self.archived = archived
+        self._counts = None
+
+    def counts(self):
+        """Nombre de versions récentes et archivées"""
+        if self._counts is None:
+            self._counts = (self.versions.count(), self.archived.count())
+        return self._counts
+
+    def count(self):
+        return sum(self.counts())
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        hot = self.counts()[0]
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        rows = []
+        if start < hot:
+            rows.extend(self.versions[start:min(stop, hot)])
+        if stop > hot:
+            rows.extend(self.archived[max(start - hot, 0):stop - hot])
+        return rows
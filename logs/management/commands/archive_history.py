@@ -0,0 +1,59 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""
+Archive les révisions de reversion plus anciennes que la durée de
+rétention (history_retention_months des options générales, voir
+logs.archive). A utiliser dans un cron, par exemple toutes les nuits.
+"""
+
+from django.core.management.base import BaseCommand
+
+from logs.archive import archive_revisions, retention_limit
+
+
+class Command(BaseCommand):
+    """ The command object for `archive_history` """
+    help = "Archive les révisions plus anciennes que la durée de rétention"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months',
+            type=int,
+            default=None,
+            help="Durée de rétention en mois (par défaut celle des options"
+                 " générales)",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Nombre de révisions archivées par transaction",
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.1,
+            help="Secondes d'attente entre deux lots",
+        )
+
+    def _progress(self, total):
+        self.stdout.write("%d révisions archivées" % total)
+
+    def handle(self, *args, **options):
+        before = retention_limit(options['months'])
+        if before is None:
+            self.stdout.write("Archivage de l'historique désactivé")
+            return
+        total = archive_revisions(
+            before,
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            progress=self._progress if options['verbosity'] > 1 else None
+        )
+        self.stdout.write("%d révisions antérieures au %s archivées" % (
+            total, before))
@@ -0,0 +1,34 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""
+Enregistre un relevé des statistiques générales (voir logs.models). A
+utiliser dans un cron, par exemple toutes les heures.
+"""
+
+from django.core.management.base import BaseCommand
+
+from logs.models import StatsSnapshot
+
+
+class Command(BaseCommand):
+    """ The command object for `refresh_stats` """
+    help = "Enregistre un relevé des statistiques générales"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-days',
+            type=int,
+            default=365,
+            help="Supprime les relevés plus anciens que ce nombre de jours",
+        )
+
+    def handle(self, *args, **options):
+        snapshot = StatsSnapshot.take()
+        purged = StatsSnapshot.purge(options['keep_days'])
+        self.stdout.write("Relevé du %s enregistré, %d anciens supprimés" % (
+            snapshot.date, purged))
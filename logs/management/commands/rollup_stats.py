@@ -0,0 +1,50 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""
+Tient les séries quotidiennes des statistiques (voir logs.rollup). A
+lancer chaque jour dans un cron, et une fois avec --backfill pour
+reconstruire l'historique à partir des cotisations, bans et whitelists.
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from logs.rollup import first_day, rollup
+
+
+class Command(BaseCommand):
+    """ The command object for `rollup_stats` """
+    help = "Met à jour les séries quotidiennes des statistiques"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backfill',
+            action='store_true',
+            default=False,
+            help="Recalcule depuis la première cotisation, ban ou whitelist",
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=7,
+            help="Nombre de jours recalculés, jusqu'à aujourd'hui (les "
+                 "cotisations peuvent être saisies après coup)",
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            start = first_day()
+        else:
+            if options['days'] < 1:
+                raise CommandError("--days doit être au moins 1")
+            start = timezone.localdate() - timedelta(days=options['days'] - 1)
+        written = rollup(start)
+        self.stdout.write("%d valeurs enregistrées depuis le %s" % (
+            written, start))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-05-06 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+import re2o.mixins
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('data', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'statistics snapshot',
+                'verbose_name_plural': 'statistics snapshots',
+            },
+            bases=(re2o.mixins.AclMixin, models.Model),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-05-07 09:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import re2o.mixins
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('metric', models.CharField(max_length=64)),
+                ('value', models.IntegerField()),
+            ],
+            options={
+                'verbose_name': 'daily statistic',
+                'verbose_name_plural': 'daily statistics',
+            },
+            bases=(re2o.mixins.AclMixin, models.Model),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyrollup',
+            unique_together=set([('day', 'metric')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='dailyrollup',
+            index_together=set([('metric', 'day')]),
+        ),
+    ]
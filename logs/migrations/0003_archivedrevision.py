@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-05-09 14:31
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import re2o.mixins
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('logs', '0002_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRevision',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('date_created', models.DateTimeField(db_index=True)),
+                ('comment', models.TextField(blank=True)),
+                ('data', models.BinaryField()),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'archived revision',
+                'verbose_name_plural': 'archived revisions',
+            },
+            bases=(re2o.mixins.AclMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name='ArchivedVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=191)),
+                ('object_repr', models.TextField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('revision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_versions', to='logs.ArchivedRevision')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedversion',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
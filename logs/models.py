@@ -0,0 +1,173 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""logs.models
+Les relevés des statistiques générales : calculés par la commande
+refresh_stats (à lancer dans un cron), la page des statistiques affiche le
+dernier et l'historique des précédents.
+
+Les séries quotidiennes (DailyRollup) sont tenues par la commande
+rollup_stats, voir logs.rollup.
+
+Les révisions de plus de history_retention_months mois (GeneralOption) sont
+déplacées par la commande archive_history dans ArchivedRevision, voir
+logs.archive.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import operator
+import zlib
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from re2o.mixins import AclMixin
+
+
+class StatsSnapshot(AclMixin, models.Model):
+    """Un relevé horodaté des compteurs de logs.stats.StatsEngine"""
+
+    date = models.DateTimeField(default=timezone.now, db_index=True)
+    data = models.TextField()
+
+    class Meta:
+        verbose_name = _("statistics snapshot")
+        verbose_name_plural = _("statistics snapshots")
+
+    @classmethod
+    def take(cls):
+        """Calcule les compteurs et enregistre le relevé"""
+        from .stats import StatsEngine
+        engine = StatsEngine()
+        return cls.objects.create(
+            date=engine.now,
+            data=json.dumps(engine.compute())
+        )
+
+    @classmethod
+    def latest_snapshot(cls):
+        """Le dernier relevé, ou None"""
+        return cls.objects.order_by('-date').first()
+
+    @classmethod
+    def purge(cls, days):
+        """Supprime les relevés de plus de days jours"""
+        return cls.objects.filter(
+            date__lt=timezone.now() - timedelta(days=days)
+        ).delete()[0]
+
+    @property
+    def counters(self):
+        """Les compteurs du relevé"""
+        return json.loads(self.data)
+
+    def __str__(self):
+        return str(self.date)
+
+
+class DailyRollup(AclMixin, models.Model):
+    """La valeur d'un compteur un jour donné. Les compteurs sont les
+    users adhérents (adherents), ayant accès (access), bannis (banned),
+    whitelistés (whitelisted), les interfaces actives (interfaces), celles
+    ayant une ipv4 (assigned_interfaces), et les ip assignées de chaque
+    plage (assigned_ips:<pk de l'IpType>)"""
+
+    day = models.DateField()
+    metric = models.CharField(max_length=64)
+    value = models.IntegerField()
+
+    class Meta:
+        unique_together = ("day", "metric")
+        index_together = (("metric", "day"),)
+        verbose_name = _("daily statistic")
+        verbose_name_plural = _("daily statistics")
+
+    @staticmethod
+    def ip_metric(ip_type_id):
+        """Le nom du compteur des ip assignées d'une plage"""
+        return 'assigned_ips:%d' % ip_type_id
+
+    def __str__(self):
+        return "%s %s" % (self.day, self.metric)
+
+
+class ArchivedRevision(AclMixin, models.Model):
+    """Une révision de reversion archivée, avec la même clef, ses versions
+    étant stockées en json compressé. Expose les attributs d'une Revision
+    utilisés par l'historique (date_created, user, comment)"""
+
+    id = models.IntegerField(primary_key=True)
+    date_created = models.DateTimeField(db_index=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True
+    )
+    comment = models.TextField(blank=True)
+    data = models.BinaryField()
+
+    class Meta:
+        verbose_name = _("archived revision")
+        verbose_name_plural = _("archived revisions")
+
+    @staticmethod
+    def pack(versions):
+        """Compresse une liste de versions (dictionnaires)"""
+        return zlib.compress(json.dumps(versions).encode('utf-8'))
+
+    @property
+    def versions(self):
+        """Les versions de la révision : content_type, object_id, db,
+        format, serialized_data et object_repr"""
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    def __str__(self):
+        return "%s %s" % (self.id, self.date_created)
+
+
+class ArchivedVersion(models.Model):
+    """L'index des objets d'une révision archivée, pour retrouver
+    l'historique d'un objet sans décompresser les archives"""
+
+    revision = models.ForeignKey(
+        ArchivedRevision,
+        on_delete=models.CASCADE,
+        related_name='archived_versions'
+    )
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=191)
+    object_repr = models.TextField()
+
+    class Meta:
+        index_together = (("content_type", "object_id"),)
+
+    @classmethod
+    def get_for_objects(cls, objects):
+        """Les versions archivées des objets, les plus récentes d'abord"""
+        queries = [
+            models.Q(
+                content_type=ContentType.objects.get_for_model(obj),
+                object_id=str(obj.pk)
+            )
+            for obj in objects
+        ]
+        if not queries:
+            return cls.objects.none()
+        return cls.objects.filter(reduce(operator.or_, queries)).select_related(
+            'revision__user'
+        ).order_by('-revision__date_created', '-pk')
+
+    def __str__(self):
+        return self.object_repr
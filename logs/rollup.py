@@ -0,0 +1,212 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""logs.rollup
+Séries quotidiennes des statistiques (voir logs.models.DailyRollup).
+
+Les compteurs d'users (adhérents, users ayant accès, bannis, whitelistés)
+d'une période sont recalculés à partir des intervalles [date_start,
+date_end] des cotisations, bans et whitelists : les intervalles de chaque
+user sont fusionnés, puis un balayage des débuts et fins triés donne le
+nombre d'users couverts à minuit de chaque jour. Cinq requêtes suffisent,
+quelle que soit la longueur de la période.
+
+Les interfaces actives et les ip assignées par plage ne sont pas datées
+en base : elles sont relevées pour le jour courant seulement.
+"""
+
+from __future__ import unicode_literals
+
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from cotisations.models import Cotisation
+from users.models import Ban, User, Whitelist
+
+from .models import DailyRollup
+from .stats import StatsEngine
+
+USER_METRICS = ('adherents', 'access', 'banned', 'whitelisted')
+
+
+def merge_intervals(intervals):
+    """Fusionne des intervalles (début, fin) qui se chevauchent. Deux
+    intervalles qui se touchent restent séparés : à l'instant commun,
+    aucun ne compte (début < t < fin)"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start < merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def subtract_intervals(intervals, removed):
+    """Les parties des intervalles fusionnés intervals hors des
+    intervalles fusionnés removed"""
+    result = []
+    for start, end in intervals:
+        for removed_start, removed_end in removed:
+            if removed_end <= start or removed_start >= end:
+                continue
+            if removed_start > start:
+                result.append((start, removed_start))
+            start = max(start, removed_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def sweep_counts(intervals_by_user, instants):
+    """Nombre d'users dont un intervalle couvre chaque instant (début <
+    instant < fin), pour des instants triés, en un balayage des bornes"""
+    events = []
+    for intervals in intervals_by_user.values():
+        for start, end in merge_intervals(intervals):
+            events.append((start, 1))
+            events.append((end, -1))
+    # A date égale, les fins passent avant les débuts
+    events.sort()
+    counts = []
+    current = 0
+    index = 0
+    for instant in instants:
+        while index < len(events) and events[index] <= (instant, -1):
+            current += events[index][1]
+            index += 1
+        counts.append(current)
+    return counts
+
+
+def day_instants(first_day, last_day):
+    """Minuit (heure locale) de chaque jour de la période"""
+    instants = []
+    day = first_day
+    while day <= last_day:
+        instants.append(timezone.make_aware(datetime.combine(day, time.min)))
+        day += timedelta(days=1)
+    return instants
+
+
+def _intervals(queryset, user_field, window_start, window_end):
+    """Intervalles par user des lignes de queryset qui recoupent la
+    période, en une requête"""
+    by_user = {}
+    for user_id, start, end in queryset.filter(
+            date_start__lt=window_end,
+            date_end__gt=window_start
+    ).values_list(user_field, 'date_start', 'date_end').iterator():
+        by_user.setdefault(user_id, []).append((start, end))
+    return by_user
+
+
+def user_series(first_day, last_day):
+    """Les séries des compteurs d'users de first_day à last_day inclus.
+    L'état des users (actif, désactivé...) n'étant pas historisé, l'accès
+    est celui des users aujourd'hui actifs"""
+    instants = day_instants(first_day, last_day)
+    if not instants:
+        return [], {metric: [] for metric in USER_METRICS}
+    window_start, window_end = instants[0], instants[-1] + timedelta(days=1)
+    valid_cotisations = Cotisation.objects.filter(
+        vente__facture__facture__valid=True
+    )
+    user_field = 'vente__facture__facture__user'
+    adhesions = _intervals(
+        valid_cotisations.filter(type_cotisation__in=['All', 'Adhesion']),
+        user_field, window_start, window_end
+    )
+    connexions = _intervals(
+        valid_cotisations.filter(type_cotisation__in=['All', 'Connexion']),
+        user_field, window_start, window_end
+    )
+    bans = _intervals(Ban.objects.all(), 'user', window_start, window_end)
+    whitelists = _intervals(
+        Whitelist.objects.all(), 'user', window_start, window_end
+    )
+    active_users = set(User.objects.filter(
+        state=User.STATE_ACTIVE
+    ).values_list('pk', flat=True))
+    access = {}
+    for user_id in (set(connexions) | set(whitelists)) & active_users:
+        allowed = merge_intervals(
+            connexions.get(user_id, []) + whitelists.get(user_id, [])
+        )
+        access[user_id] = subtract_intervals(
+            allowed,
+            merge_intervals(bans.get(user_id, []))
+        )
+    series = {
+        'adherents': sweep_counts(adhesions, instants),
+        'access': sweep_counts(access, instants),
+        'banned': sweep_counts(bans, instants),
+        'whitelisted': sweep_counts(whitelists, instants),
+    }
+    return [instant.date() for instant in instants], series
+
+
+def current_counters():
+    """Les compteurs qui ne peuvent être relevés qu'au présent : interfaces
+    actives et ip assignées par plage"""
+    engine = StatsEngine()
+    interfaces = engine.interfaces()
+    counters = {
+        'interfaces': interfaces['actives_interfaces'][0],
+        'assigned_interfaces': interfaces['actives_assigned_interfaces'][0],
+    }
+    for ip_type_id, row in engine.ip_counts().items():
+        counters[DailyRollup.ip_metric(ip_type_id)] = row['used']
+    return counters
+
+
+def rollup(first_day, last_day=None):
+    """Recalcule et enregistre les séries de first_day à last_day (par
+    défaut aujourd'hui). Les compteurs du présent sont ajoutés si la
+    période inclut aujourd'hui. Retourne le nombre de lignes écrites"""
+    today = timezone.localdate()
+    last_day = min(last_day or today, today)
+    days, series = user_series(first_day, last_day)
+    rows = [
+        DailyRollup(day=day, metric=metric, value=values[index])
+        for metric, values in series.items()
+        for index, day in enumerate(days)
+    ]
+    if last_day == today:
+        for metric, value in current_counters().items():
+            rows.append(DailyRollup(day=today, metric=metric, value=value))
+    with transaction.atomic():
+        DailyRollup.objects.filter(
+            day__range=(first_day, last_day),
+            metric__in=USER_METRICS
+        ).delete()
+        if last_day == today:
+            DailyRollup.objects.filter(day=today).exclude(
+                metric__in=USER_METRICS
+            ).delete()
+        DailyRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def first_day():
+    """Le premier jour couvert par une cotisation, un ban ou une
+    whitelist"""
+    starts = [
+        queryset.order_by('date_start').values_list(
+            'date_start', flat=True
+        ).first()
+        for queryset in (Cotisation.objects, Ban.objects, Whitelist.objects)
+    ]
+    starts = [start for start in starts if start is not None]
+    if not starts:
+        return timezone.localdate()
+    return timezone.localtime(min(starts)).date()
@@ -0,0 +1,171 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2018  Gabriel Détraz
+# Copyright © 2018  Goulven Kermarec
+# Copyright © 2018  Augustin Lemesle
+
+"""logs.stats
+Calcul des statistiques générales (users par état, adhérents, accès,
+interfaces actives, remplissage des plages d'ip).
+
+Chaque table est parcourue une fois : les compteurs sont des agrégats
+conditionnels (SUM(CASE WHEN ...)) sur les users, leurs dates de fin
+d'accès dénormalisées (UserAccessState), les interfaces et les ip, au lieu
+d'un count() par case du tableau. Les conditions d'accès sont celles de
+re2o.utils (access_q, has_access_q).
+"""
+
+from __future__ import unicode_literals
+
+from django.db.models import Case, Count, IntegerField, Q, Sum, When
+from django.utils import timezone
+
+from machines.models import Interface, IpList, IpType
+from preferences.models import AssoOption
+from re2o.utils import access_q, has_access_q
+from users.models import User
+
+# Lignes du tableau des users, dans l'ordre d'affichage
+USER_STATES = (
+    ('active_users', User.STATE_ACTIVE),
+    ('inactive_users', User.STATE_DISABLED),
+    ('archive_users', User.STATE_ARCHIVE),
+    ('full_archive_users', User.STATE_FULL_ARCHIVE),
+    ('not_active_users', User.STATE_NOT_YET_ACTIVE),
+)
+ACCESS_ROWS = (
+    'adherent_users',
+    'connexion_users',
+    'ban_users',
+    'whitelisted_user',
+)
+INTERFACE_ROWS = (
+    'actives_interfaces',
+    'actives_assigned_interfaces',
+)
+
+
+def count_if(condition):
+    """Agrégat comptant les lignes vérifiant condition"""
+    return Sum(Case(
+        When(condition, then=1),
+        default=0,
+        output_field=IntegerField()
+    ))
+
+
+def by_kind(prefix=''):
+    """Les conditions des trois colonnes : tous, adhérents, clubs"""
+    return (
+        ('', Q()),
+        ('_adherent', Q(**{prefix + 'adherent__isnull': False})),
+        ('_club', Q(**{prefix + 'club__isnull': False})),
+    )
+
+
+class StatsEngine(object):
+    """Calcule l'ensemble des compteurs en quelques requêtes"""
+
+    def __init__(self, now=None):
+        self.now = now or timezone.now()
+
+    def user_states(self):
+        """Nombre d'users, d'adhérents et de clubs par état, en une
+        requête groupée par état"""
+        rows = {
+            row['state']: [row['total'], row['adherents'], row['clubs']]
+            for row in User.objects.values('state').annotate(
+                total=Count('pk'),
+                adherents=Count('adherent'),
+                clubs=Count('club')
+            ).order_by()
+        }
+        return {
+            key: rows.get(state, [0, 0, 0])
+            for key, state in USER_STATES
+        }
+
+    def access(self):
+        """Adhérents, users ayant accès, bannis et whitelistés (sans
+        l'user de l'asso), en une requête"""
+        conditions = {
+            'adherent_users': access_q('adhesion', self.now),
+            'connexion_users': has_access_q(self.now),
+            'ban_users': access_q('ban', self.now),
+            'whitelisted_user': access_q('whitelist', self.now),
+        }
+        aggregates = {}
+        for key, condition in conditions.items():
+            for suffix, kind in by_kind():
+                aggregates[key + suffix] = count_if(condition & kind)
+        counts = User.objects.aggregate(**aggregates)
+        return {
+            key: [counts[key + suffix] or 0 for suffix, _kind in by_kind()]
+            for key in ACCESS_ROWS
+        }
+
+    def active_interface_q(self, prefix=''):
+        """Interfaces (atteintes par prefix) des machines actives des users
+        ayant accès, ou de l'user de l'asso, comme
+        all_active_interfaces_count"""
+        access = has_access_q(self.now, prefix + 'machine__user__')
+        asso_user = AssoOption.get_cached_value('utilisateur_asso')
+        if asso_user:
+            access |= Q(**{prefix + 'machine__user': asso_user})
+        return Q(**{prefix + 'machine__active': True}) & access
+
+    def interfaces(self):
+        """Interfaces actives, et celles ayant une ipv4, en une requête"""
+        active = self.active_interface_q()
+        conditions = {
+            'actives_interfaces': active,
+            'actives_assigned_interfaces': active & Q(ipv4__isnull=False),
+        }
+        aggregates = {}
+        for key, condition in conditions.items():
+            for suffix, kind in by_kind('machine__user__'):
+                aggregates[key + suffix] = count_if(condition & kind)
+        counts = Interface.objects.aggregate(**aggregates)
+        return {
+            key: [counts[key + suffix] or 0 for suffix, _kind in by_kind()]
+            for key in INTERFACE_ROWS
+        }
+
+    def ip_counts(self):
+        """Par pk d'IpType : nombre d'ip, d'ip assignées et d'ip assignées
+        à une interface active, en une requête groupée par plage"""
+        return {
+            row['ip_type']: row
+            for row in IpList.objects.values('ip_type').annotate(
+                total=Count('pk'),
+                used=Count('interface'),
+                active=count_if(self.active_interface_q('interface__'))
+            ).order_by()
+        }
+
+    def ip_ranges(self):
+        """Par plage : nom, vlan, nombre d'ip, d'ip assignées, d'ip
+        assignées à une interface active et d'ip libres"""
+        counts = self.ip_counts()
+        ranges = []
+        for ip_type in IpType.objects.select_related('vlan').order_by('pk'):
+            row = counts.get(ip_type.pk, {})
+            total = row.get('total', 0)
+            used = row.get('used', 0)
+            ranges.append([
+                str(ip_type),
+                str(ip_type.vlan) if ip_type.vlan else '',
+                total,
+                used,
+                row.get('active') or 0,
+                total - used,
+            ])
+        return ranges
+
+    def compute(self):
+        """Tous les compteurs, sous une forme sérialisable en json"""
+        users = self.user_states()
+        users.update(self.access())
+        users.update(self.interfaces())
+        return {'users': users, 'ip': self.ip_ranges()}
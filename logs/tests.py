@@ -9,6 +9,84 @@
 The tests for the Logs module.
 """
 
-# from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from .rollup import (
+    USER_METRICS,
+    merge_intervals,
+    subtract_intervals,
+    sweep_counts,
+    user_series,
+)
+
+
+class IntervalsTestCase(SimpleTestCase):
+    """The interval arithmetic behind the daily user counters"""
+
+    def test_merge_overlapping(self):
+        self.assertEqual(
+            merge_intervals([(5, 8), (1, 3), (2, 4), (6, 7)]),
+            [(1, 4), (5, 8)]
+        )
+
+    def test_merge_touching_stay_apart(self):
+        self.assertEqual(merge_intervals([(3, 5), (1, 3)]), [(1, 3), (3, 5)])
+
+    def test_merge_empty(self):
+        self.assertEqual(merge_intervals([]), [])
+
+    def test_subtract_ban(self):
+        self.assertEqual(
+            subtract_intervals([(0, 10), (20, 30)], [(2, 4), (8, 22)]),
+            [(0, 2), (4, 8), (22, 30)]
+        )
+
+    def test_subtract_whole_interval(self):
+        self.assertEqual(subtract_intervals([(2, 4)], [(0, 10)]), [])
+
+    def test_subtract_touching_ban(self):
+        self.assertEqual(
+            subtract_intervals([(2, 4)], [(0, 2), (4, 6)]),
+            [(2, 4)]
+        )
+
+    def test_sweep_open_bounds(self):
+        # Neither the start nor the end of an interval is counted
+        self.assertEqual(
+            sweep_counts({1: [(1, 3)]}, [0, 1, 2, 3, 4]),
+            [0, 0, 1, 0, 0]
+        )
+
+    def test_sweep_touching_intervals(self):
+        self.assertEqual(
+            sweep_counts({1: [(1, 3), (3, 5)], 2: [(0, 3)]}, [2, 3, 4]),
+            [2, 0, 1]
+        )
+
+    def test_sweep_merges_per_user(self):
+        self.assertEqual(
+            sweep_counts({1: [(0, 4), (2, 6)], 2: [(1, 5)]}, [3, 5]),
+            [2, 1]
+        )
+
+    def test_sweep_no_instant(self):
+        self.assertEqual(sweep_counts({1: [(0, 4)]}, []), [])
+
+
+class UserSeriesTestCase(TestCase):
+    """The daily series of the user counters"""
+
+    def test_empty_period(self):
+        today = timezone.localdate()
+        days, series = user_series(today, today - timedelta(days=1))
+        self.assertEqual(days, [])
+        self.assertEqual(series, {metric: [] for metric in USER_METRICS})
+
+    def test_rollup_stats_rejects_days(self):
+        with self.assertRaises(CommandError):
+            call_command('rollup_stats', days=0)
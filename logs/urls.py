@@ -25,6 +25,10 @@ urlpatterns = [
     url(r'^stats_models/$', views.stats_models, name='stats-models'),
     url(r'^stats_users/$', views.stats_users, name='stats-users'),
     url(r'^stats_actions/$', views.stats_actions, name='stats-actions'),
+    url(r'^stats_jobs/$', views.stats_jobs, name='stats-jobs'),
+    url(r'^retry_job/(?P<jobid>[0-9]+)$',
+        views.retry_job,
+        name='retry-job'),
     url(
         r'(?P<application>\w+)/(?P<object_name>\w+)/(?P<object_id>[0-9]+)$',
         views.history,
@@ -25,8 +25,9 @@ from django.urls import reverse
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from django.http import Http404
-from django.db.models import Count
+from django.db.models import Count, prefetch_related_objects
 from django.apps import apps
 from django.utils.translation import ugettext as _
 
@@ -78,71 +79,98 @@ from topologie.models import (
     AccessPoint
 )
 from preferences.models import GeneralOption
+from re2o.models import Job
 from re2o.views import form
-from re2o.utils import (
-    all_whitelisted,
-    all_baned,
-    all_has_access,
-    all_adherent,
-    all_active_assigned_interfaces_count,
-    all_active_interfaces_count,
-)
 from re2o.base import (
+    keyset_paginator,
     re2o_paginator,
     SortTable
 )
 from re2o.acl import (
+    acl_check,
+    can_edit,
     can_view_all,
     can_view_app,
     can_edit_history,
 )
 
+from .archive import HistoryList
+from .models import ArchivedVersion, StatsSnapshot
+from .stats import StatsEngine
+
+# Number of snapshots shown in the history of the general statistics
+STATS_HISTORY_LENGTH = 48
+
+# The types of content shown in the summary of the index, with the relations
+# followed by their description
+VERSION_RELATED = {
+    'ban': ['user'],
+    'whitelist': ['user'],
+    'vente': ['facture__facture__user'],
+    'interface': ['machine__user'],
+    'user': [],
+}
+
+
+def resolve_versions(versions):
+    """Charge les objets des versions, en une requête par type d'objet (et
+    par relation affichée), et écarte les versions dont l'objet a été
+    supprimé"""
+    prefetch_related_objects(versions, 'object')
+    objects = {}
+    for version in versions:
+        if version.object is not None:
+            objects.setdefault(
+                version.content_type.model, []
+            ).append(version.object)
+    for model, model_objects in objects.items():
+        related = VERSION_RELATED.get(model)
+        if related:
+            prefetch_related_objects(model_objects, *related)
+    return [version for version in versions if version.object is not None]
+
 
 @login_required
 @can_view_app('logs')
 def index(request):
     """Affiche les logs affinés, date reformatées, selectionne
-    les event importants (ajout de droits, ajout de ban/whitelist)"""
+    les event importants (ajout de droits, ajout de ban/whitelist).
+    Paginé par curseur sur la date de la révision, les objets des versions
+    étant chargés en une requête par type"""
     pagination_number = GeneralOption.get_cached_value('pagination_number')
-    # The types of content kept for display
-    content_type_filter = ['ban', 'whitelist', 'vente', 'interface', 'user']
     # Select only wanted versions
     versions = Version.objects.filter(
         content_type__in=ContentType.objects.filter(
-            model__in=content_type_filter
+            model__in=VERSION_RELATED.keys()
         )
-    ).select_related('revision')
-    versions = SortTable.sort(
+    ).select_related('revision__user', 'content_type')
+    if request.GET.get('col') == 'sum_date' and \
+            request.GET.get('order') != 'desc':
+        ordering = ['revision__date_created', 'id']
+    else:
+        ordering = ['-revision__date_created', '-id']
+    versions = keyset_paginator(
+        request,
         versions,
-        request.GET.get('col'),
-        request.GET.get('order'),
-        SortTable.LOGS_INDEX
+        pagination_number,
+        ordering,
+        keep=resolve_versions
     )
-    versions = re2o_paginator(request, versions, pagination_number)
-    # Force to have a list instead of QuerySet
-    versions.count(0)
-    # Items to remove later because invalid
-    to_remove = []
-    # Parse every item (max = pagination_number)
-    for i in range(len(versions.object_list)):
-        if versions.object_list[i].object:
-            version = versions.object_list[i]
-            versions.object_list[i] = {
-                'rev_id': version.revision.id,
-                'comment': version.revision.comment,
-                'datetime': version.revision.date_created.strftime(
-                    '%d/%m/%y %H:%M:%S'
-                ),
-                'username':
-                    version.revision.user.get_username()
-                    if version.revision.user else '?',
-                'user_id': version.revision.user_id,
-                'version': version}
-        else:
-            to_remove.insert(0, i)
-    # Remove all tagged invalid items
-    for i in to_remove:
-        versions.object_list.pop(i)
+    versions.object_list = [
+        {
+            'rev_id': version.revision.id,
+            'comment': version.revision.comment,
+            'datetime': version.revision.date_created.strftime(
+                '%d/%m/%y %H:%M:%S'
+            ),
+            'username':
+                version.revision.user.get_username()
+                if version.revision.user else '?',
+            'user_id': version.revision.user_id,
+            'version': version
+        }
+        for version in versions.object_list
+    ]
     return render(request, 'logs/index.html', {'versions_list': versions})
 
 
@@ -150,17 +178,32 @@ def index(request):
 @can_view_all(GeneralOption)
 def stats_logs(request):
     """Affiche l'ensemble des logs et des modifications sur les objets,
-    classés par date croissante, en vrac"""
+    classés par date croissante, en vrac. Paginé par curseur sur la date,
+    sauf pour le tri par auteur"""
     pagination_number = GeneralOption.get_cached_value('pagination_number')
-    revisions = Revision.objects.all().select_related('user')\
-        .prefetch_related('version_set__object')
-    revisions = SortTable.sort(
-        revisions,
-        request.GET.get('col'),
-        request.GET.get('order'),
-        SortTable.LOGS_STATS_LOGS
-    )
-    revisions = re2o_paginator(request, revisions, pagination_number)
+    revisions = Revision.objects.all().select_related('user')
+    col = request.GET.get('col')
+    if col == 'logs_author':
+        revisions = SortTable.sort(
+            revisions,
+            col,
+            request.GET.get('order'),
+            SortTable.LOGS_STATS_LOGS
+        )
+        revisions = re2o_paginator(request, revisions, pagination_number)
+        revisions.object_list = list(revisions.object_list)
+    else:
+        if col == 'logs_date' and request.GET.get('order') != 'desc':
+            ordering = ['date_created', 'id']
+        else:
+            ordering = ['-date_created', '-id']
+        revisions = keyset_paginator(
+            request,
+            revisions,
+            pagination_number,
+            ordering
+        )
+    prefetch_related_objects(revisions.object_list, 'version_set__object')
     return render(request, 'logs/stats_logs.html', {
         'revisions_list': revisions
     })
@@ -184,28 +227,65 @@ def revert_action(request, revision_id):
     }, 'logs/delete.html', request)
 
 
+@login_required
+@can_view_all(Job)
+def stats_jobs(request):
+    """Etat de la file des jobs : nombre de jobs par tâche et par statut,
+    et les jobs en échec ou en attente, du plus récent au plus ancien"""
+    pagination_number = GeneralOption.get_cached_value('pagination_number')
+    counts = {}
+    for task, status, count in Job.objects.values_list(
+            'task', 'status').annotate(count=Count('pk')).order_by('task'):
+        counts.setdefault(task, {})[status] = count
+    jobs = Job.objects.exclude(status=Job.STATUS_DONE).order_by('-updated')
+    jobs = re2o_paginator(request, jobs, pagination_number)
+    return render(request, 'logs/stats_jobs.html', {
+        'jobs_counts': sorted(counts.items()),
+        'jobs_list': jobs,
+    })
+
+
+@login_required
+@require_POST
+@can_edit(Job)
+def retry_job(request, job_instance, **_kwargs):
+    """Remet un job en échec dans la file"""
+    if job_instance.status != Job.STATUS_FAILED:
+        messages.error(request, _("Only a failed job can be queued again."))
+    else:
+        job_instance.retry()
+        messages.success(request, _("The job was queued again."))
+    return redirect(reverse('logs:stats-jobs'))
+
+
 @login_required
 @can_view_all(IpList, Interface, User)
 def stats_general(request):
     """Statistiques générales affinées sur les ip, activées, utilisées par
     range, et les statistiques générales sur les users : users actifs,
-    cotisants, activés, archivés, etc"""
-    ip_dict = dict()
-    for ip_range in IpType.objects.select_related('vlan').all():
-        all_ip = IpList.objects.filter(ip_type=ip_range)
-        used_ip = Interface.objects.filter(ipv4__in=all_ip).count()
-        active_ip = all_active_assigned_interfaces_count().filter(
-            ipv4__in=IpList.objects.filter(ip_type=ip_range)
-        ).count()
-        ip_dict[ip_range] = [ip_range, ip_range.vlan, all_ip.count(),
-                             used_ip, active_ip, all_ip.count()-used_ip]
-    _all_adherent = all_adherent(including_asso=False)
-    _all_has_access = all_has_access(including_asso=False)
-    _all_baned = all_baned()
-    _all_whitelisted = all_whitelisted()
-    _all_active_interfaces_count = all_active_interfaces_count()
-    _all_active_assigned_interfaces_count = \
-        all_active_assigned_interfaces_count()
+    cotisants, activés, archivés, etc.
+    Lues dans le dernier relevé (commande refresh_stats), ou calculées à
+    la volée s'il n'y en a pas encore, avec l'historique des relevés"""
+    snapshot = StatsSnapshot.latest_snapshot()
+    if snapshot is None:
+        engine = StatsEngine()
+        date, counters = engine.now, engine.compute()
+    else:
+        date, counters = snapshot.date, snapshot.counters
+    labels = (
+        ('active_users', _("Activated users")),
+        ('inactive_users', _("Disabled users")),
+        ('archive_users', _("Archived users")),
+        ('full_archive_users', _("Full Archived users")),
+        ('not_active_users', _("Not yet active users")),
+        ('adherent_users', _("Contributing members")),
+        ('connexion_users', _("Users benefiting from a connection")),
+        ('ban_users', _("Banned users")),
+        ('whitelisted_user', _("Users benefiting from a free connection")),
+        ('actives_interfaces',
+         _("Active interfaces (with access to the network)")),
+        ('actives_assigned_interfaces', _("Active interfaces assigned IPv4")),
+    )
     stats = [
         [   # First set of data (about users)
             [   # Headers
@@ -215,90 +295,8 @@ def stats_general(request):
                 _("Number of clubs")
             ],
             {   # Data
-                'active_users': [
-                    _("Activated users"),
-                    User.objects.filter(state=User.STATE_ACTIVE).count(),
-                    (Adherent.objects
-                     .filter(state=Adherent.STATE_ACTIVE)
-                     .count()),
-                    Club.objects.filter(state=Club.STATE_ACTIVE).count()
-                ],
-                'inactive_users': [
-                    _("Disabled users"),
-                    User.objects.filter(state=User.STATE_DISABLED).count(),
-                    (Adherent.objects
-                     .filter(state=Adherent.STATE_DISABLED)
-                     .count()),
-                    Club.objects.filter(state=Club.STATE_DISABLED).count()
-                ],
-                'archive_users': [
-                    _("Archived users"),
-                    User.objects.filter(state=User.STATE_ARCHIVE).count(),
-                    (Adherent.objects
-                     .filter(state=Adherent.STATE_ARCHIVE)
-                     .count()),
-                    Club.objects.filter(state=Club.STATE_ARCHIVE).count()
-                ],
-                'full_archive_users': [
-                    _("Full Archived users"),
-                    User.objects.filter(state=User.STATE_FULL_ARCHIVE).count(),
-                    (Adherent.objects
-                     .filter(state=Adherent.STATE_FULL_ARCHIVE)
-                     .count()),
-                    Club.objects.filter(state=Club.STATE_FULL_ARCHIVE).count()
-                ],
-                'not_active_users': [
-                    _("Not yet active users"),
-                    User.objects.filter(state=User.STATE_NOT_YET_ACTIVE).count(),
-                    (Adherent.objects
-                     .filter(state=Adherent.STATE_NOT_YET_ACTIVE)
-                     .count()),
-                    Club.objects.filter(state=Club.STATE_NOT_YET_ACTIVE).count()
-                ],
-                'adherent_users': [
-                    _("Contributing members"),
-                    _all_adherent.count(),
-                    _all_adherent.exclude(adherent__isnull=True).count(),
-                    _all_adherent.exclude(club__isnull=True).count()
-                ],
-                'connexion_users': [
-                    _("Users benefiting from a connection"),
-                    _all_has_access.count(),
-                    _all_has_access.exclude(adherent__isnull=True).count(),
-                    _all_has_access.exclude(club__isnull=True).count()
-                ],
-                'ban_users': [
-                    _("Banned users"),
-                    _all_baned.count(),
-                    _all_baned.exclude(adherent__isnull=True).count(),
-                    _all_baned.exclude(club__isnull=True).count()
-                ],
-                'whitelisted_user': [
-                    _("Users benefiting from a free connection"),
-                    _all_whitelisted.count(),
-                    _all_whitelisted.exclude(adherent__isnull=True).count(),
-                    _all_whitelisted.exclude(club__isnull=True).count()
-                ],
-                'actives_interfaces': [
-                    _("Active interfaces (with access to the network)"),
-                    _all_active_interfaces_count.count(),
-                    (_all_active_interfaces_count
-                     .exclude(machine__user__adherent__isnull=True)
-                     .count()),
-                    (_all_active_interfaces_count
-                     .exclude(machine__user__club__isnull=True)
-                     .count())
-                ],
-                'actives_assigned_interfaces': [
-                    _("Active interfaces assigned IPv4"),
-                    _all_active_assigned_interfaces_count.count(),
-                    (_all_active_assigned_interfaces_count
-                     .exclude(machine__user__adherent__isnull=True)
-                     .count()),
-                    (_all_active_assigned_interfaces_count
-                     .exclude(machine__user__club__isnull=True)
-                     .count())
-                ]
+                key: [label] + counters['users'][key]
+                for key, label in labels
             }
         ],
         [   # Second set of data (about ip adresses)
@@ -310,10 +308,28 @@ def stats_general(request):
                 _("Number of IP address assigned to an activated machine"),
                 _("Number of nonassigned IP addresses")
             ],
-            ip_dict  # Data already prepared
+            dict(enumerate(counters['ip']))
         ]
     ]
-    return render(request, 'logs/stats_general.html', {'stats_list': stats})
+    history = []
+    snapshots = StatsSnapshot.objects.order_by('-date')[:STATS_HISTORY_LENGTH]
+    for old_snapshot in snapshots:
+        users = old_snapshot.counters['users']
+        history.append({
+            'date': old_snapshot.date,
+            'adherents': users['adherent_users'][0],
+            'connexion': users['connexion_users'][0],
+            'ban': users['ban_users'][0],
+            'interfaces': users['actives_interfaces'][0],
+        })
+    peak = max([entry['adherents'] for entry in history] + [1])
+    for entry in history:
+        entry['ratio'] = 100 * entry['adherents'] // peak
+    return render(request, 'logs/stats_general.html', {
+        'stats_list': stats,
+        'stats_date': date,
+        'stats_history': history,
+    })
 
 
 @login_required
@@ -503,7 +519,7 @@ def history(request, application, object_name, object_id):
             'users:profil',
             kwargs={'userid': str(request.user.id)}
         ))
-    can, msg = instance.can_view(request.user)
+    can, msg = acl_check(request.user, instance, 'can_view')
     if not can:
         messages.error(request, msg or _("You don't have the right to access this menu."))
         return redirect(reverse(
@@ -511,11 +527,17 @@ def history(request, application, object_name, object_id):
             kwargs={'userid': str(request.user.id)}
         ))
     pagination_number = GeneralOption.get_cached_value('pagination_number')
-    reversions = Version.objects.get_for_object(instance)
+    objects = [instance]
     if hasattr(instance, 'linked_objects'):
-        for related_object in chain(instance.linked_objects()):
-            reversions = (reversions |
-                          Version.objects.get_for_object(related_object))
+        objects.extend(chain(instance.linked_objects()))
+    reversions = Version.objects.get_for_object(instance)
+    for related_object in objects[1:]:
+        reversions = (reversions |
+                      Version.objects.get_for_object(related_object))
+    reversions = HistoryList(
+        reversions.select_related('revision__user'),
+        ArchivedVersion.get_for_objects(objects)
+    )
     reversions = re2o_paginator(request, reversions, pagination_number)
     return render(
         request,
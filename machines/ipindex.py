@@ -0,0 +1,132 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""machines.ipindex
+Index d'intervalles sur les plages d'ip des IpType.
+
+Les plages sont stockées sous forme de tableaux triés d'entiers (début,
+fin, et maximum des fins jusqu'à chaque position), ce qui permet de
+répondre par dichotomie, sans construire d'IPSet, aux questions :
+chevauchement, appartenance, et quel IpType possède une adresse.
+"""
+
+from __future__ import unicode_literals
+
+import time
+from bisect import bisect_right
+
+from netaddr import IPAddress, IPNetwork
+
+
+class IntervalIndex(object):
+    """Intervalles fermés [start, end] d'entiers, chacun portant une
+    valeur. Recherche en O(log n + k), k étant le nombre de résultats."""
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key=lambda item: (item[0], item[1]))
+        self.starts = [start for start, _end, _value in intervals]
+        self.ends = [end for _start, end, _value in intervals]
+        self.values = [value for _start, _end, value in intervals]
+        # Maximum des fins des intervalles 0..i, croissant : permet
+        # d'arrêter la remontée dès qu'aucun intervalle précédent ne
+        # peut plus atteindre la zone cherchée
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, start, end):
+        """Valeurs des intervalles qui recoupent [start, end]"""
+        found = []
+        index = bisect_right(self.starts, end) - 1
+        while index >= 0 and self.max_ends[index] >= start:
+            if self.ends[index] >= start:
+                found.append(self.values[index])
+            index -= 1
+        return found
+
+    def containing(self, point):
+        """Valeurs des intervalles contenant point"""
+        return self.overlapping(point, point)
+
+
+class IpTypeIndex(object):
+    """Index des plages ipv4 (start-stop) et des préfixes ipv6 des
+    IpType, dont les valeurs sont les pk des IpType"""
+
+    # Durée de vie de l'index partagé (get), les processus sans signaux
+    # (radius) voient les changements au plus tard après ce délai
+    TTL = 60
+    _shared = None
+    _built_at = 0
+
+    def __init__(self, rows):
+        """rows : (pk, ip start, ip stop, prefixe v6, longueur du prefixe)"""
+        ranges_v4 = []
+        ranges_v6 = []
+        for pk, start, stop, prefix_v6, prefix_v6_length in rows:
+            ranges_v4.append((int(IPAddress(start)), int(IPAddress(stop)), pk))
+            if prefix_v6:
+                network = IPNetwork('%s/%s' % (prefix_v6, prefix_v6_length))
+                ranges_v6.append((network.first, network.last, pk))
+        self.v4 = IntervalIndex(ranges_v4)
+        self.v6 = IntervalIndex(ranges_v6)
+
+    @classmethod
+    def build(cls):
+        """Construit l'index à partir de la base, en une requête"""
+        from .models import IpType
+        return cls(IpType.objects.values_list(
+            'pk',
+            'domaine_ip_start',
+            'domaine_ip_stop',
+            'prefix_v6',
+            'prefix_v6_length'
+        ))
+
+    @classmethod
+    def get(cls):
+        """Index partagé par le processus, reconstruit après TTL secondes
+        ou après une modification d'un IpType (cf invalidate)"""
+        if cls._shared is None or time.time() - cls._built_at > cls.TTL:
+            cls._shared = cls.build()
+            cls._built_at = time.time()
+        return cls._shared
+
+    @classmethod
+    def invalidate(cls):
+        """Oublie l'index partagé"""
+        cls._shared = None
+
+    def _tree(self, address):
+        """L'index et la valeur entière d'une adresse v4 ou v6"""
+        address = IPAddress(str(address))
+        return (self.v4 if address.version == 4 else self.v6), int(address)
+
+    def owners(self, address):
+        """Pk des IpType dont la plage (v4) ou le préfixe (v6) contient
+        l'adresse"""
+        tree, value = self._tree(address)
+        return tree.containing(value)
+
+    def owner(self, address):
+        """Pk de l'IpType possédant l'adresse, ou None"""
+        owners = self.owners(address)
+        return owners[0] if owners else None
+
+    def overlapping_v4(self, start, stop, exclude=None):
+        """Pk des IpType dont la plage ipv4 recoupe start-stop"""
+        return [
+            pk for pk in self.v4.overlapping(
+                int(IPAddress(str(start))),
+                int(IPAddress(str(stop)))
+            ) if pk != exclude
+        ]
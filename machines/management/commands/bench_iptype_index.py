@@ -0,0 +1,103 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""
+Benchmark of the IpType interval index against the netaddr IPSet checks it
+replaces, on synthetic subnets. Nothing is read from or written to the
+database.
+"""
+
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from netaddr import IPAddress, IPNetwork, IPRange, IPSet
+
+from machines.ipindex import IpTypeIndex
+
+
+class Command(BaseCommand):
+    """ The command object for `bench_iptype_index` """
+    help = "Compare the IpType interval index with IPSet overlap checks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subnets', type=int, default=500)
+        parser.add_argument('--lookups', type=int, default=10000)
+
+    def _rows(self, count):
+        """ count disjoint /24 ranges with a /64 prefix each, as returned by
+        IpTypeIndex.build """
+        rows = []
+        for pk in range(count):
+            network = IPNetwork('10.0.0.0/24').next(pk)
+            rows.append((
+                pk,
+                str(network[1]),
+                str(network[-2]),
+                '2001:db8:%x::' % pk,
+                64
+            ))
+        return rows
+
+    def handle(self, *args, **options):
+        rows = self._rows(options['subnets'])
+        random_ips = [
+            str(IPAddress(random.randint(
+                int(IPAddress('10.0.0.0')),
+                int(IPAddress('10.0.0.0')) + 256 * len(rows)
+            )))
+            for _ in range(options['lookups'])
+        ]
+
+        start = time.time()
+        index = IpTypeIndex(rows)
+        build_time = time.time() - start
+
+        # IpType.clean of every range : previously one isdisjoint against
+        # every other range, building the IPSets on the way
+        start = time.time()
+        sets = [
+            (pk, IPSet(IPRange(ip_start, ip_stop)))
+            for pk, ip_start, ip_stop, _prefix, _length in rows
+        ]
+        for pk, ip_set in sets:
+            for other_pk, other_set in sets:
+                if other_pk != pk and not ip_set.isdisjoint(other_set):
+                    raise AssertionError("overlap")
+        ipset_clean = time.time() - start
+        start = time.time()
+        for pk, ip_start, ip_stop, _prefix, _length in rows:
+            if index.overlapping_v4(ip_start, ip_stop, exclude=pk):
+                raise AssertionError("overlap")
+        index_clean = time.time() - start
+
+        # Owner of an address : linear scan of the ranges against the index
+        ranges = [(pk, IPRange(ip_start, ip_stop)) for pk, ip_start, ip_stop,
+                  _prefix, _length in rows]
+        start = time.time()
+        scan_owners = [
+            next((pk for pk, ip_range in ranges if IPAddress(ip) in ip_range),
+                 None)
+            for ip in random_ips
+        ]
+        scan_time = time.time() - start
+        start = time.time()
+        index_owners = [index.owner(ip) for ip in random_ips]
+        index_time = time.time() - start
+        if scan_owners != index_owners:
+            raise AssertionError("owner mismatch")
+
+        self.stdout.write("%d subnets, index built in %.4fs" % (
+            len(rows), build_time))
+        self.stdout.write(
+            "clean of every range: IPSet %.3fs, index %.4fs, x%.0f" % (
+                ipset_clean, index_clean,
+                ipset_clean / max(index_clean, 1e-6)))
+        self.stdout.write(
+            "%d owner lookups: scan %.3fs, index %.4fs, x%.0f" % (
+                len(random_ips), scan_time, index_time,
+                scan_time / max(index_time, 1e-6)))
@@ -0,0 +1,40 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""
+Prune the interface change journal used by the incremental DHCP export
+(see machines.models.InterfaceChange). To be run from a cron, e.g. every
+night. The clients whose cursor is older than the retention get a 410 and
+do a full export again.
+"""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from machines.models import InterfaceChange
+
+
+class Command(BaseCommand):
+    """ The command object for `prune_interface_changes` """
+    help = "Delete the interface changes older than the retention"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=InterfaceChange.RETENTION.days,
+            help="Retention of the journal, in days",
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        deleted = InterfaceChange.prune(before)
+        self.stdout.write(
+            "Deleted %d interface changes older than %s" % (deleted, before)
+        )
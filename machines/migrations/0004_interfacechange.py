@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 10:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machines', '0003_drop_view_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InterfaceChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('interface_id', models.PositiveIntegerField(db_index=True)),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'interface change',
+                'verbose_name_plural': 'interface changes',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 11:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machines', '0004_interfacechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DNSZoneCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zone_type', models.CharField(choices=[('forward', 'Forward zone'), ('reverse', 'Reverse zone')], max_length=16)),
+                ('zone_id', models.PositiveIntegerField()),
+                ('serial', models.PositiveIntegerField(default=0)),
+                ('data', models.TextField(blank=True)),
+                ('checksum', models.CharField(blank=True, max_length=40)),
+                ('dirty', models.BooleanField(default=True)),
+                ('rendered_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'DNS zone cache',
+                'verbose_name_plural': 'DNS zone caches',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='dnszonecache',
+            unique_together=set([('zone_type', 'zone_id')]),
+        ),
+    ]
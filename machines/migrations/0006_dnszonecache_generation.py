@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-19 09:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('machines', '0005_dnszonecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dnszonecache',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
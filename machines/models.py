@@ -14,16 +14,22 @@ from __future__ import unicode_literals
 
 import base64
 import hashlib
+import json
 import re
-from datetime import timedelta
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from ipaddress import IPv6Address
-from itertools import chain
+from itertools import chain, islice
 
+from django.core.cache import cache
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import Q
-from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
+from django.db import models, connection
+from django.db.models import F, Q, Case, When
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver, Signal
 from django.forms import ValidationError
 from django.utils import timezone
 from django.db import transaction
@@ -35,9 +41,12 @@ from netaddr import mac_bare, EUI, NotRegisteredError, IPSet, IPRange, IPNetwork
 
 import preferences.models
 import users.models
+from re2o.acl import acl_check
 from re2o.field_permissions import FieldPermissionModelMixin
 from re2o.mixins import AclMixin, RevMixin
 
+from .ipindex import IpTypeIndex
+
 
 class Machine(RevMixin, FieldPermissionModelMixin, models.Model):
     """ Class définissant une machine, object parent user, objets fils
@@ -185,6 +194,12 @@ class Machine(RevMixin, FieldPermissionModelMixin, models.Model):
                             " than yours.")
         return True, None
 
+    @staticmethod
+    def filter_viewable(user_request, queryset):
+        """Restreint queryset aux machines que user_request peut voir sans
+        le droit view : les siennes"""
+        return queryset.filter(user=user_request)
+
     @cached_property
     def short_name(self):
         """Par defaut, renvoie le nom de la première interface
@@ -217,6 +232,9 @@ class Machine(RevMixin, FieldPermissionModelMixin, models.Model):
     @classmethod
     def mass_delete(cls, machine_queryset):
         """Mass delete for machine queryset"""
+        InterfaceChange.log(Interface.objects.filter(
+            machine__in=machine_queryset
+        ).values_list('pk', flat=True))
         Domain.objects.filter(cname__interface_parent__machine__in=machine_queryset)._raw_delete(machine_queryset.db)
         Domain.objects.filter(interface_parent__machine__in=machine_queryset)._raw_delete(machine_queryset.db)
         Ipv6List.objects.filter(interface__machine__in=machine_queryset)._raw_delete(machine_queryset.db)
@@ -263,6 +281,11 @@ class MachineType(RevMixin, AclMixin, models.Model):
         verbose_name = _("machine type")
         verbose_name_plural = _("machine types")
 
+    def __init__(self, *args, **kwargs):
+        super(MachineType, self).__init__(*args, **kwargs)
+        # Type d'ip lu en base, pour invalider l'ancienne zone inverse
+        self._original_ip_type_id = self.__dict__.get('ip_type_id')
+
     def all_interfaces(self):
         """ Renvoie toutes les interfaces (cartes réseaux) de type
         machinetype"""
@@ -451,21 +474,44 @@ class IpType(RevMixin, AclMixin, models.Model):
             interface__isnull=True
         ).filter(ip_type=self)
 
-    def gen_ip_range(self):
-        """ Cree les IpList associées au type self. Parcours pédestrement et
-        crée les ip une par une. Si elles existent déjà, met à jour le type
-        associé à l'ip"""
-        # Creation du range d'ip dans les objets iplist
-        ip_obj = [IpList(ip_type=self, ipv4=str(ip)) for ip in self.ip_range]
-        listes_ip = IpList.objects.filter(
-            ipv4__in=[str(ip) for ip in self.ip_range]
-        )
-        # Si il n'y a pas d'ip, on les crée
-        if not listes_ip:
-            IpList.objects.bulk_create(ip_obj)
-        # Sinon on update l'ip_type
-        else:
-            listes_ip.update(ip_type=self)
+    def allocate_free_ips(self, count):
+        """ Réserve jusqu'à count ip libres du type. Dans une transaction,
+        les lignes sont verrouillées (SKIP LOCKED si la base le permet)
+        pour que deux allocations concurrentes ne se marchent pas dessus :
+        l'appelant doit enregistrer les interfaces dans la même transaction.
+        En autocommit, le verrou serait relâché aussitôt (et refusé par
+        PostgreSQL), il n'est donc pas pris. Pas de jointure externe ici :
+        FOR UPDATE ne la supporte pas."""
+        free_ips = (IpList.objects
+                    .filter(ip_type=self)
+                    .exclude(pk__in=Interface.objects
+                             .filter(ipv4__isnull=False)
+                             .values('ipv4'))
+                    .order_by('pk'))
+        if connection.in_atomic_block:
+            if connection.features.has_select_for_update_skip_locked:
+                free_ips = free_ips.select_for_update(skip_locked=True)
+            elif connection.features.has_select_for_update:
+                free_ips = free_ips.select_for_update()
+        return list(free_ips[:count])
+
+    def gen_ip_range(self, chunk_size=1024):
+        """ Cree les IpList associées au type self, par paquets de
+        chunk_size adresses : les ip existantes sont rattachées à self en
+        une requête, les manquantes sont créées en bulk"""
+        ip_range = iter(self.ip_range)
+        with transaction.atomic():
+            while True:
+                chunk = [str(ip) for ip in islice(ip_range, chunk_size)]
+                if not chunk:
+                    break
+                listes_ip = IpList.objects.filter(ipv4__in=chunk)
+                listes_ip.exclude(ip_type=self).update(ip_type=self)
+                existing = set(listes_ip.values_list('ipv4', flat=True))
+                IpList.objects.bulk_create([
+                    IpList(ip_type=self, ipv4=ip)
+                    for ip in chunk if ip not in existing
+                ])
         return
 
     def del_ip_range(self):
@@ -520,10 +566,13 @@ class IpType(RevMixin, AclMixin, models.Model):
             raise ValidationError(_("The range is too large, you can't create"
                                     " a larger one than a /16."))
         # On check que les / ne se recoupent pas
-        for element in IpType.objects.all().exclude(pk=self.pk):
-            if not self.ip_set.isdisjoint(element.ip_set):
-                raise ValidationError(_("The specified range is not disjoint"
-                                        " from existing ranges."))
+        if IpTypeIndex.build().overlapping_v4(
+                self.domaine_ip_start,
+                self.domaine_ip_stop,
+                exclude=self.pk
+        ):
+            raise ValidationError(_("The specified range is not disjoint"
+                                    " from existing ranges."))
         # On formate le prefix v6
         if self.prefix_v6:
             self.prefix_v6 = str(IPNetwork(self.prefix_v6 + '/64').network)
@@ -1233,8 +1282,10 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
             raise ValidationError(_("The given MAC address is invalid."))
 
     def assign_ipv4(self):
-        """ Assigne une ip à l'interface """
-        free_ips = self.machine_type.ip_type.free_ip()
+        """ Assigne une ip à l'interface. Pour que l'ip reste réservée
+        jusqu'à l'enregistrement, appeler dans une transaction qui
+        enregistre aussi l'interface """
+        free_ips = self.machine_type.ip_type.allocate_free_ips(1)
         if free_ips:
             self.ipv4 = free_ips[0]
         else:
@@ -1250,16 +1301,51 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
     def mass_unassign_ipv4(cls, interface_list):
         """Unassign ipv4 to multiple interfaces"""
         with transaction.atomic(), reversion.create_revision():
+            InterfaceChange.log(interface_list.values_list('pk', flat=True))
             interface_list.update(ipv4=None)
             reversion.set_comment(_("IPv4 unassigning"))
 
     @classmethod
-    def mass_assign_ipv4(cls, interface_list):
-        for interface in interface_list:
-            with transaction.atomic(), reversion.create_revision():
-                interface.assign_ipv4()
-                interface.save()
-                reversion.set_comment(_("IPv4 assigning"))
+    def mass_assign_ipv4(cls, interface_list, chunk_size=500):
+        """Assign an ipv4 to every interface of the list which has none.
+        Free addresses are reserved in one query per ip type and written
+        with one UPDATE per chunk, in a single revision"""
+        with transaction.atomic(), reversion.create_revision():
+            interfaces = list(
+                interface_list.filter(ipv4__isnull=True)
+                .select_related('machine_type__ip_type')
+            )
+            by_ip_type = {}
+            for interface in interfaces:
+                by_ip_type.setdefault(
+                    interface.machine_type.ip_type, []
+                ).append(interface)
+            for ip_type, group in by_ip_type.items():
+                free_ips = ip_type.allocate_free_ips(len(group))
+                if len(free_ips) < len(group):
+                    raise ValidationError(_("There is no IP address available"
+                                            " in the slash."))
+                for interface, ipv4 in zip(group, free_ips):
+                    interface.ipv4 = ipv4
+            for start in range(0, len(interfaces), chunk_size):
+                chunk = interfaces[start:start + chunk_size]
+                cls.objects.filter(pk__in=[i.pk for i in chunk]).update(
+                    ipv4=Case(
+                        *[
+                            When(pk=interface.pk, then=interface.ipv4.pk)
+                            for interface in chunk
+                        ],
+                        output_field=models.IntegerField()
+                    )
+                )
+            if reversion.is_registered(cls):
+                for interface in interfaces:
+                    reversion.add_to_revision(interface)
+            reversion.set_comment(_("IPv4 assigning"))
+            InterfaceChange.log([interface.pk for interface in interfaces])
+        if interfaces:
+            regen('dhcp')
+            regen('mac_ip_list')
 
     def update_type(self):
         """ Lorsque le machinetype est changé de type d'ip, on réassigne"""
@@ -1356,8 +1442,10 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         :return: soit True, soit False avec la raison de l'échec"""
         if self.machine.user != user_request:
             if (not user_request.has_perm('machines.change_interface') or
-                    not self.machine.user.can_edit(
+                    not acl_check(
                         user_request,
+                        self.machine.user,
+                        'can_edit',
                         *args,
                         **kwargs
                     )[0]):
@@ -1373,8 +1461,10 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         :return: soit True, soit False avec la raison de l'échec"""
         if self.machine.user != user_request:
             if (not user_request.has_perm('machines.change_interface') or
-                    not self.machine.user.can_edit(
+                    not acl_check(
                         user_request,
+                        self.machine.user,
+                        'can_edit',
                         *args,
                         **kwargs
                     )[0]):
@@ -1399,6 +1489,8 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         self.field_permissions = {
             'machine': self.can_change_machine,
         }
+        # Type de machine lu en base, pour invalider les anciennes zones
+        self._original_machine_type_id = self.__dict__.get('machine_type_id')
 
     def __str__(self):
         try:
@@ -1408,6 +1500,89 @@ class Interface(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         return str(domain)
 
 
+#: Envoyé avec la liste des ids d'interfaces modifiées, y compris par les
+#: opérations de masse qui ne déclenchent pas post_save
+interfaces_changed = Signal(providing_args=['interface_ids'])
+
+
+class InterfaceChange(models.Model):
+    """ Journal des interfaces ajoutées, modifiées ou supprimées (ou dont
+    l'accès du propriétaire a changé). Sert à l'export DHCP incrémental :
+    un client passe l'id de la dernière entrée vue et ne reçoit que les
+    interfaces touchées depuis.
+
+    Les ids sont attribués à l'insertion, pas à la validation : une
+    transaction peut obtenir un id inférieur au curseur lu par un client
+    et n'être visible qu'après. Les entrées écrites moins de LAG avant
+    celle du curseur sont donc relues ; renvoyer deux fois une interface
+    est sans effet pour le client. Le journal est purgé au delà de
+    RETENTION (cf la commande prune_interface_changes)."""
+
+    LAG = timedelta(minutes=1)
+    RETENTION = timedelta(days=7)
+
+    interface_id = models.PositiveIntegerField(db_index=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("interface change")
+        verbose_name_plural = _("interface changes")
+
+    @classmethod
+    def log(cls, interface_ids):
+        """ Enregistre une modification pour chaque interface, et marque
+        leurs zones dns comme à reconstruire """
+        interface_ids = set(interface_ids)
+        cls.objects.bulk_create(
+            [cls(interface_id=pk) for pk in interface_ids]
+        )
+        DNSZoneCache.invalidate_interfaces(interface_ids)
+        interfaces_changed.send(sender=cls, interface_ids=interface_ids)
+
+    @classmethod
+    def cursor_date(cls, cursor):
+        """ Date de l'entrée du curseur (la dernière d'id inférieur ou
+        égal), ou None si elle a été purgée. Le curseur 0 (journal vide
+        lors de l'export) date de l'origine """
+        date = cls.objects.filter(pk__lte=cursor).order_by(
+            '-pk').values_list('date', flat=True).first()
+        if date is None and not cursor:
+            return datetime.fromtimestamp(0, timezone.utc)
+        return date
+
+    @classmethod
+    def changed_since(cls, date, cursor=None):
+        """ Renvoie les ids des interfaces modifiées après l'entrée d'id
+        cursor, ou après date (celle de cursor s'il est donné), avec une
+        marge de LAG """
+        condition = Q(date__gt=date - cls.LAG)
+        if cursor is not None:
+            condition |= Q(pk__gt=cursor)
+        return set(cls.objects.filter(condition).values_list(
+            'interface_id', flat=True))
+
+    @classmethod
+    def last_cursor(cls):
+        """ Id de la dernière entrée du journal """
+        return cls.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0
+
+    @classmethod
+    def prune(cls, before=None):
+        """ Supprime les entrées antérieures à before (par défaut, plus
+        vieilles que RETENTION), sauf la dernière qui date le curseur
+        courant. Renvoie le nombre d'entrées supprimées """
+        if before is None:
+            before = timezone.now() - cls.RETENTION
+        deleted, _rows = cls.objects.filter(date__lt=before).exclude(
+            pk=cls.last_cursor()
+        ).delete()
+        return deleted
+
+    def __str__(self):
+        return str(self.interface_id) + ' ' + str(self.date)
+
+
 class Ipv6List(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
     """ A list of IPv6 """
 
@@ -1461,8 +1636,10 @@ class Ipv6List(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         :return: soit True, soit False avec la raison de l'échec"""
         if self.interface.machine.user != user_request:
             if (not user_request.has_perm('machines.change_ipv6list') or
-                    not self.interface.machine.user.can_edit(
+                    not acl_check(
                         user_request,
+                        self.interface.machine.user,
+                        'can_edit',
                         *args,
                         **kwargs
                     )[0]):
@@ -1478,8 +1655,10 @@ class Ipv6List(RevMixin, AclMixin, FieldPermissionModelMixin, models.Model):
         :return: soit True, soit False avec la raison de l'échec"""
         if self.interface.machine.user != user_request:
             if (not user_request.has_perm('machines.change_ipv6list') or
-                    not self.interface.machine.user.can_edit(
+                    not acl_check(
                         user_request,
+                        self.interface.machine.user,
+                        'can_edit',
                         *args,
                         **kwargs
                     )[0]):
@@ -1572,6 +1751,11 @@ class Domain(RevMixin, AclMixin, models.Model):
         verbose_name = _("domain")
         verbose_name_plural = _("domains")
 
+    def __init__(self, *args, **kwargs):
+        super(Domain, self).__init__(*args, **kwargs)
+        # Extension lue en base, pour invalider l'ancienne zone directe
+        self._original_extension_id = self.__dict__.get('extension_id')
+
     def get_extension(self):
         """ Retourne l'extension de l'interface parente si c'est un A
          Retourne l'extension propre si c'est un cname, renvoie None sinon"""
@@ -1728,7 +1912,7 @@ class IpList(RevMixin, AclMixin, models.Model):
 
     def clean(self):
         """ Erreur si l'ip_type est incorrect"""
-        if not str(self.ipv4) in self.ip_type.ip_set_as_str:
+        if IPAddress(str(self.ipv4)) not in self.ip_type.ip_range:
             raise ValidationError(_("The IPv4 address and the range of the IP"
                                     " type don't match."))
         return
@@ -1853,12 +2037,117 @@ class Service(RevMixin, AclMixin, models.Model):
         return str(self.service_type)
 
 
+class _RegenFlush(object):
+    """ Le callback on_commit du flush. Django ne garde une référence aux
+    callbacks que jusqu'au commit ou à l'annulation de leur transaction :
+    une référence faible dessus dit si le flush est encore prévu """
+
+    def __init__(self, coalescer):
+        self.coalescer = coalescer
+
+    def __call__(self):
+        self.coalescer.flush()
+
+
+class RegenCoalescer(threading.local):
+    """ Regroupe les demandes de régénération d'un thread : dans une
+    transaction (la requête web entière avec RevisionMiddleware) ou un bloc
+    `coalesce_regen`, les services demandés sont collectés et marqués en
+    une seule requête au commit. Les compteurs sont globaux au processus."""
+
+    stats = {'requested': 0, 'flushed': 0, 'collapsed': 0}
+    stats_lock = threading.Lock()
+
+    def __init__(self):
+        self.pending = set()
+        self.depth = 0
+        # Le flush prévu au commit de la transaction en cours, s'il y en a
+        self.scheduled = None
+
+    @classmethod
+    def count(cls, **counters):
+        """ Incrémente les compteurs """
+        with cls.stats_lock:
+            for name, value in counters.items():
+                cls.stats[name] += value
+
+    def _forget_rolled_back(self):
+        """ Un flush prévu puis oublié par Django sans avoir été exécuté :
+        sa transaction a été annulée, ses demandes avec elle """
+        if self.scheduled is not None and self.scheduled() is None:
+            self.scheduled = None
+            self.pending = set()
+
+    def schedule(self):
+        """ Prévoit le flush au commit de la transaction en cours, une
+        seule fois par transaction """
+        self._forget_rolled_back()
+        if self.scheduled is None:
+            callback = _RegenFlush(self)
+            self.scheduled = weakref.ref(callback)
+            transaction.on_commit(callback)
+
+    def request(self, service):
+        """ Demande la régénération d'un service """
+        in_atomic_block = transaction.get_connection().in_atomic_block
+        if not self.depth:
+            if in_atomic_block:
+                self.schedule()
+            else:
+                self._forget_rolled_back()
+        if service in self.pending:
+            self.count(requested=1, collapsed=1)
+            return
+        self.count(requested=1)
+        self.pending.add(service)
+        if not self.depth and not in_atomic_block:
+            self.flush()
+
+    def flush(self):
+        """ Marque en une requête tous les services en attente """
+        services, self.pending = self.pending, set()
+        self.scheduled = None
+        if not services:
+            return
+        Service_link.objects.filter(
+            service__service_type__in=services
+        ).exclude(asked_regen=True).update(asked_regen=True)
+        self.count(flushed=len(services))
+
+
+regen_coalescer = RegenCoalescer()
+
+
+@contextmanager
+def coalesce_regen():
+    """ Regroupe les régénérations demandées dans le bloc (commande de
+    gestion, opération de masse) et les envoie à la sortie """
+    if not regen_coalescer.depth:
+        regen_coalescer._forget_rolled_back()
+    regen_coalescer.depth += 1
+    try:
+        yield regen_coalescer
+    finally:
+        regen_coalescer.depth -= 1
+        if not regen_coalescer.depth:
+            if transaction.get_connection().in_atomic_block:
+                regen_coalescer.schedule()
+            else:
+                regen_coalescer.flush()
+
+
+def regen_stats():
+    """ Compteurs des demandes de régénération : reçues, réellement
+    envoyées et fusionnées """
+    with RegenCoalescer.stats_lock:
+        return dict(RegenCoalescer.stats)
+
+
 def regen(service):
-    """ Fonction externe pour régérération d'un service, prend un objet service
-    en arg"""
-    obj = Service.objects.filter(service_type=service)
-    if obj:
-        obj[0].ask_regen()
+    """ Fonction externe pour régérération d'un service, prend le nom du
+    service en arg. La demande est regroupée avec les autres demandes de
+    la transaction en cours"""
+    regen_coalescer.request(service)
     return
 
 
@@ -2028,12 +2317,303 @@ class OuverturePort(RevMixin, AclMixin, models.Model):
         return '{} ({} {})'.format(self, protocole, in_out)
 
 
+def merge_port_ranges(ranges):
+    """Fusionne des plages de ports (begin, end) qui se chevauchent ou se
+    suivent, et renvoie les intervalles minimaux triés"""
+    merged = []
+    for begin, end in sorted(ranges):
+        if merged and begin <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([begin, end])
+    return [
+        str(begin) if begin == end else '%d:%d' % (begin, end)
+        for begin, end in merged
+    ]
+
+
+class FirewallPolicy(object):
+    """Politique d'ouverture de ports : ip -> {tcp_in, tcp_out, udp_in,
+    udp_out}, pour les interfaces actives ayant un profil de ports.
+
+    Compilée en un nombre constant de requêtes et gardée en cache. Le cache
+    est valide tant que le journal InterfaceChange n'a pas bougé (les
+    modifications de ports, de profils et d'ipv6 y sont journalisées) et
+    jusqu'à la prochaine fin d'accès d'un des users concernés."""
+
+    CACHE_KEY = 'firewall_policy'
+    DIRECTIONS = {
+        (OuverturePort.TCP, OuverturePort.IN): 'tcp_in',
+        (OuverturePort.TCP, OuverturePort.OUT): 'tcp_out',
+        (OuverturePort.UDP, OuverturePort.IN): 'udp_in',
+        (OuverturePort.UDP, OuverturePort.OUT): 'udp_out',
+    }
+    # Durée maximale du cache, pour les changements de préférences
+    TIMEOUT = 3600
+
+    @classmethod
+    def _interfaces(cls):
+        """Les interfaces actives avec un profil de ports"""
+        from re2o.utils import all_has_access
+        return Interface.objects.filter(
+            port_lists__isnull=False,
+            machine__active=True,
+            machine__user__in=all_has_access()
+        )
+
+    @classmethod
+    def _valid_until(cls, now):
+        """Prochain début ou fin d'une période de connexion, de ban ou de
+        whitelist d'un user ayant une interface avec un profil de ports"""
+        ends = users.models.UserAccessState.objects.filter(
+            user__machine__interface__port_lists__isnull=False
+        ).aggregate(**{
+            'next_' + field: models.Min(Case(When(
+                **{field + '__gt': now, 'then': field}
+            )))
+            for field in users.models.UserAccessState.DATE_FIELDS
+            if not field.endswith('adhesion')
+        })
+        return min(
+            [end for end in ends.values() if end is not None] +
+            [now + timedelta(seconds=cls.TIMEOUT)]
+        )
+
+    @classmethod
+    def compile(cls):
+        """Construit la politique : une requête pour les ports, une pour
+        les interfaces et leurs profils, une pour les ipv6"""
+        ports = {}
+        for port_list, protocole, io, begin, end in (
+                OuverturePort.objects.values_list(
+                    'port_list', 'protocole', 'io', 'begin', 'end')):
+            ports.setdefault(port_list, {}).setdefault(
+                cls.DIRECTIONS[(protocole, io)], []
+            ).append((begin, end))
+
+        interface_lists = {}
+        ipv4s = {}
+        for interface, ipv4, port_list in cls._interfaces().values_list(
+                'pk', 'ipv4__ipv4', 'port_lists'):
+            interface_lists.setdefault(interface, set()).add(port_list)
+            if ipv4 and not IPAddress(ipv4).is_private():
+                ipv4s[interface] = ipv4
+
+        ipv6s = {}
+        ipv6_mode = preferences.models.OptionalMachine.get_cached_value(
+            'ipv6_mode')
+        if ipv6_mode in ('SLAAC', 'DHCPV6'):
+            ipv6_list = Ipv6List.objects.filter(
+                interface__in=cls._interfaces()
+            )
+            if ipv6_mode == 'DHCPV6':
+                ipv6_list = ipv6_list.filter(slaac_ip=False)
+            for interface, ipv6 in ipv6_list.values_list('interface', 'ipv6'):
+                ipv6s.setdefault(interface, []).append(ipv6)
+
+        ranges = {'ipv4': {}, 'ipv6': {}}
+        for interface, port_lists in interface_lists.items():
+            addresses = [('ipv6', ipv6) for ipv6 in ipv6s.get(interface, [])]
+            if interface in ipv4s:
+                addresses.append(('ipv4', ipv4s[interface]))
+            for family, address in addresses:
+                policy = ranges[family].setdefault(address, {
+                    direction: [] for direction in cls.DIRECTIONS.values()
+                })
+                for port_list in port_lists:
+                    for direction, port_ranges in (
+                            ports.get(port_list, {}).items()):
+                        policy[direction] += port_ranges
+        return {
+            family: {
+                address: {
+                    direction: merge_port_ranges(port_ranges)
+                    for direction, port_ranges in policy.items()
+                }
+                for address, policy in addresses.items()
+            }
+            for family, addresses in ranges.items()
+        }
+
+    @classmethod
+    def get(cls):
+        """Renvoie la politique, depuis le cache s'il est encore valide"""
+        now = timezone.now()
+        cursor = InterfaceChange.last_cursor()
+        cached = cache.get(cls.CACHE_KEY)
+        if cached and cached['cursor'] == cursor \
+                and cached['valid_until'] > now:
+            return cached['policy']
+        policy = cls.compile()
+        valid_until = cls._valid_until(now)
+        cache.set(
+            cls.CACHE_KEY,
+            {'cursor': cursor, 'valid_until': valid_until, 'policy': policy},
+            cls.TIMEOUT
+        )
+        return policy
+
+    @classmethod
+    def invalidate(cls):
+        """Vide le cache"""
+        cache.delete(cls.CACHE_KEY)
+
+
+class DNSZoneCache(models.Model):
+    """Zone DNS pré-rendue (directe pour une Extension, inverse pour un
+    IpType), servie telle quelle par l'API tant qu'elle n'est pas marquée
+    comme sale par les signaux. Chaque reconstruction qui change le
+    contenu incrémente le serial de la zone."""
+
+    FORWARD = 'forward'
+    REVERSE = 'reverse'
+    ZONE_TYPES = (
+        (FORWARD, _("Forward zone")),
+        (REVERSE, _("Reverse zone")),
+    )
+
+    zone_type = models.CharField(max_length=16, choices=ZONE_TYPES)
+    zone_id = models.PositiveIntegerField()
+    serial = models.PositiveIntegerField(default=0)
+    data = models.TextField(blank=True)
+    checksum = models.CharField(max_length=40, blank=True)
+    dirty = models.BooleanField(default=True)
+    # Incrémenté à chaque invalidation, cf update
+    generation = models.PositiveIntegerField(default=0)
+    rendered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (("zone_type", "zone_id"),)
+        verbose_name = _("DNS zone cache")
+        verbose_name_plural = _("DNS zone caches")
+
+    @classmethod
+    def invalidate(cls, zone_type, zone_ids):
+        """Marque les zones comme à reconstruire"""
+        zone_ids = set(zone_id for zone_id in zone_ids if zone_id)
+        if zone_ids:
+            cls.objects.filter(
+                zone_type=zone_type,
+                zone_id__in=zone_ids
+            ).update(dirty=True, generation=F('generation') + 1)
+
+    @classmethod
+    def invalidate_interfaces(cls, interfaces):
+        """Marque les zones directes et inverses d'un ensemble
+        d'interfaces (queryset ou liste d'ids)"""
+        zones = Interface.objects.filter(pk__in=interfaces).values_list(
+            'machine_type__ip_type',
+            'machine_type__ip_type__extension'
+        )
+        ip_types = set()
+        extensions = set()
+        for ip_type, extension in zones:
+            ip_types.add(ip_type)
+            extensions.add(extension)
+        cls.invalidate(cls.REVERSE, ip_types)
+        cls.invalidate(cls.FORWARD, extensions)
+
+    @classmethod
+    def invalidate_ip_types(cls, ip_types):
+        """Marque les zones inverses d'ip types et les zones directes de
+        leurs extensions"""
+        ip_types = set(ip_type for ip_type in ip_types if ip_type)
+        cls.invalidate(cls.REVERSE, ip_types)
+        cls.invalidate(cls.FORWARD, IpType.objects.filter(
+            pk__in=ip_types
+        ).values_list('extension', flat=True))
+
+    @classmethod
+    def invalidate_extensions(cls, extensions):
+        """Marque des extensions et les zones inverses qui en dépendent"""
+        extensions = set(extension for extension in extensions if extension)
+        cls.invalidate(cls.FORWARD, extensions)
+        cls.invalidate(cls.REVERSE, IpType.objects.filter(
+            extension__in=extensions
+        ).values_list('pk', flat=True))
+
+    @classmethod
+    def invalidate_expired(cls):
+        """Les adhésions, bans et whitelists qui ont commencé ou expiré
+        depuis le dernier rendu ne déclenchent aucun signal : on marque les
+        zones des interfaces des users concernés"""
+        since = cls.objects.filter(dirty=False).aggregate(
+            models.Min('rendered_at'))['rendered_at__min']
+        if since is None:
+            return
+        now = timezone.now()
+        expired = users.models.User.objects.filter(
+            users.models.UserAccessState.bounds_between_q(since, now)
+        )
+        cls.invalidate_interfaces(Interface.objects.filter(
+            machine__user__in=expired
+        ).values_list('pk', flat=True))
+
+    @classmethod
+    def get_zones(cls, zone_type, zone_ids):
+        """Les caches des zones, par id, en créant ceux qui manquent (sales,
+        donc rendus à la demande). get_or_create relit la ligne si un
+        autre processus l'a créée entre temps"""
+        caches = {
+            cache.zone_id: cache for cache in
+            cls.objects.filter(zone_type=zone_type, zone_id__in=zone_ids)
+        }
+        for zone_id in set(zone_ids) - set(caches):
+            caches[zone_id], _created = cls.objects.get_or_create(
+                zone_type=zone_type,
+                zone_id=zone_id
+            )
+        return caches
+
+    def update(self, data):
+        """Enregistre le rendu de la zone. Le serial n'est incrémenté que
+        si le contenu a changé ; il est reporté dans le SOA rendu.
+        La zone n'est marquée propre que si elle n'a pas été invalidée
+        depuis la lecture de cette instance (generation inchangée) : une
+        invalidation validée pendant le rendu la laisse sale."""
+        content = json.dumps(data, sort_keys=True, default=str)
+        checksum = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        if checksum != self.checksum:
+            self.serial = max(self.serial + 1, int(time.time()))
+            self.checksum = checksum
+            if isinstance(data.get('soa'), dict):
+                data['soa']['serial'] = self.serial
+            self.data = json.dumps(data, default=str)
+        self.rendered_at = timezone.now()
+        zones = DNSZoneCache.objects.filter(pk=self.pk)
+        zones.update(
+            serial=self.serial,
+            checksum=self.checksum,
+            data=self.data,
+            rendered_at=self.rendered_at
+        )
+        self.dirty = not zones.filter(
+            generation=self.generation
+        ).update(dirty=False)
+
+    def get_data(self):
+        """Le rendu de la zone, désérialisé"""
+        return json.loads(self.data)
+
+    @property
+    def etag(self):
+        """ETag de la zone, qui change avec le serial"""
+        return '"%s-%s-%s"' % (self.zone_type, self.zone_id, self.serial)
+
+    def __str__(self):
+        return "%s %s (%s)" % (self.zone_type, self.zone_id, self.serial)
+
+
 @receiver(post_save, sender=Machine)
 def machine_post_save(**kwargs):
     """Synchronisation ldap et régen parefeu/dhcp lors de la modification
     d'une machine"""
-    user = kwargs['instance'].user
-    user.ldap_sync(base=False, access_refresh=False, mac_refresh=True)
+    machine = kwargs['instance']
+    InterfaceChange.log(
+        machine.interface_set.values_list('pk', flat=True)
+    )
+    user = machine.user
+    user.ldap_sync_later(base=False, access_refresh=False, mac_refresh=True)
     regen('dhcp')
     regen('mac_ip_list')
 
@@ -2044,7 +2624,7 @@ def machine_post_delete(**kwargs):
     d'une machine"""
     machine = kwargs['instance']
     user = machine.user
-    user.ldap_sync(base=False, access_refresh=False, mac_refresh=True)
+    user.ldap_sync_later(base=False, access_refresh=False, mac_refresh=True)
     regen('dhcp')
     regen('mac_ip_list')
 
@@ -2055,8 +2635,16 @@ def interface_post_save(**kwargs):
     d'une interface"""
     interface = kwargs['instance']
     interface.sync_ipv6()
+    InterfaceChange.log([interface.pk])
+    # Les zones de l'ancien type gardent sinon l'interface
+    if interface._original_machine_type_id not in (
+            None, interface.machine_type_id):
+        DNSZoneCache.invalidate_ip_types(MachineType.objects.filter(
+            pk=interface._original_machine_type_id
+        ).values_list('ip_type', flat=True))
+    interface._original_machine_type_id = interface.machine_type_id
     user = interface.machine.user
-    user.ldap_sync(base=False, access_refresh=False, mac_refresh=True)
+    user.ldap_sync_later(base=False, access_refresh=False, mac_refresh=True)
     # Regen services
     regen('dhcp')
     regen('mac_ip_list')
@@ -2067,8 +2655,13 @@ def interface_post_delete(**kwargs):
     """Synchronisation ldap et régen parefeu/dhcp lors de la suppression
     d'une interface"""
     interface = kwargs['instance']
+    InterfaceChange.log([interface.pk])
+    DNSZoneCache.invalidate(
+        DNSZoneCache.REVERSE,
+        [interface.machine_type.ip_type_id]
+    )
     user = interface.machine.user
-    user.ldap_sync(base=False, access_refresh=False, mac_refresh=True)
+    user.ldap_sync_later(base=False, access_refresh=False, mac_refresh=True)
 
 
 @receiver(post_save, sender=IpType)
@@ -2084,10 +2677,22 @@ def machinetype_post_save(**kwargs):
     """Mise à jour des interfaces lorsque changement d'attribution
     d'une machinetype (changement iptype parent)"""
     machinetype = kwargs['instance']
+    if machinetype._original_ip_type_id != machinetype.ip_type_id:
+        DNSZoneCache.invalidate_ip_types([machinetype._original_ip_type_id])
+    machinetype._original_ip_type_id = machinetype.ip_type_id
     for interface in machinetype.all_interfaces():
         interface.update_type()
 
 
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+def domain_changed(**kwargs):
+    """Le nom d'hôte d'une interface a changé, on le note pour le dhcp"""
+    domain = kwargs['instance']
+    if domain.interface_parent_id:
+        InterfaceChange.log([domain.interface_parent_id])
+
+
 @receiver(post_save, sender=Domain)
 @receiver(post_delete, sender=Domain)
 @receiver(post_save, sender=Extension)
@@ -2104,6 +2709,93 @@ def machinetype_post_save(**kwargs):
 @receiver(post_delete, sender=DName)
 @receiver(post_save, sender=Srv)
 @receiver(post_delete, sender=Srv)
-def regen_dns_receiver(**_kwargs):
-    """Regen DNS when configuration changes"""
+def regen_dns_receiver(**kwargs):
+    """Regen DNS when configuration changes, and mark the cached zones
+    depending on the changed object as dirty"""
+    instance = kwargs['instance']
+    if isinstance(instance, Domain):
+        # L'ancienne extension garde sinon le nom
+        extensions = [instance.extension_id, instance._original_extension_id]
+        instance._original_extension_id = instance.extension_id
+        extensions += list(instance.related_domain.values_list(
+            'extension', flat=True))
+        extensions += list(Mx.objects.filter(name=instance).values_list(
+            'zone', flat=True))
+        extensions += list(Ns.objects.filter(ns=instance).values_list(
+            'zone', flat=True))
+        extensions += list(Srv.objects.filter(target=instance).values_list(
+            'extension', flat=True))
+        DNSZoneCache.invalidate_extensions(extensions)
+        if instance.interface_parent_id:
+            DNSZoneCache.invalidate_interfaces([instance.interface_parent_id])
+    elif isinstance(instance, Extension):
+        DNSZoneCache.invalidate_extensions([instance.pk])
+    elif isinstance(instance, SOA):
+        DNSZoneCache.invalidate_extensions(
+            Extension.objects.filter(soa=instance).values_list(
+                'pk', flat=True)
+        )
+    elif isinstance(instance, Srv):
+        DNSZoneCache.invalidate_extensions([instance.extension_id])
+    else:
+        DNSZoneCache.invalidate_extensions([instance.zone_id])
     regen('dns')
+
+
+@receiver(post_save, sender=Ipv6List)
+@receiver(post_delete, sender=Ipv6List)
+@receiver(post_save, sender=SshFp)
+@receiver(post_delete, sender=SshFp)
+def dns_interface_records_changed(**kwargs):
+    """Mark the zones of the interfaces whose AAAA or SSHFP records
+    changed as dirty"""
+    instance = kwargs['instance']
+    if isinstance(instance, Ipv6List):
+        # Journalisée : change aussi la politique de pare-feu
+        InterfaceChange.log([instance.interface_id])
+    else:
+        DNSZoneCache.invalidate_interfaces(
+            Interface.objects.filter(machine=instance.machine_id)
+            .values_list('pk', flat=True)
+        )
+
+
+@receiver(post_save, sender=OuverturePort)
+@receiver(post_delete, sender=OuverturePort)
+def ouverture_port_changed(**kwargs):
+    """Journalise les interfaces dont le profil de ports a changé, pour
+    la politique de pare-feu"""
+    port = kwargs['instance']
+    InterfaceChange.log(
+        Interface.objects.filter(port_lists=port.port_list_id)
+        .values_list('pk', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=Interface.port_lists.through)
+def interface_port_lists_changed(**kwargs):
+    """Journalise les interfaces dont les profils de ports ont changé"""
+    if kwargs['action'] not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if isinstance(kwargs['instance'], Interface):
+        InterfaceChange.log([kwargs['instance'].pk])
+    elif kwargs['action'] == 'post_clear':
+        # Les interfaces ne sont plus connues après un clear inverse
+        FirewallPolicy.invalidate()
+    else:
+        InterfaceChange.log(kwargs['pk_set'])
+
+
+@receiver(post_save, sender=preferences.models.OptionalMachine)
+def optionalmachine_firewall_changed(**_kwargs):
+    """Le mode ipv6 change les adresses de la politique de pare-feu"""
+    FirewallPolicy.invalidate()
+
+
+@receiver(post_save, sender=IpType)
+@receiver(post_delete, sender=IpType)
+def iptype_dns_changed(**kwargs):
+    """The reverse zone of an IpType must be rendered again, and the
+    range index rebuilt"""
+    DNSZoneCache.invalidate(DNSZoneCache.REVERSE, [kwargs['instance'].pk])
+    IpTypeIndex.invalidate()
@@ -0,0 +1,227 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""machines.tests
+The tests for the Machines module.
+"""
+
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import (
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+    skipUnlessDBFeature,
+)
+from django.test.utils import CaptureQueriesContext
+
+from users.models import User
+from . import models
+
+
+class AssignIpv4TestCase(TransactionTestCase):
+    """The IPv4 allocation, in and out of a transaction. TransactionTestCase
+    runs the tests in autocommit, like freeradius does : on PostgreSQL, a
+    SELECT ... FOR UPDATE there raises TransactionManagementError"""
+
+    def setUp(self):
+        soa = models.SOA.objects.create(
+            name="assign_soa",
+            mail="postmaster@example.net"
+        )
+        extension = models.Extension.objects.create(
+            name=".assign.example.net",
+            soa=soa
+        )
+        self.ip_type = models.IpType.objects.create(
+            name="assign_iptype",
+            extension=extension,
+            domaine_ip_start="10.42.0.1",
+            domaine_ip_stop="10.42.0.10",
+        )
+        self.machine_type = models.MachineType.objects.create(
+            name="assign_machinetype",
+            ip_type=self.ip_type
+        )
+        user = User.objects.create_user(
+            "assignipv4user",
+            "assignipv4user@example.net",
+            "assignipv4user",
+            surname="assignipv4user",
+        )
+        machine = models.Machine.objects.create(user=user, active=True)
+        self.interface = models.Interface(
+            machine=machine,
+            machine_type=self.machine_type,
+            mac_address="00:11:22:33:44:55"
+        )
+
+    def test_assign_in_autocommit(self):
+        self.assertFalse(connection.in_atomic_block)
+        with CaptureQueriesContext(connection) as queries:
+            self.interface.assign_ipv4()
+        self.assertIsNotNone(self.interface.ipv4)
+        self.assertFalse(any(
+            'FOR UPDATE' in query['sql'] for query in queries.captured_queries
+        ))
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_assign_in_transaction_locks(self):
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                self.interface.assign_ipv4()
+            self.interface.save()
+        self.assertTrue(any(
+            'FOR UPDATE' in query['sql'] for query in queries.captured_queries
+        ))
+        self.assertEqual(
+            models.Interface.objects.get(pk=self.interface.pk).ipv4,
+            self.interface.ipv4
+        )
+
+    def test_allocations_do_not_overlap(self):
+        with transaction.atomic():
+            first = self.ip_type.allocate_free_ips(3)
+            self.interface.ipv4 = first[0]
+            self.interface.save()
+        second = self.ip_type.allocate_free_ips(3)
+        self.assertNotIn(first[0], second)
+
+
+# Les jobs (ldap) sont mis en file au lieu d'être exécutés
+@override_settings(ASYNC_JOBS=True)
+class DNSZoneInvalidationTestCase(TestCase):
+    """Une interface qui change de type d'ip doit aussi marquer les
+    zones qu'elle quitte, sans quoi elles gardent ses enregistrements"""
+
+    def setUp(self):
+        soa = models.SOA.objects.create(
+            name="zones_soa",
+            mail="postmaster@example.net"
+        )
+        self.extensions = []
+        self.ip_types = []
+        self.machine_types = []
+        for index in (1, 2):
+            extension = models.Extension.objects.create(
+                name=".zones%d.example.net" % index,
+                soa=soa
+            )
+            ip_type = models.IpType.objects.create(
+                name="zones_iptype%d" % index,
+                extension=extension,
+                domaine_ip_start="10.%d.0.1" % (50 + index),
+                domaine_ip_stop="10.%d.0.10" % (50 + index),
+            )
+            self.extensions.append(extension)
+            self.ip_types.append(ip_type)
+            self.machine_types.append(models.MachineType.objects.create(
+                name="zones_machinetype%d" % index,
+                ip_type=ip_type
+            ))
+        user = User.objects.create_user(
+            "zonesuser",
+            "zonesuser@example.net",
+            "zonesuser",
+            surname="zonesuser",
+        )
+        machine = models.Machine.objects.create(user=user, active=True)
+        interface = models.Interface(
+            machine=machine,
+            machine_type=self.machine_types[0],
+            mac_address="00:11:22:33:44:66"
+        )
+        interface.clean()
+        interface.save()
+        self.interface_id = interface.pk
+        # Toutes les zones viennent d'être rendues
+        models.DNSZoneCache.get_zones(
+            models.DNSZoneCache.REVERSE,
+            [ip_type.pk for ip_type in self.ip_types]
+        )
+        models.DNSZoneCache.get_zones(
+            models.DNSZoneCache.FORWARD,
+            [extension.pk for extension in self.extensions]
+        )
+        models.DNSZoneCache.objects.update(dirty=False)
+
+    def assertDirty(self, zone_type, zones):
+        self.assertEqual(
+            set(models.DNSZoneCache.objects.filter(
+                zone_type=zone_type,
+                dirty=True
+            ).values_list('zone_id', flat=True)),
+            set(zone.pk for zone in zones)
+        )
+
+    def test_interface_changes_ip_type(self):
+        interface = models.Interface.objects.get(pk=self.interface_id)
+        interface.machine_type = self.machine_types[1]
+        interface.clean()
+        interface.save()
+        self.assertDirty(models.DNSZoneCache.REVERSE, self.ip_types)
+        self.assertDirty(models.DNSZoneCache.FORWARD, self.extensions)
+
+    def test_machine_type_changes_ip_type(self):
+        machine_type = models.MachineType.objects.get(
+            pk=self.machine_types[0].pk
+        )
+        machine_type.ip_type = self.ip_types[1]
+        machine_type.save()
+        self.assertDirty(models.DNSZoneCache.REVERSE, self.ip_types)
+        self.assertDirty(models.DNSZoneCache.FORWARD, self.extensions)
+
+
+class RegenCoalescerTestCase(TransactionTestCase):
+    """Le regroupement des régénérations, au commit et à l'annulation"""
+
+    def setUp(self):
+        models.regen_coalescer.flush()
+
+    def flushed(self, queries):
+        table = models.Service_link._meta.db_table
+        return any(
+            query['sql'].startswith('UPDATE') and table in query['sql']
+            for query in queries.captured_queries
+        )
+
+    def test_one_callback_per_transaction(self):
+        with mock.patch(
+                'machines.models.transaction.on_commit',
+                wraps=transaction.on_commit
+        ) as on_commit:
+            with transaction.atomic():
+                for _ in range(100):
+                    models.regen('dhcp')
+                    models.regen('dns')
+            self.assertEqual(on_commit.call_count, 1)
+            self.assertEqual(models.regen_coalescer.pending, set())
+
+    def test_rolled_back_request_is_not_lost(self):
+        try:
+            with transaction.atomic():
+                models.regen('dhcp')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with CaptureQueriesContext(connection) as queries:
+            models.regen('dhcp')
+        self.assertTrue(self.flushed(queries))
+        self.assertEqual(models.regen_coalescer.pending, set())
+
+    def test_new_transaction_after_rollback(self):
+        try:
+            with transaction.atomic():
+                models.regen('dhcp')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                models.regen('dhcp')
+        self.assertTrue(self.flushed(queries))
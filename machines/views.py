@@ -30,11 +30,9 @@ from re2o.acl import (
     can_view,
     can_delete,
     can_view_all,
+    filter_viewable,
 )
-from re2o.utils import (
-    all_active_assigned_interfaces,
-    filter_active_interfaces,
-)
+from re2o.utils import all_active_assigned_interfaces
 from re2o.base import (
     SortTable,
     re2o_paginator,
@@ -67,9 +65,9 @@ from .models import (
     Txt,
     Srv,
     SshFp,
-    OuverturePortList,
     OuverturePort,
     Ipv6List,
+    FirewallPolicy,
 )
 from .serializers import (
     FullInterfaceSerializer,
@@ -572,7 +570,7 @@ def index(request):
     machines in Re2o """
     pagination_large_number = (GeneralOption
                                .get_cached_value('pagination_large_number'))
-    machines_list = (Machine.objects
+    machines_list = (filter_viewable(request.user, Machine.objects.all())
                      .select_related('user')
                      .prefetch_related('interface_set__domain__extension')
                      .prefetch_related('interface_set__ipv4__ip_type')
@@ -858,67 +856,9 @@ def service_servers(_request):
 @login_required
 @permission_required('machines.serveur')
 def ouverture_ports(_request):
-    """ API view to list the port policies for each IP """
-    r = {'ipv4': {}, 'ipv6': {}}
-    for o in (OuverturePortList.objects
-            .all()
-            .prefetch_related('ouvertureport_set')
-            .prefetch_related('interface_set', 'interface_set__ipv4')):
-        pl = {
-            "tcp_in": set(map(
-                str,
-                o.ouvertureport_set.filter(
-                    protocole=OuverturePort.TCP,
-                    io=OuverturePort.IN
-                )
-            )),
-            "tcp_out": set(map(
-                str,
-                o.ouvertureport_set.filter(
-                    protocole=OuverturePort.TCP,
-                    io=OuverturePort.OUT
-                )
-            )),
-            "udp_in": set(map(
-                str,
-                o.ouvertureport_set.filter(
-                    protocole=OuverturePort.UDP,
-                    io=OuverturePort.IN
-                )
-            )),
-            "udp_out": set(map(
-                str,
-                o.ouvertureport_set.filter(
-                    protocole=OuverturePort.UDP,
-                    io=OuverturePort.OUT
-                )
-            )),
-        }
-        for i in filter_active_interfaces(o.interface_set):
-            if i.may_have_port_open():
-                d = r['ipv4'].get(i.ipv4.ipv4, {})
-                d["tcp_in"] = (d.get("tcp_in", set())
-                               .union(pl["tcp_in"]))
-                d["tcp_out"] = (d.get("tcp_out", set())
-                                .union(pl["tcp_out"]))
-                d["udp_in"] = (d.get("udp_in", set())
-                               .union(pl["udp_in"]))
-                d["udp_out"] = (d.get("udp_out", set())
-                                .union(pl["udp_out"]))
-                r['ipv4'][i.ipv4.ipv4] = d
-            if i.ipv6():
-                for ipv6 in i.ipv6():
-                    d = r['ipv6'].get(ipv6.ipv6, {})
-                    d["tcp_in"] = (d.get("tcp_in", set())
-                                   .union(pl["tcp_in"]))
-                    d["tcp_out"] = (d.get("tcp_out", set())
-                                    .union(pl["tcp_out"]))
-                    d["udp_in"] = (d.get("udp_in", set())
-                                   .union(pl["udp_in"]))
-                    d["udp_out"] = (d.get("udp_out", set())
-                                    .union(pl["udp_out"]))
-                    r['ipv6'][ipv6.ipv6] = d
-    return JSONResponse(r)
+    """ API view to list the port policies for each IP, see
+    FirewallPolicy """
+    return JSONResponse(FirewallPolicy.get())
 
 
 @csrf_exempt
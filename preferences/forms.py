@@ -141,6 +141,9 @@ class EditGeneralOptionForm(ModelForm):
         self.fields['req_expire_hrs'].label = _("Time before expiration of the"
                                                 " reset password link (in"
                                                 " hours)")
+        self.fields['history_retention_months'].label = _("Months before"
+                                                          " archival of the"
+                                                          " history")
         self.fields['site_name'].label = _("Website name")
         self.fields['email_from'].label = _("Email address for automatic"
                                             " emailing")
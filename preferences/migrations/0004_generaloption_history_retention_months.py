@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2019-05-09 14:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('preferences', '0003_drop_view_permissions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generaloption',
+            name='history_retention_months',
+            field=models.PositiveIntegerField(default=0, help_text='Revisions older than this number of months are moved to the history archive (0 to never archive them)'),
+        ),
+    ]
@@ -389,6 +389,11 @@ class GeneralOption(AclMixin, PreferencesModel):
     pagination_number = models.IntegerField(default=25)
     pagination_large_number = models.IntegerField(default=8)
     req_expire_hrs = models.IntegerField(default=48)
+    history_retention_months = models.PositiveIntegerField(
+        default=0,
+        help_text=_("Revisions older than this number of months are moved to"
+                    " the history archive (0 to never archive them)")
+    )
     site_name = models.CharField(max_length=32, default="Re2o")
     email_from = models.EmailField(default="www-data@example.com")
     main_site_url = models.URLField(max_length=255, default="http://re2o.example.org")
@@ -8,6 +8,11 @@
 """Handles ACL for re2o.
 
 Here are defined some decorators that can be used in views to handle ACL.
+
+The decisions taken by the `can_xxx` methods are memoized for the duration
+of a request (see `acl_check`) : the decorators, the templatetags and the
+API permissions share them, so a list page checking the same rights on every
+row only runs the queries once. Any database write forgets them.
 """
 from __future__ import unicode_literals
 
@@ -15,11 +20,129 @@ import sys
 from itertools import chain
 
 from django.db.models import Model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.contrib import messages
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.translation import ugettext as _
 
+# Bumped on every write, the memoized decisions of an older generation are
+# dropped (see acl_cache)
+_GENERATION = 0
+
+
+@receiver([post_save, post_delete, m2m_changed])
+def acl_cache_changed(**_kwargs):
+    """Any write may change an ACL decision : forget the memoized ones"""
+    global _GENERATION
+    _GENERATION += 1
+
+
+def acl_cache(user):
+    """The ACL decisions already taken for `user`. They are stored on the
+    user object, which lives as long as the request (`request.user`, which
+    is also `user` in the templates)."""
+    generation, cache = getattr(user, '_acl_cache', (None, None))
+    if generation != _GENERATION:
+        cache = {}
+        user._acl_cache = (_GENERATION, cache)
+    return cache
+
+
+def _acl_key(target, method_name, args, kwargs):
+    """The key of a decision : the method, the model (or module) and the
+    pk of the instance, and the arguments. None if it can't be memoized
+    (unsaved instance, unhashable argument)"""
+    if isinstance(target, Model):
+        if target.pk is None:
+            return None
+        target = (type(target), target.pk)
+    key = (method_name, target, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def acl_check(user, target, method_name, *args, **kwargs):
+    """Runs `target.method_name(user, *args, **kwargs)`, memoized for the
+    duration of the request.
+
+    Args:
+        user: The user asking for the access.
+        target: A model, an instance or an application module.
+        method_name: The name of the ACL method (ex: 'can_edit').
+
+    Returns:
+        The `(can, reason)` tuple returned by the method.
+    """
+    method = getattr(target, method_name)
+    key = _acl_key(target, method_name, args, kwargs)
+    if key is None or getattr(user, 'pk', None) is None:
+        return method(user, *args, **kwargs)
+    cache = acl_cache(user)
+    if key not in cache:
+        cache[key] = method(user, *args, **kwargs)
+    return cache[key]
+
+
+def filter_viewable(user, queryset):
+    """Restricts `queryset` to the instances `user` can view, without
+    checking every instance when possible : everything if the user can view
+    all the instances of the model, else the filter given by the
+    `filter_viewable` method of the model. Models without such a method
+    fall back to checking every instance.
+
+    Args:
+        user: The user asking for the access.
+        queryset: The queryset to restrict.
+
+    Returns:
+        The restricted queryset.
+    """
+    model = queryset.model
+    if hasattr(model, 'can_view_all') and \
+            acl_check(user, model, 'can_view_all')[0]:
+        return queryset
+    if hasattr(model, 'filter_viewable'):
+        return model.filter_viewable(user, queryset)
+    return queryset.filter(pk__in=viewable_ids(user, queryset))
+
+
+def viewable_ids(user, queryset):
+    """The pks of the instances of `queryset` that `user` can view, checking
+    them one by one (memoized)"""
+    return [
+        instance.pk for instance in queryset
+        if acl_check(user, instance, 'can_view')[0]
+    ]
+
+
+def filter_deletable(user, queryset):
+    """Restricts `queryset` to the instances `user` can delete, with the
+    `filter_deletable` method of the model, evaluated in SQL. Models without
+    such a method, or returning None from it, fall back to checking every
+    instance.
+
+    Args:
+        user: The user asking for the deletion.
+        queryset: The queryset to restrict.
+
+    Returns:
+        The restricted queryset.
+    """
+    model = queryset.model
+    if hasattr(model, 'filter_deletable'):
+        filtered = model.filter_deletable(user, queryset)
+        if filtered is not None:
+            return filtered
+    return queryset.filter(pk__in=[
+        instance.pk for instance in queryset
+        if acl_check(user, instance, 'can_delete')[0]
+    ])
+
 
 def acl_base_decorator(method_name, *targets, on_instance=True):
     """Base decorator for acl. It checks if the `request.user` has the
@@ -126,11 +249,17 @@ ModelC)
                         yield False, _("Nonexistent entry.")
                         return
                 if hasattr(target, method_name):
-                    can_fct = getattr(target, method_name)
-                    yield can_fct(request.user, *args, **kwargs)
+                    yield acl_check(
+                        request.user, target, method_name, *args, **kwargs
+                    )
                 for field in fields:
-                    can_change_fct = getattr(target, 'can_change_' + field)
-                    yield can_change_fct(request.user, *args, **kwargs)
+                    yield acl_check(
+                        request.user,
+                        target,
+                        'can_change_' + field,
+                        *args,
+                        **kwargs
+                    )
 
             error_messages = [
                 x[1] for x in chain.from_iterable(
@@ -189,21 +318,16 @@ def can_delete(*targets):
 
 def can_delete_set(model):
     """Decorator which returns a list of detable models by request user.
-    If none of them, return an error"""
+    If none of them, return an error. The list is a queryset filtered by
+    `filter_deletable`, evaluated in SQL when the model allows it."""
     def decorator(view):
         """The decorator to use on a specific view
         """
         def wrapper(request, *args, **kwargs):
             """The wrapper used for a specific request
             """
-            all_objects = model.objects.all()
-            instances_id = []
-            for instance in all_objects:
-                can, _msg = instance.can_delete(request.user)
-                if can:
-                    instances_id.append(instance.id)
-            instances = model.objects.filter(id__in=instances_id)
-            if not instances:
+            instances = filter_deletable(request.user, model.objects.all())
+            if not instances.exists():
                 messages.error(
                     request, _("You don't have the right to access this menu.")
                 )
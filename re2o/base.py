@@ -11,6 +11,8 @@ Et non corrélées/dépendantes des autres applications
 
 import smtplib
 
+from django.db import connection
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
@@ -253,3 +255,175 @@ def re2o_paginator(request, query_set, pagination_number):
         # If page is out of range (e.g. 9999), deliver last page of results.
         results = paginator.page(paginator.num_pages)
     return results
+
+
+# Above this number of rows, keyset paginated lists only show an estimate
+APPROXIMATE_COUNT_LIMIT = 10000
+
+
+def approximate_count(query_set, limit=APPROXIMATE_COUNT_LIMIT):
+    """Count the rows of query_set, stopping at limit.
+    :query_set: Query_set to count
+    :limit: The number of rows above which the count is not exact
+    :return: (count, exact). Above limit, the count is the estimate of the
+        database statistics for an unfiltered table on PostgreSQL, else
+        limit itself"""
+    count = query_set.order_by()[:limit + 1].count()
+    if count <= limit:
+        return count, True
+    if not query_set.query.where and connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE relname = %s",
+                [query_set.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+        if row and row[0] > limit:
+            return int(row[0]), False
+    return limit, False
+
+
+class KeysetPage(object):
+    """A page of a list paginated with keyset_paginator. Like a Page, it
+    iterates over its objects, but it only knows the cursors of the
+    neighbouring pages and an approximate total count."""
+    keyset = True
+
+    def __init__(self, object_list, next_cursor, previous_cursor, count,
+                 count_exact):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+        self.count_exact = count_exact
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _keyset_filter(ordering, values):
+    """The filter of the rows coming after values in ordering, a list of
+    fields (prefixed by '-' when descending) ending by a unique one"""
+    condition = Q()
+    equal = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = '__lt' if field.startswith('-') else '__gt'
+        condition |= equal & Q(**{name + lookup: value})
+        equal &= Q(**{name: value})
+    return condition
+
+
+def _reverse_ordering(ordering):
+    """The opposite ordering"""
+    return [
+        field[1:] if field.startswith('-') else '-' + field
+        for field in ordering
+    ]
+
+
+def _keyset_scan(query_set, ordering, boundary, number, keep):
+    """Read the rows after boundary in ordering by chunks of number rows,
+    until number rows are kept by keep (a function filtering a list).
+    :return: the kept rows, and whether some rows are left after them"""
+    names = [field.lstrip('-') for field in ordering]
+    query_set = query_set.order_by(*ordering)
+    kept = []
+    while True:
+        rows = query_set
+        if boundary is not None:
+            rows = rows.filter(_keyset_filter(ordering, boundary))
+        rows = list(rows[:number + 1])
+        more = len(rows) > number
+        rows = rows[:number]
+        for row in keep(rows):
+            if len(kept) == number:
+                return kept, True
+            kept.append(row)
+        if not more:
+            return kept, False
+        if len(kept) == number:
+            return kept, True
+        last = rows[-1]
+        boundary = [_field_value(last, name) for name in names]
+
+
+def _field_value(obj, name):
+    """The value of the field name (which may follow relations) of obj"""
+    for attribute in name.split('__'):
+        obj = getattr(obj, attribute)
+    return obj
+
+
+def keyset_paginator(request, query_set, pagination_number, ordering,
+                     keep=None):
+    """Keyset (cursor) paginator, for lists too large for an OFFSET and a
+    COUNT(*) : a page is the pagination_number rows following (GET
+    parameter `after`) or preceding (`before`) the row whose pk is given.
+    :request:
+    :query_set: Query_set to paginate
+    :pagination_number: Number of entries to display
+    :ordering: The fields to order by, prefixed by '-' when descending, the
+        last one being unique (ex: ['-revision__date_created', '-id']). They
+        must not be null.
+    :keep: A function filtering a list of rows (ex: dropping the versions
+        whose object was deleted). The page is filled with the next rows.
+    :return: A KeysetPage"""
+    keep = keep or (lambda rows: rows)
+    names = [field.lstrip('-') for field in ordering]
+
+    def boundary(param):
+        """The ordering values of the row given by the GET parameter"""
+        try:
+            pk = int(request.GET.get(param) or '')
+        except ValueError:
+            return None
+        return query_set.model.objects.filter(pk=pk).values_list(
+            *names
+        ).first()
+
+    count, count_exact = approximate_count(query_set)
+    before = boundary('before')
+    if before is not None:
+        rows, more = _keyset_scan(
+            query_set,
+            _reverse_ordering(ordering),
+            before,
+            pagination_number,
+            keep
+        )
+        rows.reverse()
+        return KeysetPage(
+            rows,
+            rows[-1].pk if rows else None,
+            rows[0].pk if rows and more else None,
+            count,
+            count_exact
+        )
+    after = boundary('after')
+    rows, more = _keyset_scan(
+        query_set,
+        ordering,
+        after,
+        pagination_number,
+        keep
+    )
+    return KeysetPage(
+        rows,
+        rows[-1].pk if rows and more else None,
+        rows[0].pk if rows and after is not None else None,
+        count,
+        count_exact
+    )
@@ -0,0 +1,177 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""
+Benchmark of the access queries of re2o.utils : the denormalized
+UserAccessState path (no search_time) against the historical nested
+subqueries (explicit search_time).
+
+A synthetic fixture is inserted in a transaction which is rolled back at
+the end, so the command leaves the database untouched.
+"""
+
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cotisations.models import (
+    BaseInvoice, Cotisation, Facture, Paiement, Vente
+)
+from re2o.settings import UID_RANGES
+from re2o.utils import all_adherent, all_has_access
+from users.models import User, UserAccessState
+
+
+class Rollback(Exception):
+    """ Raised to roll back the fixture once the benchmark is done """
+    pass
+
+
+class Command(BaseCommand):
+    """ The command object for `bench_access` """
+    help = ("Compare all_has_access/all_adherent on the denormalized "
+            "access state and on the nested subqueries")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--invoices', type=int, default=200000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def _create_fixture(self, nb_users, nb_invoices):
+        """ Bulk insert users, invoices, purchases and cotisations, without
+        any signal """
+        now = timezone.now()
+        paiement = Paiement.objects.create(moyen='bench')
+        uid_start = int(min(UID_RANGES['users']))
+        last_user = User.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0
+        User.objects.bulk_create(
+            [
+                User(
+                    username='bench%d' % i,
+                    surname='bench',
+                    email='bench%d@example.org' % i,
+                    password='!',
+                    pwd_ntlm='',
+                    state=User.STATE_ACTIVE,
+                    uid_number=uid_start + 1000000 + i,
+                )
+                for i in range(nb_users)
+            ],
+            batch_size=1000
+        )
+        user_ids = list(User.objects.filter(
+            pk__gt=last_user).values_list('pk', flat=True))
+
+        last_invoice = BaseInvoice.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0
+        BaseInvoice.objects.bulk_create(
+            [BaseInvoice() for _ in range(nb_invoices)],
+            batch_size=1000
+        )
+        invoice_ids = list(BaseInvoice.objects.filter(
+            pk__gt=last_invoice).values_list('pk', flat=True))
+        # Multi-table inheritance is not supported by bulk_create
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO %s (baseinvoice_ptr_id, user_id, paiement_id, "
+                "cheque, valid, control) VALUES (%%s, %%s, %%s, '', %%s, %%s)"
+                % Facture._meta.db_table,
+                [
+                    (invoice_id, random.choice(user_ids), paiement.pk,
+                     random.random() > 0.05, False)
+                    for invoice_id in invoice_ids
+                ]
+            )
+
+        last_vente = Vente.objects.order_by('-pk').values_list(
+            'pk', flat=True).first() or 0
+        Vente.objects.bulk_create(
+            [
+                Vente(
+                    facture_id=invoice_id,
+                    number=1,
+                    name='bench',
+                    prix=10,
+                    duration=1,
+                    type_cotisation=random.choice(
+                        ['All', 'Adhesion', 'Connexion']
+                    ),
+                )
+                for invoice_id in invoice_ids
+            ],
+            batch_size=1000
+        )
+        Cotisation.objects.bulk_create(
+            [
+                Cotisation(
+                    vente_id=vente_id,
+                    type_cotisation=type_cotisation,
+                    date_start=date_start,
+                    date_end=date_start + timedelta(days=30),
+                )
+                for vente_id, type_cotisation, date_start in (
+                    (pk, type_cotisation,
+                     now - timedelta(days=random.randint(0, 730)))
+                    for pk, type_cotisation in Vente.objects.filter(
+                        pk__gt=last_vente
+                    ).values_list('pk', 'type_cotisation')
+                )
+            ],
+            batch_size=1000
+        )
+
+    def _time(self, function, repeat, **kwargs):
+        """ Best wall time of `repeat` evaluations of the queryset """
+        best = None
+        count = 0
+        for _ in range(repeat):
+            start = time.time()
+            count = len(function(**kwargs).values_list('pk', flat=True))
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, count
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                start = time.time()
+                self._create_fixture(options['users'], options['invoices'])
+                self.stdout.write("Fixture created in %.1fs" % (
+                    time.time() - start))
+                start = time.time()
+                UserAccessState.refresh_all()
+                self.stdout.write("Access state built in %.1fs" % (
+                    time.time() - start))
+                for function in (all_has_access, all_adherent):
+                    state_time, state_count = self._time(
+                        function, options['repeat'], including_asso=False
+                    )
+                    query_time, query_count = self._time(
+                        function,
+                        options['repeat'],
+                        including_asso=False,
+                        search_time=timezone.now()
+                    )
+                    self.stdout.write(
+                        "%s: access state %.3fs (%d users), "
+                        "subqueries %.3fs (%d users), x%.1f" % (
+                            function.__name__,
+                            state_time,
+                            state_count,
+                            query_time,
+                            query_count,
+                            query_time / max(state_time, 1e-6)
+                        )
+                    )
+                raise Rollback()
+        except Rollback:
+            self.stdout.write(self.style.SUCCESS("Fixture rolled back"))
@@ -0,0 +1,77 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""
+The job worker : runs the jobs queued by the post_save signals (see
+re2o.models.Job). Runs forever by default, or until the queue is empty
+with --once (to use from a cron).
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from re2o.models import Job
+
+
+class Command(BaseCommand):
+    """ The command object for `run_jobs` """
+    help = "Run the queued jobs (ldap synchronisation, mails)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help="Exit once the queue is empty",
+        )
+        parser.add_argument('--batch', type=int, default=50)
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=2,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            '--purge-days',
+            type=int,
+            default=7,
+            help="Delete the jobs done for more than this number of days",
+        )
+        parser.add_argument(
+            '--stale-minutes',
+            type=int,
+            default=30,
+            help="Requeue the jobs running for more than this number of "
+                 "minutes",
+        )
+
+    def handle(self, *args, **options):
+        recovered = Job.recover(options['stale_minutes'])
+        if recovered:
+            self.stdout.write("%d stale jobs requeued" % recovered)
+        done = failed = 0
+        last_purge = 0
+        while True:
+            close_old_connections()
+            if time.time() - last_purge > 3600:
+                Job.purge(options['purge_days'])
+                last_purge = time.time()
+            jobs = Job.fetch(options['batch'])
+            for job in jobs:
+                if job.run():
+                    done += 1
+                else:
+                    failed += 1
+                    self.stderr.write("%s failed (attempt %d)" % (
+                        job, job.attempts))
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+        self.stdout.write("%d jobs done, %d failed" % (done, failed))
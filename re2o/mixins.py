@@ -63,7 +63,9 @@ class AclMixin(object):
     :can_view: Applied on an instance, return if the user can view the
         instance
     :can_view_all: Applied on a class, return if the user can view all
-        instances"""
+        instances
+    :filter_deletable: Applied on a class, take the requested user and a
+        queryset, return the instances of the queryset the user can delete"""
 
     @classmethod
     def get_classname(cls):
@@ -125,6 +127,22 @@ class AclMixin(object):
                 % self.get_classname())
         )
 
+    @classmethod
+    def filter_deletable(cls, user_request, queryset):
+        """Restreint queryset aux instances que l'user peut supprimer, en
+        une requête, suivant la même règle que can_delete
+        :param user_request: Utilisateur qui fait la requête
+        :param queryset: Les instances candidates
+        :return: Le queryset filtré, ou None si can_delete est redéfini
+            sans filter_deletable (il faut alors tester chaque instance)"""
+        if cls.can_delete is not AclMixin.can_delete:
+            return None
+        if user_request.has_perm(
+                cls.get_modulename() + '.delete_' + cls.get_classname()
+        ):
+            return queryset
+        return queryset.none()
+
     @classmethod
     def can_view_all(cls, user_request, *_args, **_kwargs):
         """Vérifie qu'on peut bien afficher l'ensemble des objets,
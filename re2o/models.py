@@ -0,0 +1,177 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""re2o.models
+The job queue : the side effects of the post_save signals (ldap
+synchronisation, mails) are stored as jobs in the database and run by the
+`run_jobs` worker, outside of the web request.
+
+A job is the dotted path of a function and its keyword arguments. The
+functions must be idempotent : they reload the objects they work on, so a
+job may be retried, and the pending jobs on the same key are merged.
+
+Unless `ASYNC_JOBS` is set in settings_local, the jobs are run right away
+as before.
+"""
+
+from __future__ import unicode_literals
+
+import json
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext_lazy as _
+
+from re2o.mixins import AclMixin
+
+
+class Job(AclMixin, models.Model):
+    """A side effect to run by the worker"""
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = (
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+        (STATUS_FAILED, _("Failed")),
+    )
+    MAX_ATTEMPTS = 5
+    # Delay before the first retry, doubled at each attempt
+    RETRY_DELAY = 30
+
+    task = models.CharField(max_length=255)
+    key = models.CharField(max_length=255)
+    kwargs = models.TextField(default='{}')
+    status = models.CharField(
+        max_length=16,
+        choices=STATUSES,
+        default=STATUS_PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        index_together = (("status", "run_after"), ("task", "key", "status"))
+        verbose_name = _("job")
+        verbose_name_plural = _("jobs")
+
+    @staticmethod
+    def _merge(old, new):
+        """Merge the arguments of two jobs on the same key : the boolean
+        flags are or-ed (a job syncing more is still correct), the other
+        values are replaced"""
+        merged = dict(old)
+        for name, value in new.items():
+            if isinstance(value, bool) and isinstance(merged.get(name), bool):
+                merged[name] = merged[name] or value
+            else:
+                merged[name] = value
+        return merged
+
+    @classmethod
+    def enqueue(cls, task, key, **kwargs):
+        """Queue the function `task` (dotted path) called with kwargs.
+        A pending job with the same task and key is reused. Without
+        `ASYNC_JOBS`, the function is run right away."""
+        if not getattr(settings, 'ASYNC_JOBS', False):
+            return import_string(task)(**kwargs)
+        with transaction.atomic():
+            job = cls.objects.select_for_update().filter(
+                task=task,
+                key=key,
+                status=cls.STATUS_PENDING
+            ).first()
+            if job is None:
+                return cls.objects.create(
+                    task=task,
+                    key=key,
+                    kwargs=json.dumps(kwargs)
+                )
+            job.kwargs = json.dumps(cls._merge(json.loads(job.kwargs), kwargs))
+            job.save()
+            return job
+
+    @classmethod
+    def fetch(cls, limit):
+        """Take up to `limit` runnable jobs, marking them running. The
+        rows are locked while taken, skipping the ones another worker
+        holds when the database allows it"""
+        with transaction.atomic():
+            jobs = cls.objects.filter(
+                status=cls.STATUS_PENDING,
+                run_after__lte=timezone.now()
+            ).order_by('run_after', 'pk')
+            if connection.features.has_select_for_update_skip_locked:
+                jobs = jobs.select_for_update(skip_locked=True)
+            else:
+                jobs = jobs.select_for_update()
+            jobs = list(jobs[:limit])
+            cls.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=cls.STATUS_RUNNING,
+                updated=timezone.now()
+            )
+        return jobs
+
+    def run(self):
+        """Run the job, then mark it done, or pending again with a delay
+        until MAX_ATTEMPTS is reached. Returns True on success"""
+        self.attempts += 1
+        try:
+            with transaction.atomic():
+                import_string(self.task)(**json.loads(self.kwargs))
+        except Exception:
+            self.last_error = traceback.format_exc()
+            if self.attempts >= self.MAX_ATTEMPTS:
+                self.status = self.STATUS_FAILED
+            else:
+                self.status = self.STATUS_PENDING
+                self.run_after = timezone.now() + timedelta(
+                    seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1)
+                )
+            self.save()
+            return False
+        self.status = self.STATUS_DONE
+        self.last_error = ''
+        self.save()
+        return True
+
+    def retry(self):
+        """Put a failed job back in the queue"""
+        self.status = self.STATUS_PENDING
+        self.attempts = 0
+        self.run_after = timezone.now()
+        self.save()
+
+    @classmethod
+    def purge(cls, days):
+        """Delete the jobs done for more than `days` days"""
+        return cls.objects.filter(
+            status=cls.STATUS_DONE,
+            updated__lt=timezone.now() - timedelta(days=days)
+        ).delete()[0]
+
+    @classmethod
+    def recover(cls, minutes):
+        """Put back in the queue the jobs left running for more than
+        `minutes` minutes by a worker which died"""
+        return cls.objects.filter(
+            status=cls.STATUS_RUNNING,
+            updated__lt=timezone.now() - timedelta(minutes=minutes)
+        ).update(status=cls.STATUS_PENDING)
+
+    def __str__(self):
+        return "%s (%s)" % (self.task, self.key)
@@ -96,3 +96,8 @@ GID_RANGES = {
 
 # Some Django apps you want to add in you local project
 OPTIONNAL_APPS = ()
+
+# Run the side effects of the saves (LDAP synchronisation, mails) in the job
+# worker, `python3 manage.py run_jobs`, instead of inside the web request.
+# The worker must then be running (systemd service or cron with --once).
+ASYNC_JOBS = False
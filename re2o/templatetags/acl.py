@@ -53,6 +53,10 @@ an instance of a model (either Model.can_xxx or instance.can_xxx)
     To add support for a new model, add an entry in 'get_model' and be sure
     the acl function exists in the model definition
 
+The decisions are memoized for the request and shared with the view
+decorators (see `re2o.acl.acl_check`), so the same check on every row of a
+list only runs once per distinct instance.
+
 """
 import sys
 
@@ -60,6 +64,8 @@ from django import template
 from django.template.base import Node, NodeList
 from django.contrib.contenttypes.models import ContentType
 
+from re2o.acl import acl_check
+
 
 register = template.Library()
 
@@ -100,37 +106,40 @@ def get_callback(tag_name, obj=None):
     """Return the right function to call back to check for acl"""
 
     if tag_name == 'can_create':
-        return acl_fct(obj.can_create, False)
+        return acl_fct(acl_method(obj, 'can_create'), False)
     if tag_name == 'cannot_create':
-        return acl_fct(obj.can_create, True)
+        return acl_fct(acl_method(obj, 'can_create'), True)
     if tag_name == 'can_edit':
-        return acl_fct(obj.can_edit, False)
+        return acl_fct(acl_method(obj, 'can_edit'), False)
     if tag_name == 'cannot_edit':
-        return acl_fct(obj.can_edit, True)
+        return acl_fct(acl_method(obj, 'can_edit'), True)
     if tag_name == 'can_edit_all':
-        return acl_fct(obj.can_edit_all, False)
+        return acl_fct(acl_method(obj, 'can_edit_all'), False)
     if tag_name == 'cannot_edit_all':
-        return acl_fct(obj.can_edit_all, True)
+        return acl_fct(acl_method(obj, 'can_edit_all'), True)
     if tag_name == 'can_delete':
-        return acl_fct(obj.can_delete, False)
+        return acl_fct(acl_method(obj, 'can_delete'), False)
     if tag_name == 'cannot_delete':
-        return acl_fct(obj.can_delete, True)
+        return acl_fct(acl_method(obj, 'can_delete'), True)
     if tag_name == 'can_delete_all':
-        return acl_fct(obj.can_delete_all, False)
+        return acl_fct(acl_method(obj, 'can_delete_all'), False)
     if tag_name == 'cannot_delete_all':
-        return acl_fct(obj.can_delete_all, True)
+        return acl_fct(acl_method(obj, 'can_delete_all'), True)
     if tag_name == 'can_view':
-        return acl_fct(obj.can_view, False)
+        return acl_fct(acl_method(obj, 'can_view'), False)
     if tag_name == 'cannot_view':
-        return acl_fct(obj.can_view, True)
+        return acl_fct(acl_method(obj, 'can_view'), True)
     if tag_name == 'can_view_all':
-        return acl_fct(obj.can_view_all, False)
+        return acl_fct(acl_method(obj, 'can_view_all'), False)
     if tag_name == 'cannot_view_all':
-        return acl_fct(obj.can_view_all, True)
+        return acl_fct(acl_method(obj, 'can_view_all'), True)
     if tag_name == 'can_view_app':
         return acl_fct(
             lambda x: (
-                not any(not sys.modules[o].can_view(x)[0] for o in obj),
+                not any(
+                    not acl_check(x, sys.modules[o], 'can_view')[0]
+                    for o in obj
+                ),
                 None
             ),
             False
@@ -138,7 +147,10 @@ def get_callback(tag_name, obj=None):
     if tag_name == 'cannot_view_app':
         return acl_fct(
             lambda x: (
-                not any(not sys.modules[o].can_view(x)[0] for o in obj),
+                not any(
+                    not acl_check(x, sys.modules[o], 'can_view')[0]
+                    for o in obj
+                ),
                 None
             ),
             True
@@ -155,12 +167,18 @@ def get_callback(tag_name, obj=None):
         )
     if tag_name == 'can_view_any_app':
         return acl_fct(
-            lambda x: (any(sys.modules[o].can_view(x)[0] for o in obj), None),
+            lambda x: (
+                any(acl_check(x, sys.modules[o], 'can_view')[0] for o in obj),
+                None
+            ),
             False
         )
     if tag_name == 'cannot_view_any_app':
         return acl_fct(
-            lambda x: (any(sys.modules[o].can_view(x)[0] for o in obj), None),
+            lambda x: (
+                any(acl_check(x, sys.modules[o], 'can_view')[0] for o in obj),
+                None
+            ),
             True
         )
 
@@ -169,6 +187,19 @@ def get_callback(tag_name, obj=None):
     )
 
 
+def acl_method(obj, method_name):
+    """The acl method `method_name` of obj, memoized for the request (see
+    `re2o.acl.acl_check`)"""
+    # Fail when the tag is compiled rather than when it is rendered
+    getattr(obj, method_name)
+
+    def acl_method_memoized(user, *args, **kwargs):
+        """The memoized can_xxx method"""
+        return acl_check(user, obj, method_name, *args, **kwargs)
+
+    return acl_method_memoized
+
+
 def acl_fct(callback, reverse):
     """Build a function to use as an acl checker"""
 
@@ -259,7 +290,7 @@ def acl_change_filter(parser, token):
         )
 
     model = get_model(model_name)
-    callback = getattr(model, 'can_change_'+field_name)
+    callback = acl_method(model, 'can_change_' + field_name)
 
     # {% can_create %}
     oknodes = parser.parse(('acl_else', 'acl_end'))
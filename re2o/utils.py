@@ -27,83 +27,131 @@ from machines.models import Interface, Machine
 from users.models import Adherent, User, Ban, Whitelist
 from preferences.models import AssoOption
 
-def all_adherent(search_time=None, including_asso=True):
-    """ Fonction renvoyant tous les users adherents. Optimisee pour n'est
-    qu'une seule requete sql
-    Inspecte les factures de l'user et ses cotisation, regarde si elles
-    sont posterieur à now (end_time)"""
-    if search_time is None:
-        search_time = timezone.now()
-    filter_user = (
-        Q(facture__in=Facture.objects.filter(
-            vente__in=Vente.objects.filter(
-                Q(type_cotisation='All') | Q(type_cotisation='Adhesion'),
-                cotisation__in=Cotisation.objects.filter(
-                    vente__in=Vente.objects.filter(
-                        facture__in=Facture.objects.all().exclude(valid=False)
-                    )
-                ).filter(Q(date_start__lt=search_time) & Q(date_end__gt=search_time))
-            )
-        )
-    ))
+def _asso_filter(filter_user, including_asso):
+    """ Ajoute l'utilisateur asso défini dans AssoOption au filtre """
     if including_asso:
         asso_user = AssoOption.get_cached_value('utilisateur_asso')
         if asso_user:
             filter_user |= Q(id=asso_user.id)
-    return User.objects.filter(filter_user).distinct()
+    return filter_user
+
+
+def _cotisation_q(types, search_time):
+    """ Les users ayant une cotisation valide d'un des types couvrant
+    search_time """
+    return Q(facture__in=Facture.objects.filter(
+        vente__in=Vente.objects.filter(
+            cotisation__in=Cotisation.objects.filter(
+                type_cotisation__in=types,
+                vente__in=Vente.objects.filter(
+                    facture__in=Facture.objects.all().exclude(valid=False)
+                )
+            ).filter(Q(date_start__lt=search_time) & Q(date_end__gt=search_time))
+        )
+    ))
+
+
+# Les conditions historiques, à une date donnée, par type de période
+DATED_FILTERS = {
+    'adhesion': lambda search_time: _cotisation_q(
+        ['All', 'Adhesion'], search_time
+    ),
+    'connexion': lambda search_time: _cotisation_q(
+        ['All', 'Connexion'], search_time
+    ),
+    'ban': lambda search_time: Q(ban__in=Ban.objects.filter(
+        Q(date_start__lt=search_time) & Q(date_end__gt=search_time)
+    )),
+    'whitelist': lambda search_time: Q(whitelist__in=Whitelist.objects.filter(
+        Q(date_start__lt=search_time) & Q(date_end__gt=search_time)
+    )),
+}
+
+
+def access_q(kind, now=None, prefix=''):
+    """ La condition "une période kind (adhesion, connexion, ban,
+    whitelist) de l'user atteint par prefix couvre now", lue sur
+    UserAccessState : la dernière période continue couvre now.
+    Si cette période n'a pas encore commencé, une période antérieure peut
+    couvrir now : ces users, peu nombreux (période datée dans le futur),
+    sont vérifiés avec la condition historique, en une requête """
+    now = now or timezone.now()
+    state = prefix + 'access_state__'
+    condition = Q(**{
+        state + 'start_' + kind + '__lt': now,
+        state + 'end_' + kind + '__gt': now,
+    })
+    pending = list(User.objects.filter(
+        DATED_FILTERS[kind](now),
+        **{'access_state__start_' + kind + '__gte': now}
+    ).values_list('pk', flat=True).distinct())
+    if pending:
+        condition |= Q(**{prefix + 'pk__in': pending})
+    return condition
+
+
+def has_access_q(now=None, prefix=''):
+    """ La condition de all_has_access (hors user de l'asso), pour l'user
+    atteint par prefix """
+    now = now or timezone.now()
+    return (
+        Q(**{prefix + 'state': User.STATE_ACTIVE}) &
+        ~access_q('ban', now, prefix) &
+        (access_q('whitelist', now, prefix) |
+         access_q('connexion', now, prefix))
+    )
+
+
+def all_adherent(search_time=None, including_asso=True):
+    """ Fonction renvoyant tous les users adherents.
+    Sans search_time, lit l'état d'accès dénormalisé (UserAccessState),
+    sinon inspecte les factures de l'user et ses cotisations à cette date"""
+    if search_time is None:
+        return User.objects.filter(
+            _asso_filter(access_q('adhesion'), including_asso)
+        )
+    return User.objects.filter(_asso_filter(
+        DATED_FILTERS['adhesion'](search_time), including_asso
+    )).distinct()
 
 
 def all_baned(search_time=None):
     """ Fonction renvoyant tous les users bannis """
     if search_time is None:
-        search_time = timezone.now()
-    return User.objects.filter(
-        ban__in=Ban.objects.filter(
-            Q(date_start__lt=search_time) & Q(date_end__gt=search_time)
-        )
-    ).distinct()
+        return User.objects.filter(access_q('ban'))
+    return User.objects.filter(DATED_FILTERS['ban'](search_time)).distinct()
 
 
 def all_whitelisted(search_time=None):
     """ Fonction renvoyant tous les users whitelistes """
     if search_time is None:
-        search_time = timezone.now()
+        return User.objects.filter(access_q('whitelist'))
     return User.objects.filter(
-        whitelist__in=Whitelist.objects.filter(
-            Q(date_start__lt=search_time) & Q(date_end__gt=search_time)
-        )
+        DATED_FILTERS['whitelist'](search_time)
     ).distinct()
 
 
 def all_has_access(search_time=None, including_asso=True):
     """ Return all connected users : active users and whitelisted +
-    asso_user defined in AssoOption pannel
+    asso_user defined in AssoOption pannel.
+    Without search_time, reads the denormalized UserAccessState table
+    (one join, no subquery), else falls back to the invoices at that date.
     ----
     Renvoie tous les users beneficiant d'une connexion
     : user adherent et whiteliste non banni plus l'utilisateur asso"""
     if search_time is None:
-        search_time = timezone.now()
+        return User.objects.filter(
+            _asso_filter(has_access_q(), including_asso)
+        )
     filter_user = (
         Q(state=User.STATE_ACTIVE) &
-        ~Q(ban__in=Ban.objects.filter(Q(date_start__lt=search_time) & Q(date_end__gt=search_time))) &
-        (Q(whitelist__in=Whitelist.objects.filter(Q(date_start__lt=search_time) & Q(date_end__gt=search_time))) |
-         Q(facture__in=Facture.objects.filter(
-             vente__in=Vente.objects.filter(
-                 cotisation__in=Cotisation.objects.filter(
-                     Q(type_cotisation='All') | Q(type_cotisation='Connexion'),
-                     vente__in=Vente.objects.filter(
-                         facture__in=Facture.objects.all()
-                         .exclude(valid=False)
-                     )
-                 ).filter(Q(date_start__lt=search_time) & Q(date_end__gt=search_time))
-             )
-         )))
+        ~DATED_FILTERS['ban'](search_time) &
+        (DATED_FILTERS['whitelist'](search_time) |
+         DATED_FILTERS['connexion'](search_time))
     )
-    if including_asso:
-        asso_user = AssoOption.get_cached_value('utilisateur_asso')
-        if asso_user:
-            filter_user |= Q(id=asso_user.id)
-    return User.objects.filter(filter_user).distinct()
+    return User.objects.filter(
+        _asso_filter(filter_user, including_asso)
+    ).distinct()
 
 
 def filter_active_interfaces(interface_set):
@@ -0,0 +1,18 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+from django.core.management.base import BaseCommand
+
+from search.models import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search index of users, machines and rooms"
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write("Indexed %d documents" % count)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 11:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def create_trigram_index(apps, schema_editor):
+    """Trigram index on the documents, PostgreSQL only"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX search_searchdocument_text_trgm "
+        "ON search_searchdocument USING gin (text gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "DROP INDEX IF EXISTS search_searchdocument_text_trgm"
+    )
+
+
+def fill_index(apps, schema_editor):
+    """Build the documents of the existing users, machines and rooms"""
+    db_alias = schema_editor.connection.alias
+    SearchDocument = apps.get_model('search', 'SearchDocument')
+    User = apps.get_model('users', 'User')
+    Machine = apps.get_model('machines', 'Machine')
+    Interface = apps.get_model('machines', 'Interface')
+    Domain = apps.get_model('machines', 'Domain')
+    Room = apps.get_model('topologie', 'Room')
+
+    documents = []
+
+    def add(category, object_id, parts):
+        documents.append(SearchDocument(
+            category=category,
+            object_id=object_id,
+            text='\n'.join(str(part).lower() for part in parts if part)
+        ))
+
+    for user in User.objects.using(db_alias).values_list(
+            'pk', 'surname', 'username', 'email', 'telephone',
+            'adherent__name', 'adherent__room__name', 'club__room__name'):
+        add('users', user[0], user[1:])
+
+    machines = {
+        pk: [name] for pk, name in
+        Machine.objects.using(db_alias).values_list('pk', 'name')
+    }
+    for machine, mac, ipv4, domain in (
+            Interface.objects.using(db_alias).values_list(
+                'machine', 'mac_address', 'ipv4__ipv4', 'domain__name')):
+        machines[machine] += [mac, ipv4, domain]
+    for machine, alias in (
+            Domain.objects.using(db_alias)
+            .filter(cname__interface_parent__isnull=False)
+            .values_list('cname__interface_parent__machine', 'name')):
+        machines[machine].append(alias)
+    for pk, parts in machines.items():
+        add('machines', pk, parts)
+
+    for room in Room.objects.using(db_alias).values_list(
+            'pk', 'name', 'details'):
+        add('rooms', room[0], room[1:])
+
+    SearchDocument.objects.using(db_alias).bulk_create(
+        documents,
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('machines', '0005_dnszonecache'),
+        ('topologie', '0002_drop_view_permissions'),
+        ('users', '0003_useraccessstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(choices=[('users', 'Users'), ('machines', 'Machines'), ('rooms', 'Rooms')], max_length=16)),
+                ('object_id', models.PositiveIntegerField()),
+                ('text', models.TextField()),
+            ],
+            options={
+                'verbose_name': 'search document',
+                'verbose_name_plural': 'search documents',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchdocument',
+            unique_together=set([('category', 'object_id')]),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+        migrations.RunPython(fill_index, migrations.RunPython.noop),
+    ]
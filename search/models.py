@@ -0,0 +1,227 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""search.models
+The search index : one denormalized document per user, machine and room,
+holding in lower case every field the search matches on. A word is then
+looked up with a single LIKE on one indexed column (trigram index on
+PostgreSQL) instead of a dozen icontains across joins.
+
+The documents are kept up to date by the signals below, and can be rebuilt
+with the `rebuild_search_index` command.
+"""
+
+from __future__ import unicode_literals
+
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
+
+from machines.models import Domain, Interface, Machine, interfaces_changed
+from topologie.models import Room
+from users.models import Adherent, Club, User
+
+
+class SearchDocument(models.Model):
+    """A searchable document, pointing to an object of a category"""
+
+    USERS = 'users'
+    MACHINES = 'machines'
+    ROOMS = 'rooms'
+    CATEGORIES = (
+        (USERS, _("Users")),
+        (MACHINES, _("Machines")),
+        (ROOMS, _("Rooms")),
+    )
+
+    category = models.CharField(max_length=16, choices=CATEGORIES)
+    object_id = models.PositiveIntegerField()
+    text = models.TextField()
+
+    class Meta:
+        unique_together = (("category", "object_id"),)
+        verbose_name = _("search document")
+        verbose_name_plural = _("search documents")
+
+    @classmethod
+    def matching(cls, category, word):
+        """Subquery of the ids of the objects whose document contains word.
+        The text is stored in lower case so the lookup is a plain LIKE,
+        which the trigram index can serve."""
+        return cls.objects.filter(
+            category=category,
+            text__contains=word.lower()
+        ).values('object_id')
+
+    @classmethod
+    def index(cls, category, object_id, parts):
+        """Create or update the document of an object"""
+        text = '\n'.join(str(part).lower() for part in parts if part)
+        cls.objects.update_or_create(
+            category=category,
+            object_id=object_id,
+            defaults={'text': text}
+        )
+
+    @classmethod
+    def unindex(cls, category, object_ids):
+        """Remove the documents of some objects"""
+        cls.objects.filter(
+            category=category,
+            object_id__in=object_ids
+        ).delete()
+
+    def __str__(self):
+        return "%s %s" % (self.category, self.object_id)
+
+
+def user_document(user):
+    """The searchable fields of a user (adherent or club)"""
+    parts = [user.surname, user.username, user.email, user.telephone]
+    if hasattr(user, 'adherent'):
+        parts += [user.adherent.name, getattr(user.adherent.room, 'name', None)]
+    elif hasattr(user, 'club'):
+        parts.append(getattr(user.club.room, 'name', None))
+    return parts
+
+
+def machine_document(machine):
+    """The searchable fields of a machine"""
+    parts = [machine.name]
+    for interface in machine.interface_set.all():
+        parts += [interface.mac_address, interface.ipv4]
+        try:
+            domain = interface.domain
+        except Domain.DoesNotExist:
+            continue
+        parts.append(domain.name)
+        parts += [alias.name for alias in domain.related_domain.all()]
+    return parts
+
+
+def room_document(room):
+    """The searchable fields of a room"""
+    return [room.name, room.details]
+
+
+def index_users(users):
+    """(Re)index some users"""
+    for user in users.select_related('adherent__room', 'club__room'):
+        SearchDocument.index(
+            SearchDocument.USERS,
+            user.pk,
+            user_document(user)
+        )
+
+
+def index_machines(machines):
+    """(Re)index some machines"""
+    machines = machines.prefetch_related(
+        'interface_set__domain__related_domain',
+        'interface_set__ipv4'
+    )
+    for machine in machines:
+        SearchDocument.index(
+            SearchDocument.MACHINES,
+            machine.pk,
+            machine_document(machine)
+        )
+
+
+def index_rooms(rooms):
+    """(Re)index some rooms"""
+    for room in rooms:
+        SearchDocument.index(
+            SearchDocument.ROOMS,
+            room.pk,
+            room_document(room)
+        )
+
+
+def rebuild_index():
+    """Rebuild the whole index. Returns the number of documents"""
+    with transaction.atomic():
+        SearchDocument.objects.all().delete()
+        index_users(User.objects.all())
+        index_machines(Machine.objects.all())
+        index_rooms(Room.objects.all())
+    return SearchDocument.objects.count()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Adherent)
+@receiver(post_save, sender=Club)
+def user_post_save(**kwargs):
+    """Reindex a user when it is saved"""
+    index_users(User.objects.filter(pk=kwargs['instance'].pk))
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Adherent)
+@receiver(post_delete, sender=Club)
+def user_post_delete(**kwargs):
+    """Unindex a deleted user"""
+    SearchDocument.unindex(SearchDocument.USERS, [kwargs['instance'].pk])
+
+
+@receiver(post_save, sender=Machine)
+def machine_post_save(**kwargs):
+    """Reindex a machine when it is saved"""
+    index_machines(Machine.objects.filter(pk=kwargs['instance'].pk))
+
+
+@receiver(post_delete, sender=Machine)
+def machine_post_delete(**kwargs):
+    """Unindex a deleted machine"""
+    SearchDocument.unindex(SearchDocument.MACHINES, [kwargs['instance'].pk])
+
+
+@receiver(post_save, sender=Domain)
+@receiver(post_delete, sender=Domain)
+def domain_changed(**kwargs):
+    """Reindex the machine of a domain or of the domain it is an alias of"""
+    domain = kwargs['instance']
+    condition = models.Q()
+    if domain.interface_parent_id is not None:
+        condition |= models.Q(interface__pk=domain.interface_parent_id)
+    if domain.cname_id is not None:
+        condition |= models.Q(interface__domain__pk=domain.cname_id)
+    if condition:
+        index_machines(Machine.objects.filter(condition).distinct())
+
+
+@receiver(post_delete, sender=Interface)
+def interface_post_delete(**kwargs):
+    """Reindex the machine of a deleted interface"""
+    index_machines(Machine.objects.filter(
+        pk=kwargs['instance'].machine_id
+    ))
+
+
+@receiver(interfaces_changed)
+def interfaces_changed_receiver(**kwargs):
+    """Reindex the machines of the changed interfaces (mac, ipv4, ...)"""
+    index_machines(Machine.objects.filter(
+        interface__in=kwargs['interface_ids']
+    ).distinct())
+
+
+@receiver(post_save, sender=Room)
+def room_post_save(**kwargs):
+    """Reindex a room and its occupants"""
+    room = kwargs['instance']
+    index_rooms([room])
+    index_users(User.objects.filter(
+        models.Q(adherent__room=room) | models.Q(club__room=room)
+    ))
+
+
+@receiver(post_delete, sender=Room)
+def room_post_delete(**kwargs):
+    """Unindex a deleted room"""
+    SearchDocument.unindex(SearchDocument.ROOMS, [kwargs['instance'].pk])
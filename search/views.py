@@ -12,7 +12,8 @@ Gplv2"""
 
 from __future__ import unicode_literals
 
-from netaddr import EUI, AddrFormatError
+from netaddr import EUI, AddrFormatError, INET_PTON, valid_ipv4
+from macaddress.fields import default_dialect
 
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
@@ -24,6 +25,7 @@ from cotisations.models import Cotisation
 from topologie.models import Port, Switch, Room
 from cotisations.models import Facture
 from preferences.models import GeneralOption
+from search.models import SearchDocument
 from search.forms import (
     SearchForm,
     SearchFormPlus,
@@ -46,6 +48,17 @@ def is_int(variable):
         return True
 
 
+def exact_mac(word):
+    """ Return the normalized MAC address if the word is a full MAC
+    address, None otherwise """
+    if len(word) < 12:
+        return None
+    try:
+        return str(EUI(word, 48, dialect=default_dialect()))
+    except (AddrFormatError, TypeError, ValueError):
+        return None
+
+
 def finish_results(results, col, order):
     """Sort the results by applying filters and then limit them to the
     number of max results. Finally add the info of the nmax number of results
@@ -119,50 +132,33 @@ def search_single_word(word, filters, user,
 
     # Users
     if '0' in aff:
-        filter_users = (
-            Q(
-                surname__icontains=word
-            ) | Q(
-                username__icontains=word
-            ) | Q(
-                room__name__icontains=word
-            ) | Q(
-                email__icontains=word
-            ) | Q(
-                telephone__icontains=word
-            )
+        filter_users = Q(
+            pk__in=SearchDocument.matching(SearchDocument.USERS, word)
         ) & Q(state__in=user_state)
         if not User.can_view_all(user)[0]:
             filter_users &= Q(id=user.id)
-        filter_clubs = filter_users
-        filter_users |= Q(name__icontains=word)
         filters['users'] |= filter_users
-        filters['clubs'] |= filter_clubs
+        filters['clubs'] |= filter_users
 
     # Machines
     if '1' in aff:
-        filter_machines = Q(
-            name__icontains=word
-        ) | (
-            Q(
-                user__username__icontains=word
-            ) & Q(
-                user__state__in=user_state
+        mac_address = exact_mac(word)
+        if mac_address:
+            # Exact MAC address : indexed equality lookup
+            filter_machines = Q(interface__mac_address=mac_address)
+        elif valid_ipv4(word, INET_PTON):
+            # Exact IPv4 : indexed equality lookup
+            filter_machines = Q(interface__ipv4__ipv4=word)
+        else:
+            filter_machines = Q(
+                pk__in=SearchDocument.matching(SearchDocument.MACHINES, word)
+            ) | (
+                Q(
+                    user__username__icontains=word
+                ) & Q(
+                    user__state__in=user_state
+                )
             )
-        ) | Q(
-            interface__domain__name__icontains=word
-        ) | Q(
-            interface__domain__related_domain__name__icontains=word
-        ) | Q(
-            interface__mac_address__icontains=word
-        ) | Q(
-            interface__ipv4__ipv4__icontains=word
-        )
-        try:
-            _mac_addr = EUI(word, 48)
-            filter_machines |= Q(interface__mac_address=word)
-        except AddrFormatError:
-            pass
         if not Machine.can_view_all(user)[0]:
             filter_machines &= Q(user__id=user.id)
         filters['machines'] |= filter_machines
@@ -241,9 +237,7 @@ def search_single_word(word, filters, user,
     # Rooms
     if '5' in aff and Room.can_view_all(user):
         filter_rooms = Q(
-            details__icontains=word
-        ) | Q(
-            name__icontains=word
+            pk__in=SearchDocument.matching(SearchDocument.ROOMS, word)
         ) | Q(
             port__details=word
         )
@@ -272,11 +266,13 @@ def search_single_word(word, filters, user,
 
     # Switches
     if '7' in aff and Switch.can_view_all(user):
+        if valid_ipv4(word, INET_PTON):
+            filter_ipv4 = Q(interface__ipv4__ipv4=word)
+        else:
+            filter_ipv4 = Q(interface__ipv4__ipv4__icontains=word)
         filter_switches = Q(
             interface__domain__name__icontains=word
-        ) | Q(
-            interface__ipv4__ipv4__icontains=word
-        ) | Q(
+        ) | filter_ipv4 | Q(
             switchbay__building__name__icontains=word
         ) | Q(
             stack__name__icontains=word
@@ -0,0 +1,273 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""topologie.graph
+The network topology graph : switches, their uplinks, and the access
+points and servers plugged on them, grouped by building.
+
+The whole adjacency is loaded with a handful of bulk queries into an
+in-memory graph, walked with a set-based traversal, and rendered as DOT
+then PNG. The PNG in the media directory is the cache : when a port, a
+switch, an access point or a building changes, it is rendered again by a
+job (see re2o.models.Job) queued once per transaction with ASYNC_JOBS, or
+else when the index view is next displayed.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import tempfile
+import threading
+from collections import deque
+from subprocess import Popen, PIPE
+
+from django.conf import settings
+from django.db import transaction
+from django.template import Template, loader
+from django.utils.translation import ugettext as _
+
+from machines.models import Interface, Service_link, regen
+from preferences.models import OptionalTopologie
+from re2o.models import Job
+from re2o.settings import MEDIA_ROOT
+
+from .models import AccessPoint, Building, Dormitory, Port, Switch
+
+GRAPH_PATH = os.path.join(MEDIA_ROOT, 'images', 'switchs.png')
+
+COLORS = {
+    'head': "#7f0505",  # Color parameters for the graph
+    'back': "#b5adad",
+    'texte': "#563d01",
+    'border_bornes': "#02078e",
+    'head_bornes': "#25771c",
+    'head_server': "#1c3777"
+}
+
+
+def generate_dot(data, template):
+    """create the dot file
+    :param data: dictionary passed to the template
+    :param template: path to the dot template
+    :return: all the lines of the dot file"""
+    t = loader.get_template(template)
+    if not isinstance(t, Template) and \
+       not (hasattr(t, 'template') and isinstance(t.template, Template)):
+        raise Exception(_("The default Django template isn't used. This can"
+                          " lead to rendering errors. Check the parameters."))
+    return t.render(data)
+
+
+class TopologyGraph(object):
+    """The switches and what is plugged on them, loaded in bulk"""
+
+    def __init__(self):
+        self.switches = list(
+            Switch.objects.select_related(
+                'switchbay',
+                'model__constructor'
+            ).order_by('pk')
+        )
+        self.names = self._machine_names()
+        # Undirected uplink adjacency, and uplink ports of each switch
+        self.adjacency = {switch.pk: set() for switch in self.switches}
+        self.uplinks = {switch.pk: [] for switch in self.switches}
+        self.has_ports = set()
+        for switch_id, port, related_switch in Port.objects.values_list(
+                'switch', 'port', 'related__switch').order_by('pk'):
+            self.has_ports.add(switch_id)
+            if related_switch is None:
+                continue
+            self.uplinks[switch_id].append((port, related_switch))
+            if related_switch != switch_id:
+                self.adjacency[switch_id].add(related_switch)
+                self.adjacency[related_switch].add(switch_id)
+        # First port of each plugged machine (access points and servers)
+        self.plugged = {}
+        for machine_id, switch_id, port in Port.objects.filter(
+                machine_interface__isnull=False
+        ).values_list(
+            'machine_interface__machine', 'switch', 'port'
+        ).order_by('pk'):
+            self.plugged.setdefault(machine_id, (switch_id, port))
+        self.access_points = set(
+            AccessPoint.objects.filter(pk__in=self.plugged.keys())
+            .values_list('pk', flat=True)
+        )
+
+    def _machine_names(self):
+        """Name of every machine : the domain of its first interface, or
+        of its management interface for the switches"""
+        switch_ip_type = OptionalTopologie.get_cached_value('switchs_ip_type')
+        switch_ids = set(Switch.objects.values_list('pk', flat=True))
+        names = {}
+        for machine_id, name, ip_type in Interface.objects.filter(
+                domain__isnull=False
+        ).values_list(
+            'machine', 'domain__name', 'machine_type__ip_type'
+        ).order_by('pk'):
+            if machine_id in switch_ids and switch_ip_type and \
+                    ip_type != switch_ip_type.pk:
+                continue
+            names.setdefault(machine_id, name)
+        return names
+
+    def links(self):
+        """A spanning forest of the uplinks, as (from, to) switch ids.
+        Each connected component is walked once, breadth first"""
+        visited = set()
+        links = []
+        for switch in self.switches:
+            if switch.pk in visited or switch.pk not in self.has_ports:
+                continue
+            visited.add(switch.pk)
+            queue = deque([switch.pk])
+            while queue:
+                current = queue.popleft()
+                for neighbour in sorted(self.adjacency[current] - visited):
+                    visited.add(neighbour)
+                    links.append((current, neighbour))
+                    queue.append(neighbour)
+        return links
+
+    def data(self):
+        """The context of the graph_switch.dot template"""
+        several_dormitories = Dormitory.objects.count() > 1
+        # Switches and plugged machines grouped by building, in one pass
+        switches = {}
+        building_of = {}
+        for switch in self.switches:
+            if switch.switchbay is None:
+                continue
+            building_id = switch.switchbay.building_id
+            building_of[switch.pk] = building_id
+            switches.setdefault(building_id, []).append(switch)
+        plugged = {}
+        for machine_id, (switch_id, port) in sorted(self.plugged.items()):
+            if switch_id in building_of:
+                plugged.setdefault(building_of[switch_id], []).append(
+                    (machine_id, switch_id, port)
+                )
+        subs = []
+        for building in Building.objects.select_related('dormitory'):
+            if several_dormitories:
+                building_name = building.dormitory.name + " : " + building.name
+            else:
+                building_name = building.name
+            sub = {
+                'bat_id': building.id,
+                'bat_name': building_name,
+                'switchs': [],
+                'bornes': [],
+                'machines': []
+            }
+            for switch in switches.get(building.pk, []):
+                sub['switchs'].append({
+                    'name': self.names.get(switch.pk),
+                    'nombre': switch.number,
+                    'model': switch.model,
+                    'id': switch.id,
+                    'batiment': building_name,
+                    'ports': [
+                        {'numero': port, 'related': self.names.get(related)}
+                        for port, related in self.uplinks[switch.pk]
+                    ]
+                })
+            for machine_id, switch_id, port in plugged.get(building.pk, []):
+                key = 'bornes' if machine_id in self.access_points \
+                    else 'machines'
+                sub[key].append({
+                    'name': self.names.get(machine_id),
+                    'switch': self.names.get(switch_id),
+                    'port': port
+                })
+            subs.append(sub)
+        return {
+            'subs': subs,
+            'links': [
+                {'depart': depart, 'arrive': arrive}
+                for depart, arrive in self.links()
+            ],
+            # Switchs that are not connected or not in a building
+            'alone': [
+                {'id': switch.id, 'name': self.names.get(switch.pk)}
+                for switch in self.switches
+                if switch.switchbay is None and not self.uplinks[switch.pk]
+            ],
+            'colors': COLORS,
+        }
+
+    def dot(self):
+        """The DOT source of the graph"""
+        return generate_dot(self.data(), 'topologie/graph_switch.dot')
+
+    def render(self, path=GRAPH_PATH):
+        """Render the graph as a PNG, replacing path atomically once the
+        rendering is complete"""
+        with tempfile.NamedTemporaryFile(
+                mode='w+', encoding='utf-8', suffix='.dot') as dot_file:
+            dot_file.write(self.dot())
+            dot_file.flush()
+            tmp_path = path + '.tmp'
+            unflatten = Popen(  # unflatten the graph to make it look better
+                ["unflatten", "-l", "3", dot_file.name],
+                stdout=PIPE
+            )
+            dot = Popen(  # pipe the result of the first command into the second
+                ["dot", "-Tpng", "-o", tmp_path],
+                stdin=unflatten.stdout,
+            )
+            unflatten.stdout.close()
+            if dot.wait() != 0 or unflatten.wait() != 0:
+                raise RuntimeError("Graphviz failed to render the topology")
+        os.replace(tmp_path, path)
+
+
+# Whether a rendering was asked in the current transaction of the thread
+_pending = threading.local()
+
+
+def _enqueue_render():
+    """Queue the rendering job, once per committed transaction : the
+    callback is registered by every schedule_render, only the first one
+    run at the commit queues the job"""
+    if getattr(_pending, 'render', False):
+        _pending.render = False
+        Job.enqueue('topologie.tasks.render_graph', 'graph_topo')
+
+
+def schedule_render():
+    """Ask for the graph to be rendered again. With ASYNC_JOBS, the job is
+    queued at the commit of the transaction. Otherwise the graph is only
+    rendered when the index view is displayed (see refresh_graph), as a
+    regeneration of the graph_topo service, instead of running graphviz in
+    the request which changed the topology"""
+    if not getattr(settings, 'ASYNC_JOBS', False):
+        regen('graph_topo')
+        return
+    _pending.render = True
+    transaction.on_commit(_enqueue_render)
+
+
+def refresh_graph():
+    """Make sure the graph is up to date when it is displayed : without
+    ASYNC_JOBS it is rendered here if missing or asked for, else the job is
+    queued if the graph is missing"""
+    if getattr(settings, 'ASYNC_JOBS', False):
+        if not os.path.isfile(GRAPH_PATH):
+            schedule_render()
+        return
+    service_links = list(
+        Service_link.objects.select_related('service')
+        .filter(service__service_type='graph_topo')
+    )
+    if os.path.isfile(GRAPH_PATH) and \
+            not any(link.need_regen for link in service_links):
+        return
+    TopologyGraph().render()
+    for link in service_links:
+        link.done_regen()
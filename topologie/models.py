@@ -597,34 +597,18 @@ class Port(AclMixin, RevMixin, models.Model):
 
     @cached_property
     def get_port_profile(self):
-        """Return the config profil for this port
+        """Return the config profil for this port, with at most two small
+        queries, see PortProfileResolver to resolve many ports at once
         :returns: the profile of self (port)"""
-        def profile_or_nothing(profile):
-            port_profile = PortProfile.objects.filter(
-                profil_default=profile).first()
-            if port_profile:
-                return port_profile
-            else:
-                nothing_profile, _created = PortProfile.objects.get_or_create(
-                    profil_default='nothing',
-                    name='nothing',
-                    radius_type='NO'
-                )
-                return nothing_profile
-
-        if self.custom_profile:
+        if self.custom_profile_id:
             return self.custom_profile
-        elif self.related:
-            return profile_or_nothing('uplink')
-        elif self.machine_interface:
-            if hasattr(self.machine_interface.machine, 'accesspoint'):
-                return profile_or_nothing('access_point')
-            else:
-                return profile_or_nothing('asso_machine')
-        elif self.room:
-            return profile_or_nothing('room')
-        else:
-            return profile_or_nothing('nothing')
+        profil_default = PortProfileResolver.profil_default_of(
+            self,
+            lambda machine_id: AccessPoint.objects.filter(
+                pk=machine_id).exists()
+        )
+        return (PortProfile.objects.filter(
+            profil_default=profil_default).first() or nothing_profile())
 
     @classmethod
     def get_instance(cls, portid, *_args, **kwargs):
@@ -849,18 +833,90 @@ class PortProfile(AclMixin, RevMixin, models.Model):
         return self.name
 
 
+def nothing_profile():
+    """Le profil 'nothing', créé au besoin, pour les ports dont le profil
+    par défaut n'est pas défini"""
+    profile, _created = PortProfile.objects.get_or_create(
+        profil_default='nothing',
+        name='nothing',
+        radius_type='NO'
+    )
+    return profile
+
+
+class PortProfileResolver(object):
+    """Résout en mémoire le profil effectif de ports : les profils par
+    défaut sont chargés en une requête, au premier besoin, et les bornes
+    wifi en une autre. A garder le temps d'une requête (ou d'un délai
+    court dans un processus long, cf radius)."""
+
+    def __init__(self):
+        self._defaults = None
+        self._access_points = None
+
+    def default(self, profil_default):
+        """Le profil par défaut d'un type de port, ou le profil
+        'nothing' (créé au besoin) s'il n'est pas défini"""
+        if self._defaults is None:
+            self._defaults = {
+                profile.profil_default: profile
+                for profile in PortProfile.objects.filter(
+                    profil_default__isnull=False
+                ).select_related('vlan_untagged')
+                .prefetch_related('vlan_tagged')
+            }
+        if profil_default not in self._defaults:
+            self._defaults['nothing'] = nothing_profile()
+            return self._defaults['nothing']
+        return self._defaults[profil_default]
+
+    def is_access_point(self, machine_id):
+        """La machine est-elle une borne wifi"""
+        if self._access_points is None:
+            self._access_points = set(
+                AccessPoint.objects.values_list('pk', flat=True)
+            )
+        return machine_id in self._access_points
+
+    @staticmethod
+    def profil_default_of(port, is_access_point):
+        """Le type de profil par défaut d'un port, is_access_point dit si
+        une machine est une borne wifi"""
+        if port.related_id:
+            return 'uplink'
+        elif port.machine_interface_id:
+            if is_access_point(port.machine_interface.machine_id):
+                return 'access_point'
+            else:
+                return 'asso_machine'
+        elif port.room_id:
+            return 'room'
+        else:
+            return 'nothing'
+
+    def resolve(self, port):
+        """Le profil effectif d'un port"""
+        if port.custom_profile_id:
+            return port.custom_profile
+        return self.default(
+            self.profil_default_of(port, self.is_access_point)
+        )
+
+
 @receiver(post_save, sender=AccessPoint)
 def ap_post_save(**_kwargs):
     """Regeneration des noms des bornes vers le controleur"""
+    from .graph import schedule_render
     regen('unifi-ap-names')
-    regen("graph_topo")
+    schedule_render()
 
 
 @receiver(post_delete, sender=AccessPoint)
 def ap_post_delete(**_kwargs):
     """Regeneration des noms des bornes vers le controleur"""
+    from .graph import schedule_render
     regen('unifi-ap-names')
-    regen("graph_topo")
+    schedule_render()
 
 
 @receiver(post_delete, sender=Stack)
@@ -878,5 +934,7 @@ def stack_post_delete(**_kwargs):
 @receiver(post_save, sender=Switch)
 @receiver(post_delete, sender=Switch)
 def switch_post_delete(**_kwargs):
-    regen("graph_topo")
+    """Le graphe de la topologie est à refaire"""
+    from .graph import schedule_render
+    schedule_render()
 
@@ -0,0 +1,19 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""topologie.tasks
+The jobs of the topologie app, run by the worker (see re2o.models.Job).
+"""
+
+from __future__ import unicode_literals
+
+from .graph import TopologyGraph
+
+
+def render_graph():
+    """Render the topology graph in the media directory"""
+    TopologyGraph().render()
@@ -28,11 +28,8 @@ from django.contrib.auth.decorators import login_required
 from django.db import IntegrityError
 from django.db.models import ProtectedError, Prefetch
 from django.core.exceptions import ValidationError
-from django.template import Template, loader
 from django.utils.translation import ugettext as _
 
-import tempfile
-
 from users.views import form
 from re2o.base import (
     re2o_paginator,
@@ -45,7 +42,6 @@ from re2o.acl import (
     can_view,
     can_view_all,
 )
-from re2o.settings import MEDIA_ROOT
 from machines.forms import (
     DomainForm,
     EditInterfaceForm,
@@ -54,7 +50,6 @@ from machines.forms import (
 from machines.views import generate_ipv4_mbf_param
 from machines.models import (
     Interface,
-    Service_link, 
     Vlan
 )
 from preferences.models import AssoOption, GeneralOption
@@ -69,7 +64,6 @@ from .models import (
     SwitchBay,
     Building,
     Dormitory,
-    Server,
     PortProfile,
     ModuleSwitch,
     ModuleOnSwitch,
@@ -91,12 +85,7 @@ from .forms import (
     EditSwitchModuleForm,
 )
 
-from subprocess import (
-    Popen,
-    PIPE
-)
-
-from os.path import isfile
+from .graph import refresh_graph
 
 
 @login_required
@@ -121,18 +110,7 @@ def index(request):
     pagination_number = GeneralOption.get_cached_value('pagination_number')
     switch_list = re2o_paginator(request, switch_list, pagination_number)
 
-    if any(
-        service_link.need_regen
-        for service_link in Service_link.objects.filter(
-            service__service_type='graph_topo')
-    ):
-        make_machine_graph()
-        for service_link in Service_link.objects.filter(
-                service__service_type='graph_topo'):
-            service_link.done_regen()
-
-    if not isfile("/var/www/re2o/media/images/switchs.png"):
-        make_machine_graph()
+    refresh_graph()
     return render(
         request,
         'topologie/index.html',
@@ -1003,160 +981,3 @@ def del_module_on(request, module, **_kwargs):
         'topologie/delete.html',
         request
     )
-
-
-def make_machine_graph():
-    """
-    Create the graph of switchs, machines and access points.
-    """
-    dico = {
-        'subs': [],
-        'links': [],
-        'alone': [],
-        'colors': {
-            'head': "#7f0505",  # Color parameters for the graph
-            'back': "#b5adad",
-            'texte': "#563d01",
-            'border_bornes': "#02078e",
-            'head_bornes': "#25771c",
-            'head_server': "#1c3777"
-        }
-    }
-    missing = list(Switch.objects.all())
-    detected = []
-    for building in Building.objects.all():  # Visit all buildings
-
-        dico['subs'].append(
-            {
-                'bat_id': building.id,
-                'bat_name': building,
-                'switchs': [],
-                'bornes': [],
-                'machines': []
-            }
-        )
-        # Visit all switchs in this building
-        for switch in Switch.objects.filter(switchbay__building=building):
-            dico['subs'][-1]['switchs'].append({
-                'name': switch.main_interface().domain.name,
-                'nombre': switch.number,
-                'model': switch.model,
-                'id': switch.id,
-                'batiment': building,
-                'ports': []
-            })
-            # visit all ports of this switch and add the switchs linked to it
-            for port in switch.ports.filter(related__isnull=False):
-                dico['subs'][-1]['switchs'][-1]['ports'].append({
-                    'numero': port.port,
-                    'related': port.related.switch.main_interface().domain.name
-                })
-
-        for ap in AccessPoint.all_ap_in(building):
-            dico['subs'][-1]['bornes'].append({
-                'name': ap.short_name,
-                'switch': ap.switch()[0].main_interface().domain.name,
-                'port': ap.switch()[0].ports.filter(
-                    machine_interface__machine=ap
-                )[0].port
-            })
-        for server in Server.all_server_in(building):
-            dico['subs'][-1]['machines'].append({
-                'name': server.short_name,
-                'switch': server.switch()[0].main_interface().domain.name,
-                'port': Port.objects.filter(
-                    machine_interface__machine=server
-                )[0].port
-            })
-
-    # While the list of forgotten ones is not empty
-    while missing:
-        if missing[0].ports.count():  # The switch is not empty
-            links, new_detected = recursive_switchs(
-                missing[0], None, [missing[0]])
-            for link in links:
-                dico['links'].append(link)
-            # Update the lists of missings and already detected switchs
-            missing = [i for i in missing if i not in new_detected]
-            detected += new_detected
-        # If the switch have no ports, don't explore it and hop to the next one
-        else:
-            del missing[0]
-    # Switchs that are not connected or not in a building
-    for switch in Switch.objects.filter(
-            switchbay__isnull=True).exclude(ports__related__isnull=False):
-        dico['alone'].append({
-            'id': switch.id,
-            'name': switch.main_interface().domain.name
-        })
-
-    # generate the dot file
-    dot_data = generate_dot(dico, 'topologie/graph_switch.dot')
-
-    # Create a temporary file to store the dot data
-    f = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False)
-    with f:
-        f.write(dot_data)
-    unflatten = Popen(  # unflatten the graph to make it look better
-        ["unflatten", "-l", "3", f.name],
-        stdout=PIPE
-    )
-    Popen(  # pipe the result of the first command into the second
-        ["dot", "-Tpng", "-o", MEDIA_ROOT + "/images/switchs.png"],
-        stdin=unflatten.stdout,
-        stdout=PIPE
-    )
-
-
-def generate_dot(data, template):
-    """create the dot file
-    :param data: dictionary passed to the template
-    :param template: path to the dot template
-    :return: all the lines of the dot file"""
-    t = loader.get_template(template)
-    if not isinstance(t, Template) and \
-       not (hasattr(t, 'template') and isinstance(t.template, Template)):
-        raise Exception(_("The default Django template isn't used. This can"
-                          " lead to rendering errors. Check the parameters."))
-    c = data
-    dot = t.render(c)
-    return(dot)
-
-
-def recursive_switchs(switch_start, switch_before, detected):
-    """Visit the switch and travel to the switchs linked to it.
-    :param switch_start: the switch to begin the visit on
-    :param switch_before: the switch that you come from.
-        None if switch_start is the first one
-    :param detected: list of all switchs already visited.
-        None if switch_start is the first one
-    :return: A list of all the links found and a list of
-        all the switchs visited
-    """
-    detected.append(switch_start)
-    links_return = []  # list of dictionaries of the links to be detected
-    # create links to every switchs below
-    for port in switch_start.ports.filter(related__isnull=False):
-        # Not the switch that we come from, not the current switch
-        if port.related.switch != switch_before \
-                and port.related.switch != port.switch \
-                and port.related.switch not in detected:
-            links = {  # Dictionary of a link
-                'depart': switch_start.id,
-                'arrive': port.related.switch.id
-            }
-            links_return.append(links)  # Add current and below levels links
-
-    # go down on every related switchs
-    for port in switch_start.ports.filter(related__isnull=False):
-        # The switch at the end of this link has not been visited
-        if port.related.switch not in detected:
-            # explore it and get the results
-            links_down, detected = recursive_switchs(
-                port.related.switch, switch_start, detected)
-            # Add the non empty links to the current list
-            for link in links_down:
-                if link:
-                    links_return.append(link)
-    return (links_return, detected)
-
@@ -0,0 +1,506 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""users.importer
+Import en masse d'adhérents (début d'année, listes d'écoles...).
+
+Un lot de lignes (csv ou json) est d'abord validé entièrement, en
+quelques requêtes groupées (usernames et adresses mail déjà pris,
+écoles, bâtiments, chambres, articles), sans rien écrire. Les uid sont
+ensuite réservés en bloc, puis chaque paquet de lignes est inséré en une
+transaction avec des bulk_create : chambres manquantes, users, adhérents,
+adresses mail locales, et si un article est donné factures, ventes et
+cotisations. Les tables filles de l'héritage multi-table (Adherent,
+Facture) sont remplies par un executemany, bulk_create ne les gérant pas.
+
+Les signaux de sauvegarde ne sont pas déclenchés : l'index de recherche
+est mis à jour par paquet, et les effets de bord (ldap, mails de
+bienvenue et de facture, régénération du mailing) sont regroupés en une
+passe, via des jobs portant tous les users importés.
+"""
+
+from __future__ import unicode_literals
+
+import csv
+import json
+import time
+import uuid
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.utils import timezone
+from reversion import revisions as reversion
+
+from cotisations.models import (
+    Article, BaseInvoice, Cotisation, Facture, Paiement, UserBalance, Vente
+)
+from machines.models import coalesce_regen, regen
+from preferences.models import OptionalUser
+from re2o.login import hash_nt
+from re2o.models import Job
+from search.models import index_rooms, index_users
+from topologie.models import Building, Room
+
+from .models import (
+    Adherent, EMailAddress, School, User, UserAccessState,
+    get_fresh_user_uids, linux_user_check
+)
+
+# Colonnes reconnues, les autres sont ignorées
+FIELDS = (
+    'username',
+    'name',
+    'surname',
+    'email',
+    'telephone',
+    'school',
+    'comment',
+    'building',
+    'room',
+    'article',
+    'number',
+    'password',
+)
+REQUIRED = ('username', 'name', 'surname', 'email')
+# Champ du modèle dans lequel chaque colonne texte est enregistrée, pour
+# en vérifier la longueur
+COLUMN_FIELDS = {
+    'username': (User, 'username'),
+    'name': (Adherent, 'name'),
+    'surname': (User, 'surname'),
+    'email': (User, 'email'),
+    'telephone': (User, 'telephone'),
+    'comment': (User, 'comment'),
+    'room': (Room, 'name'),
+}
+
+
+def read_rows(file, fmt='csv'):
+    """Les lignes d'un fichier csv (avec en-tête) ou json (liste
+    d'objets), sous forme de dictionnaires"""
+    if fmt == 'json':
+        rows = json.load(file)
+        if not isinstance(rows, list):
+            raise ValueError("Le json doit être une liste d'objets")
+        return rows
+    return list(csv.DictReader(file))
+
+
+def _insert_ids(model, objects):
+    """bulk_create qui renvoie les pk créées, dans l'ordre des objets. Sans
+    RETURNING, les pk sont relues après la dernière existante : un écart
+    avec le nombre d'objets (insertion concurrente) annule la transaction"""
+    if connection.features.can_return_ids_from_bulk_insert:
+        model.objects.bulk_create(objects, batch_size=1000)
+        return [obj.pk for obj in objects]
+    last = model.objects.order_by('-pk').values_list(
+        'pk', flat=True).first() or 0
+    model.objects.bulk_create(objects, batch_size=1000)
+    ids = list(model.objects.filter(pk__gt=last).order_by('pk')
+               .values_list('pk', flat=True))
+    if len(ids) != len(objects):
+        raise RuntimeError(
+            "Insertion concurrente dans %s" % model._meta.db_table
+        )
+    return ids
+
+
+class UserImport(object):
+    """Un lot d'adhérents à importer.
+
+    validate remplit errors (numéro de ligne, message) sans rien écrire,
+    run importe le lot s'il est valide. progress est appelé après chaque
+    paquet avec le nombre d'users importés, le total et la durée écoulée.
+    Après run, created, invoices, elapsed et rate résument l'import."""
+
+    def __init__(self, rows, payment=None, batch_size=500, mail=True,
+                 revision=True, progress=None):
+        self.rows = [
+            {
+                field: str(row.get(field) or '').strip()
+                for field in FIELDS
+            }
+            for row in rows
+        ]
+        self.payment = payment
+        self.batch_size = batch_size
+        self.mail = mail
+        self.revision = revision
+        self.progress = progress
+        self.errors = []
+        self.plan = []
+        self.created = []
+        self.invoices = []
+        self.elapsed = 0
+
+    @property
+    def rate(self):
+        """Users importés par seconde"""
+        return len(self.created) / self.elapsed if self.elapsed else 0
+
+    def summary(self):
+        """Le résumé de l'import, sérialisable en json"""
+        return {
+            'created': len(self.created),
+            'invoices': len(self.invoices),
+            'elapsed': round(self.elapsed, 3),
+            'rate': round(self.rate, 1),
+        }
+
+    def error(self, line, message):
+        """Note une erreur sur la ligne line (numérotée à partir de 1)"""
+        self.errors.append((line, message))
+
+    def _lookups(self):
+        """Les objets référencés par le lot, en une requête par table"""
+        def values(field):
+            return set(row[field] for row in self.rows if row[field])
+
+        usernames = values('username')
+        lookups = {
+            'usernames': set(User.objects.filter(
+                username__in=usernames
+            ).values_list('username', flat=True)),
+            'local_parts': set(EMailAddress.objects.filter(
+                local_part__in=[username.lower() for username in usernames]
+            ).values_list('local_part', flat=True)),
+            'schools': dict(School.objects.filter(
+                name__in=values('school')
+            ).values_list('name', 'pk')),
+            'articles': {
+                article.name: article
+                for article in Article.objects.filter(
+                    name__in=values('article')
+                )
+            },
+            'buildings': {},
+            'rooms': {},
+            'occupied': set(),
+        }
+        for pk, name in Building.objects.filter(
+                name__in=values('building')
+        ).values_list('pk', 'name'):
+            lookups['buildings'].setdefault(name, []).append(pk)
+        building_ids = [
+            pk for pks in lookups['buildings'].values() for pk in pks
+        ]
+        for pk, building_id, name in Room.objects.filter(
+                building__in=building_ids,
+                name__in=values('room')
+        ).values_list('pk', 'building', 'name'):
+            lookups['rooms'][(building_id, name)] = pk
+        lookups['occupied'] = set(Adherent.objects.filter(
+            room__in=lookups['rooms'].values()
+        ).values_list('room', flat=True))
+        return lookups
+
+    def validate(self):
+        """Vérifie tout le lot, sans rien écrire. Renvoie True si aucune
+        ligne n'est en erreur"""
+        self.errors = []
+        self.plan = []
+        lookups = self._lookups()
+        if isinstance(self.payment, str):
+            self.payment = Paiement.objects.filter(
+                moyen=self.payment).first() or self.payment
+        seen_usernames = set()
+        seen_rooms = set()
+        all_active = OptionalUser.get_cached_value('all_users_active')
+        max_lengths = {
+            column: model._meta.get_field(field).max_length
+            for column, (model, field) in COLUMN_FIELDS.items()
+        }
+        for line, row in enumerate(self.rows, 1):
+            errors = len(self.errors)
+            for field in REQUIRED:
+                if not row[field]:
+                    self.error(line, "Champ %s manquant" % field)
+            for column, max_length in max_lengths.items():
+                if len(row[column]) > max_length:
+                    self.error(
+                        line,
+                        "Champ %s trop long (%d caractères au plus)"
+                        % (column, max_length)
+                    )
+            username = row['username']
+            if username:
+                if not linux_user_check(username):
+                    self.error(line, "Username invalide : %s" % username)
+                elif username in seen_usernames:
+                    self.error(line, "Username en double : %s" % username)
+                elif username in lookups['usernames'] or \
+                        username.lower() in lookups['local_parts']:
+                    self.error(line, "Username déjà pris : %s" % username)
+                seen_usernames.add(username)
+            if row['email']:
+                try:
+                    validate_email(row['email'])
+                except ValidationError:
+                    self.error(line, "Email invalide : %s" % row['email'])
+            school_id = None
+            if row['school']:
+                school_id = lookups['schools'].get(row['school'])
+                if school_id is None:
+                    self.error(line, "École inconnue : %s" % row['school'])
+            room_key = None
+            room_id = None
+            if row['room'] or row['building']:
+                buildings = lookups['buildings'].get(row['building'], [])
+                if not row['room'] or not row['building']:
+                    self.error(line, "Chambre et bâtiment vont ensemble")
+                elif len(buildings) != 1:
+                    self.error(
+                        line,
+                        "Bâtiment inconnu ou ambigu : %s" % row['building']
+                    )
+                else:
+                    room_key = (buildings[0], row['room'])
+                    room_id = lookups['rooms'].get(room_key)
+                    if room_key in seen_rooms:
+                        self.error(line, "Chambre en double : %s" % row['room'])
+                    elif room_id in lookups['occupied']:
+                        self.error(line, "Chambre occupée : %s" % row['room'])
+                    seen_rooms.add(room_key)
+            article = None
+            number = 1
+            if row['article']:
+                article = lookups['articles'].get(row['article'])
+                if article is None:
+                    self.error(line, "Article inconnu : %s" % row['article'])
+                if not isinstance(self.payment, Paiement):
+                    self.error(line, "Moyen de paiement inconnu ou manquant")
+                try:
+                    number = int(row['number'] or 1)
+                    if number < 1:
+                        raise ValueError
+                except ValueError:
+                    self.error(line, "Quantité invalide : %s" % row['number'])
+            if len(self.errors) > errors:
+                continue
+            member = article is not None and \
+                article.type_cotisation in ('All', 'Adhesion')
+            self.plan.append({
+                'row': row,
+                'school_id': school_id,
+                'room_key': room_key,
+                'room_id': room_id,
+                'article': article,
+                'number': number,
+                'state': User.STATE_ACTIVE if member or all_active
+                else User.STATE_NOT_YET_ACTIVE,
+            })
+        return not self.errors
+
+    def _create_rooms(self, chunk):
+        """Crée les chambres manquantes du paquet et renseigne room_id.
+        Renvoie les pk des chambres créées"""
+        missing = set(
+            entry['room_key'] for entry in chunk
+            if entry['room_key'] and entry['room_id'] is None
+        )
+        if not missing:
+            return []
+        Room.objects.bulk_create(
+            [Room(building_id=building_id, name=name)
+             for building_id, name in missing],
+            batch_size=1000
+        )
+        room_ids = {
+            (building_id, name): pk
+            for pk, building_id, name in Room.objects.filter(
+                building__in=set(key[0] for key in missing),
+                name__in=set(key[1] for key in missing)
+            ).values_list('pk', 'building', 'name')
+        }
+        for entry in chunk:
+            if entry['room_key'] in missing:
+                entry['room_id'] = room_ids[entry['room_key']]
+        return [room_ids[key] for key in missing]
+
+    def _create_users(self, chunk, uids):
+        """Insère les users, les adhérents et leurs adresses mail locales.
+        Renvoie les pk des users, dans l'ordre du paquet"""
+        users = []
+        for entry, uid in zip(chunk, uids):
+            row = entry['row']
+            users.append(User(
+                username=row['username'],
+                surname=row['surname'],
+                email=row['email'],
+                telephone=row['telephone'] or None,
+                school_id=entry['school_id'],
+                comment=row['comment'],
+                password=make_password(row['password'] or None),
+                pwd_ntlm=hash_nt(row['password']) if row['password'] else '',
+                state=entry['state'],
+                is_active=True,
+                uid_number=uid,
+            ))
+        User.objects.bulk_create(users, batch_size=1000)
+        ids = dict(User.objects.filter(
+            uid_number__in=uids
+        ).values_list('uid_number', 'pk'))
+        user_ids = [ids[uid] for uid in uids]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO %s (user_ptr_id, name, room_id, gpg_fingerprint)"
+                " VALUES (%%s, %%s, %%s, NULL)" % Adherent._meta.db_table,
+                [
+                    (user_id, entry['row']['name'], entry['room_id'])
+                    for user_id, entry in zip(user_ids, chunk)
+                ]
+            )
+        EMailAddress.objects.bulk_create(
+            [
+                EMailAddress(
+                    user_id=user_id,
+                    local_part=entry['row']['username'].lower()
+                )
+                for user_id, entry in zip(user_ids, chunk)
+            ],
+            batch_size=1000
+        )
+        return user_ids
+
+    def _create_invoices(self, chunk, user_ids):
+        """Insère une facture validée, sa vente et éventuellement sa
+        cotisation pour chaque ligne portant un article"""
+        purchases = [
+            (user_id, entry['article'], entry['number'])
+            for user_id, entry in zip(user_ids, chunk)
+            if entry['article'] is not None
+        ]
+        if not purchases:
+            return []
+        now = timezone.now()
+        invoice_ids = _insert_ids(
+            BaseInvoice, [BaseInvoice() for _purchase in purchases]
+        )
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO %s (baseinvoice_ptr_id, user_id, paiement_id,"
+                " banque_id, cheque, valid, control)"
+                " VALUES (%%s, %%s, %%s, NULL, '', %%s, %%s)"
+                % Facture._meta.db_table,
+                [
+                    (invoice_id, user_id, self.payment.pk, True, False)
+                    for invoice_id, (user_id, _article, _number)
+                    in zip(invoice_ids, purchases)
+                ]
+            )
+        sales = [
+            Vente(
+                facture_id=invoice_id,
+                number=number,
+                name=article.name,
+                prix=article.prix,
+                duration=article.duration,
+                type_cotisation=article.type_cotisation,
+            )
+            for invoice_id, (_user_id, article, number)
+            in zip(invoice_ids, purchases)
+        ]
+        sale_ids = _insert_ids(Vente, sales)
+        Cotisation.objects.bulk_create(
+            [
+                Cotisation(
+                    vente_id=sale_id,
+                    type_cotisation=sale.type_cotisation,
+                    date_start=now,
+                    date_end=now + relativedelta(
+                        months=(sale.duration or 0) * sale.number
+                    ),
+                )
+                for sale_id, sale in zip(sale_ids, sales)
+                if sale.type_cotisation
+            ],
+            batch_size=1000
+        )
+        UserBalance.sync_invoices(invoice_ids)
+        return invoice_ids
+
+    def _import_chunk(self, chunk, uids):
+        """Importe un paquet de lignes, en une transaction"""
+        with transaction.atomic():
+            room_ids = self._create_rooms(chunk)
+            user_ids = self._create_users(chunk, uids)
+            invoice_ids = self._create_invoices(chunk, user_ids)
+            UserAccessState.refresh_users(user_ids)
+            # Les bulk_create n'envoient pas les signaux qui tiennent
+            # l'index de recherche à jour
+            index_rooms(Room.objects.filter(pk__in=room_ids))
+            index_users(User.objects.filter(pk__in=user_ids))
+            if self.revision:
+                with reversion.create_revision():
+                    reversion.set_comment("Import")
+                    for adherent in Adherent.objects.filter(
+                            pk__in=user_ids
+                    ).select_related('user_ptr'):
+                        reversion.add_to_revision(adherent)
+        self.created.extend(user_ids)
+        self.invoices.extend(invoice_ids)
+
+    def defer_side_effects(self):
+        """Les effets de bord des users importés, en une passe : un job de
+        synchronisation ldap, un job de mails de bienvenue et un de mails
+        de facture, et une régénération du mailing"""
+        if not self.created:
+            return
+        key = 'import:%s' % uuid.uuid4().hex
+        Job.enqueue(
+            'users.tasks.ldap_sync_users',
+            key,
+            user_ids=self.created
+        )
+        if self.mail:
+            Job.enqueue(
+                'users.tasks.notif_inscriptions',
+                key,
+                user_ids=self.created
+            )
+            if self.invoices:
+                Job.enqueue(
+                    'cotisations.tasks.mail_invoices',
+                    key,
+                    invoice_ids=self.invoices
+                )
+        regen('mailing')
+
+    def run(self):
+        """Valide puis importe le lot par paquets de batch_size. Renvoie
+        False sans rien écrire si une ligne est en erreur. Si un paquet
+        échoue, l'exception est propagée : hors transaction (commande
+        import_users) les paquets précédents restent importés (created),
+        dans une transaction (API, sous RevisionMiddleware) c'est à
+        l'appelant de l'annuler ou de la valider. Les effets de bord ne
+        partent qu'au commit de ce qui a été importé"""
+        if not self.validate():
+            return False
+        start = time.time()
+        uids = get_fresh_user_uids(len(self.plan))
+        with coalesce_regen():
+            try:
+                for offset in range(0, len(self.plan), self.batch_size):
+                    self._import_chunk(
+                        self.plan[offset:offset + self.batch_size],
+                        uids[offset:offset + self.batch_size]
+                    )
+                    self.elapsed = time.time() - start
+                    if self.progress is not None:
+                        self.progress(
+                            len(self.created), len(self.plan), self.elapsed
+                        )
+            finally:
+                # Sans transaction englobante, les paquets déjà commités
+                # restent importés et leurs effets de bord partent tout de
+                # suite ; sinon au commit, et jamais si elle est annulée
+                transaction.on_commit(self.defer_side_effects)
+        self.elapsed = time.time() - start
+        return True
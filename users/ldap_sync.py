@@ -0,0 +1,189 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""users.ldap_sync
+Synchronisation en masse du ldap à partir de la base sql.
+
+Au lieu d'un `LdapUser.objects.get` puis d'un `save` (qui relit l'entrée)
+par user, les entrées ldap sont chargées par paquets avec une seule
+recherche, comparées aux valeurs attendues calculées en bloc (accès,
+macs, membres des groupes), et seuls les attributs modifiés sont envoyés
+avec un `modify_s` sur la connexion ldap partagée.
+"""
+
+from __future__ import unicode_literals
+
+import sys
+import time
+from collections import defaultdict
+
+import ldap
+from django.db import connections, router
+
+from machines.models import Interface
+from .models import User, ListRight, LdapUser, LdapUserGroup
+
+# Les users présents dans le ldap
+LDAP_STATES = (User.STATE_ACTIVE, User.STATE_ARCHIVE, User.STATE_DISABLED)
+
+
+def _normalize(value):
+    """ Forme comparable d'une valeur ldap : les valeurs vides sont
+    équivalentes, les listes ne sont pas ordonnées"""
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return sorted(str(item) for item in value)
+    return str(value)
+
+
+class LdapSyncEngine(object):
+    """ Calcule le diff entre la base et le ldap et n'envoie que les
+    attributs modifiés.
+
+    Les compteurs `checked`, `created`, `updated` et `attributes` sont
+    remplis au fil des synchronisations, `elapsed` donne la durée totale."""
+
+    def __init__(self, chunk_size=500, dry_run=False):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.connection = connections[router.db_for_write(LdapUser)]
+        self.checked = 0
+        self.created = 0
+        self.updated = 0
+        self.attributes = 0
+        self.elapsed = 0
+
+    @property
+    def touched(self):
+        """ Nombre d'entrées ldap créées ou modifiées """
+        return self.created + self.updated
+
+    def _diff(self, entry, expected):
+        """ Renvoie les champs dont la valeur ldap diffère de expected """
+        return [
+            field for field, value in expected.items()
+            if _normalize(getattr(entry, field)) != _normalize(value)
+        ]
+
+    def _apply(self, entry, expected):
+        """ Envoie les attributs modifiés de l'entrée, en un seul
+        modify_s """
+        changed = self._diff(entry, expected)
+        if not changed:
+            return
+        self.updated += 1
+        self.attributes += len(changed)
+        if self.dry_run:
+            return
+        modlist = []
+        for name in changed:
+            field = entry._meta.get_field(name)
+            values = field.get_db_prep_save(
+                expected[name],
+                connection=self.connection
+            )
+            modlist.append((ldap.MOD_REPLACE, field.db_column, values or None))
+        self.connection.modify_s(entry.dn, modlist)
+
+    def _create(self, entry):
+        """ Crée une entrée absente du ldap """
+        self.created += 1
+        if not self.dry_run:
+            entry.save(using=self.connection.alias)
+
+    def _macs(self, user_ids):
+        """ Les macs de chaque user, en une requête """
+        macs = defaultdict(set)
+        for user_id, mac in Interface.objects.filter(
+                machine__user__in=user_ids
+        ).values_list('machine__user', 'mac_address'):
+            macs[user_id].add(str(mac))
+        return macs
+
+    def _sync_user_chunk(self, users, mac_refresh):
+        """ Synchronise un paquet d'users """
+        entries = {
+            entry.uidNumber: entry
+            for entry in LdapUser.objects.using(self.connection.alias).filter(
+                uidNumber__in=[user.uid_number for user in users]
+            )
+        }
+        macs = self._macs([user.pk for user in users]) if mac_refresh else {}
+        for user in users:
+            self.checked += 1
+            expected = user.ldap_base_attributes()
+            expected['dialupAccess'] = str(user.has_access())
+            entry = entries.get(user.uid_number)
+            if entry is None:
+                if not mac_refresh:
+                    macs.update(self._macs([user.pk]))
+                expected['macs'] = list(macs.get(user.pk, ()))
+                self._create(LdapUser(uidNumber=user.uid_number, **expected))
+                continue
+            if mac_refresh:
+                expected['macs'] = list(macs.get(user.pk, ()))
+            # Les champs calculés par LdapUser.save
+            expected['uid'] = expected['name']
+            expected['sambaSID'] = user.uid_number
+            self._apply(entry, expected)
+
+    def sync_users(self, users=None, mac_refresh=True):
+        """ Synchronise les users (un queryset, tous par défaut) présents
+        dans le ldap """
+        if sys.version_info[0] < 3:
+            return
+        start = time.time()
+        if users is None:
+            users = User.objects.all()
+        users = users.filter(state__in=LDAP_STATES).select_related(
+            'access_state',
+            'shell'
+        ).order_by('pk')
+        chunk = []
+        for user in users.iterator():
+            chunk.append(user)
+            if len(chunk) >= self.chunk_size:
+                self._sync_user_chunk(chunk, mac_refresh)
+                chunk = []
+        if chunk:
+            self._sync_user_chunk(chunk, mac_refresh)
+        self.elapsed += time.time() - start
+
+    def sync_groups(self):
+        """ Synchronise tous les groupes, avec une recherche ldap et une
+        requête pour les membres """
+        if sys.version_info[0] < 3:
+            return
+        start = time.time()
+        entries = {
+            entry.gid: entry
+            for entry in LdapUserGroup.objects.using(self.connection.alias)
+        }
+        members = defaultdict(list)
+        for group_id, username in User.groups.through.objects.values_list(
+                'group_id',
+                'user__username'
+        ):
+            members[group_id].append(username)
+        for right in ListRight.objects.all():
+            self.checked += 1
+            expected = {
+                'name': right.unix_name,
+                'members': members.get(right.pk, []),
+            }
+            entry = entries.get(right.gid)
+            if entry is None:
+                self._create(LdapUserGroup(gid=right.gid, **expected))
+            else:
+                self._apply(entry, expected)
+        self.elapsed += time.time() - start
+
+    def sync_all(self, mac_refresh=True):
+        """ Synchronise tous les users puis tous les groupes """
+        self.sync_users(mac_refresh=mac_refresh)
+        self.sync_groups()
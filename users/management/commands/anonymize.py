@@ -5,6 +5,8 @@ from django.core.management.base import BaseCommand
 from users.models import User, School, Adherent, Club
 from machines.models import Domain, Machine
 from reversion.models import Revision
+from logs.models import ArchivedRevision
+from search.models import rebuild_index
 from django.db.models import F, Value
 from django.db.models import Q
 from django.db.models.functions import Concat
@@ -93,6 +95,13 @@ class Command(BaseCommand):
 
             self.stdout.write('Suppression de l\'historique (This may take some time)')
             Revision.objects.all().delete()
+            # Les versions archivées sont supprimées en cascade
+            ArchivedRevision.objects.all().delete()
+            self.stdout.write(self.style.SUCCESS('done...'))
+
+            self.stdout.write('Reconstruction de l\'index de recherche...')
+            # Les update() ne déclenchent pas les signaux de l'index
+            rebuild_index()
             self.stdout.write(self.style.SUCCESS('done...'))
 
             self.stdout.write("Data anonymized!")
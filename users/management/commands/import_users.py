@@ -0,0 +1,89 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.importer import FIELDS, UserImport, read_rows
+
+
+class Command(BaseCommand):
+    help = ("Importe des adhérents en masse depuis un fichier csv ou json. "
+            "Colonnes : %s" % ', '.join(FIELDS))
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="Fichier csv (avec en-tête) ou json")
+        parser.add_argument(
+            '--format',
+            choices=('csv', 'json'),
+            dest='format',
+            default=None,
+            help="Format du fichier (déduit de l'extension par défaut)",
+        )
+        parser.add_argument(
+            '--payment',
+            dest='payment',
+            default=None,
+            help="Moyen de paiement des factures (colonne article)",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=500,
+            help="Nombre d'users insérés par transaction",
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Valide le fichier sans rien importer",
+        )
+        parser.add_argument(
+            '--no-mail',
+            action='store_false',
+            dest='mail',
+            default=True,
+            help="N'envoie ni les mails de bienvenue ni les factures",
+        )
+
+    def progress(self, done, total, elapsed):
+        self.stdout.write("%d/%d users (%.0f/s)" % (
+            done, total, done / elapsed if elapsed else 0
+        ))
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or (
+            'json' if options['file'].endswith('.json') else 'csv'
+        )
+        try:
+            with open(options['file'], encoding='utf-8') as file:
+                rows = read_rows(file, fmt)
+        except (OSError, ValueError) as error:
+            raise CommandError("Lecture impossible : %s" % error)
+        importer = UserImport(
+            rows,
+            payment=options['payment'],
+            batch_size=options['batch_size'],
+            mail=options['mail'],
+            progress=self.progress
+        )
+        valid = importer.validate() if options['dry_run'] else importer.run()
+        if not valid:
+            for line, message in importer.errors:
+                self.stderr.write("Ligne %d : %s" % (line, message))
+            raise CommandError(
+                "%d erreurs, rien n'a été importé" % len(importer.errors)
+            )
+        if options['dry_run']:
+            self.stdout.write("%d lignes valides" % len(importer.plan))
+            return
+        summary = importer.summary()
+        self.stdout.write(self.style.SUCCESS(
+            "%(created)d users et %(invoices)d factures importés en "
+            "%(elapsed).2fs (%(rate).0f users/s)" % summary
+        ))
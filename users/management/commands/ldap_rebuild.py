@@ -9,7 +9,7 @@ from base64 import decodebytes
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from users.models import User, ListRight
+from users.ldap_sync import LdapSyncEngine
 
 
 def split_lines(lines):
@@ -77,10 +77,7 @@ def flush_ldap(binddn, bindpass, server, usersdn, groupsdn):
 
 def sync_ldap():
     """Syncrhonize the whole LDAP with the DB."""
-    for u in User.objects.all():
-        u.ldap_sync()
-    for lr in ListRight.objects.all():
-        lr.ldap_sync()
+    LdapSyncEngine().sync_all()
 
 
 class Command(BaseCommand):
@@ -7,7 +7,7 @@
 
 from django.core.management.base import BaseCommand, CommandError
 
-from users.models import User
+from users.ldap_sync import LdapSyncEngine
 
 
 class Command(BaseCommand):
@@ -23,7 +23,35 @@ class Command(BaseCommand):
             default=False,
             help='Régénération complète du ldap (y compris des machines)',
         )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Calcule le diff sans rien écrire dans le ldap",
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=500,
+            help="Nombre d'entrées ldap chargées par recherche",
+        )
 
     def handle(self, *args, **options):
-        for usr in User.objects.all():
-            usr.ldap_sync(mac_refresh=options['full'])
+        engine = LdapSyncEngine(
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run']
+        )
+        engine.sync_all(mac_refresh=options['full'])
+        self.stdout.write(
+            "%d entrées vérifiées, %d touchées (%d créées, %d modifiées, "
+            "%d attributs) en %.2fs" % (
+                engine.checked,
+                engine.touched,
+                engine.created,
+                engine.updated,
+                engine.attributes,
+                engine.elapsed
+            )
+        )
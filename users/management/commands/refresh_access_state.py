@@ -0,0 +1,19 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+from django.core.management.base import BaseCommand
+
+from users.models import UserAccessState
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the denormalized access state (end of membership, "
+            "connection, ban and whitelist) of every user")
+
+    def handle(self, *args, **options):
+        count = UserAccessState.refresh_all()
+        self.stdout.write("Refreshed the access state of %d users" % count)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-18 10:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_access_state(apps, schema_editor):
+    """Compute the access state of every user with grouped aggregates"""
+    db_alias = schema_editor.connection.alias
+    UserAccessState = apps.get_model('users', 'UserAccessState')
+    Ban = apps.get_model('users', 'Ban')
+    Whitelist = apps.get_model('users', 'Whitelist')
+    Cotisation = apps.get_model('cotisations', 'Cotisation')
+    valid_cotisations = Cotisation.objects.using(db_alias).filter(
+        vente__facture__facture__valid=True
+    )
+    ends = {}
+
+    def collect(field, queryset, user_field):
+        for row in (queryset.values(user_field)
+                    .annotate(end=models.Max('date_end'))):
+            ends.setdefault(row[user_field], {})[field] = row['end']
+
+    collect(
+        'end_adhesion',
+        valid_cotisations.filter(type_cotisation__in=['All', 'Adhesion']),
+        'vente__facture__facture__user'
+    )
+    collect(
+        'end_connexion',
+        valid_cotisations.filter(type_cotisation__in=['All', 'Connexion']),
+        'vente__facture__facture__user'
+    )
+    collect('end_ban', Ban.objects.using(db_alias).all(), 'user')
+    collect('end_whitelist', Whitelist.objects.using(db_alias).all(), 'user')
+    UserAccessState.objects.using(db_alias).bulk_create(
+        [
+            UserAccessState(user_id=user_id, **dates)
+            for user_id, dates in ends.items()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cotisations', '0003_drop_view_permissions'),
+        ('users', '0002_drop_view_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserAccessState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='access_state', serialize=False, to='users.User')),
+                ('end_adhesion', models.DateTimeField(db_index=True, null=True)),
+                ('end_connexion', models.DateTimeField(db_index=True, null=True)),
+                ('end_ban', models.DateTimeField(db_index=True, null=True)),
+                ('end_whitelist', models.DateTimeField(db_index=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'user access state',
+                'verbose_name_plural': 'user access states',
+            },
+        ),
+        migrations.RunPython(fill_access_state, migrations.RunPython.noop),
+    ]
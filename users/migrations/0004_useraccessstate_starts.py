@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-19 09:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def last_period(intervals):
+    """The last continuous period of (start, end) intervals"""
+    start = end = None
+    for interval_start, interval_end in sorted(intervals):
+        if end is None or interval_start > end:
+            start = interval_start
+        end = interval_end if end is None else max(end, interval_end)
+    return start, end
+
+
+def fill_starts(apps, schema_editor):
+    """Compute the bounds of the last period of every user"""
+    db_alias = schema_editor.connection.alias
+    UserAccessState = apps.get_model('users', 'UserAccessState')
+    Ban = apps.get_model('users', 'Ban')
+    Whitelist = apps.get_model('users', 'Whitelist')
+    Cotisation = apps.get_model('cotisations', 'Cotisation')
+    valid_cotisations = Cotisation.objects.using(db_alias).filter(
+        vente__facture__facture__valid=True
+    )
+    dates = {}
+
+    def collect(kind, queryset, user_field):
+        intervals = {}
+        for user_id, start, end in queryset.values_list(
+                user_field, 'date_start', 'date_end').iterator():
+            intervals.setdefault(user_id, []).append((start, end))
+        for user_id, user_intervals in intervals.items():
+            start, end = last_period(user_intervals)
+            user_dates = dates.setdefault(user_id, {})
+            user_dates['start_' + kind] = start
+            user_dates['end_' + kind] = end
+
+    collect(
+        'adhesion',
+        valid_cotisations.filter(type_cotisation__in=['All', 'Adhesion']),
+        'vente__facture__facture__user'
+    )
+    collect(
+        'connexion',
+        valid_cotisations.filter(type_cotisation__in=['All', 'Connexion']),
+        'vente__facture__facture__user'
+    )
+    collect('ban', Ban.objects.using(db_alias).all(), 'user')
+    collect('whitelist', Whitelist.objects.using(db_alias).all(), 'user')
+    UserAccessState.objects.using(db_alias).all().delete()
+    UserAccessState.objects.using(db_alias).bulk_create(
+        [
+            UserAccessState(user_id=user_id, **user_dates)
+            for user_id, user_dates in dates.items()
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_useraccessstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useraccessstate',
+            name='start_adhesion',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='useraccessstate',
+            name='start_ban',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='useraccessstate',
+            name='start_connexion',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='useraccessstate',
+            name='start_whitelist',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_starts, migrations.RunPython.noop),
+    ]
@@ -63,9 +63,10 @@ from re2o.settings import LDAP, GID_RANGES, UID_RANGES
 from re2o.field_permissions import FieldPermissionModelMixin
 from re2o.mixins import AclMixin, RevMixin
 from re2o.base import smtp_check
+from re2o.models import Job
 
-from cotisations.models import Cotisation, Facture, Paiement, Vente
-from machines.models import Domain, Interface, Machine, regen
+from cotisations.models import Cotisation, UserBalance
+from machines.models import Domain, Interface, InterfaceChange, Machine, regen
 from preferences.models import GeneralOption, AssoOption, OptionalUser
 from preferences.models import OptionalMachine, MailMessageOption
 
@@ -103,6 +104,25 @@ def get_fresh_user_uid():
     return min(free_uids)
 
 
+def get_fresh_user_uids(count):
+    """ Renvoie les count plus petits uid non pris, en une requête """
+    low = int(min(UID_RANGES['users']))
+    high = int(max(UID_RANGES['users']))
+    used_uids = set(User.objects.filter(
+        uid_number__gte=low,
+        uid_number__lt=high
+    ).values_list('uid_number', flat=True))
+    free_uids = []
+    for uid in range(low, high):
+        if len(free_uids) == count:
+            break
+        if uid not in used_uids:
+            free_uids.append(uid)
+    if len(free_uids) < count:
+        raise ValueError("Not enough free uids left in UID_RANGES['users']")
+    return free_uids
+
+
 def get_fresh_gid():
     """ Renvoie le plus petit gid libre  """
     gids = list(range(
@@ -349,137 +369,92 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
         else:
             return None
 
+    def refresh_access_state(self):
+        """ Recalcule l'état d'accès dénormalisé de l'user. Appelé par les
+        signaux des cotisations, factures, bans et whitelists"""
+        state = UserAccessState.refresh(self)
+        self.access_state = state
+        self.log_interface_changes()
+        return state
+
+    def log_interface_changes(self):
+        """ Note toutes les interfaces de l'user comme modifiées, pour
+        l'export dhcp incrémental"""
+        InterfaceChange.log(
+            Interface.objects.filter(machine__user=self)
+            .values_list('pk', flat=True)
+        )
+
+    @classmethod
+    def mass_refresh_access_state(cls, user_ids):
+        """ Recalcule l'état d'accès de plusieurs users en bloc, cf
+        refresh_access_state"""
+        user_ids = list(user_ids)
+        UserAccessState.refresh_users(user_ids)
+        InterfaceChange.log(
+            Interface.objects.filter(machine__user__in=user_ids)
+            .values_list('pk', flat=True)
+        )
+
+    def get_access_state(self):
+        """ Renvoie l'état d'accès de l'user, calculé à la volée s'il
+        n'existe pas encore"""
+        try:
+            return self.access_state
+        except UserAccessState.DoesNotExist:
+            return self.refresh_access_state()
+
     def end_adhesion(self):
-        """ Renvoie la date de fin d'adhésion d'un user. Examine les objets
-        cotisation"""
-        date_max = Cotisation.objects.filter(
-            vente__in=Vente.objects.filter(
-                facture__in=Facture.objects.filter(
-                    user=self
-                ).exclude(valid=False)
-            )
-        ).filter(
-            Q(type_cotisation='All') | Q(type_cotisation='Adhesion')
-        ).aggregate(models.Max('date_end'))['date_end__max']
-        return date_max
+        """ Renvoie la date de fin d'adhésion d'un user"""
+        return self.get_access_state().end_adhesion
 
     def end_connexion(self):
-        """ Renvoie la date de fin de connexion d'un user. Examine les objets
-        cotisation"""
-        date_max = Cotisation.objects.filter(
-            vente__in=Vente.objects.filter(
-                facture__in=Facture.objects.filter(
-                    user=self
-                ).exclude(valid=False)
-            )
-        ).filter(
-            Q(type_cotisation='All') | Q(type_cotisation='Connexion')
-        ).aggregate(models.Max('date_end'))['date_end__max']
-        return date_max
+        """ Renvoie la date de fin de connexion d'un user"""
+        return self.get_access_state().end_connexion
 
     def is_adherent(self):
         """ Renvoie True si l'user est adhérent : si
         self.end_adhesion()>now"""
-        end = self.end_adhesion()
-        if not end:
-            return False
-        elif end < timezone.now():
-            return False
-        else:
-            return True
+        return self.get_access_state().is_adherent()
 
     def is_connected(self):
         """ Renvoie True si l'user est adhérent : si
         self.end_adhesion()>now et end_connexion>now"""
-        end = self.end_connexion()
-        if not end:
-            return False
-        elif end < timezone.now():
-            return False
-        else:
-            return self.is_adherent()
+        return self.get_access_state().is_connected()
 
     def end_ban(self):
         """ Renvoie la date de fin de ban d'un user, False sinon """
-        date_max = Ban.objects.filter(
-            user=self
-        ).aggregate(models.Max('date_end'))['date_end__max']
-        return date_max
+        return self.get_access_state().end_ban
 
     def end_whitelist(self):
         """ Renvoie la date de fin de whitelist d'un user, False sinon """
-        date_max = Whitelist.objects.filter(
-            user=self
-        ).aggregate(models.Max('date_end'))['date_end__max']
-        return date_max
+        return self.get_access_state().end_whitelist
 
     def is_ban(self):
         """ Renvoie si un user est banni ou non """
-        end = self.end_ban()
-        if not end:
-            return False
-        elif end < timezone.now():
-            return False
-        else:
-            return True
+        return self.get_access_state().is_ban()
 
     def is_whitelisted(self):
         """ Renvoie si un user est whitelisté ou non """
-        end = self.end_whitelist()
-        if not end:
-            return False
-        elif end < timezone.now():
-            return False
-        else:
-            return True
+        return self.get_access_state().is_whitelisted()
 
     def has_access(self):
         """ Renvoie si un utilisateur a accès à internet """
+        state = self.get_access_state()
         return (self.state == User.STATE_ACTIVE and
-                not self.is_ban() and
-                (self.is_connected() or self.is_whitelisted())) \
+                not state.is_ban() and
+                (state.is_connected() or state.is_whitelisted())) \
                 or self == AssoOption.get_cached_value('utilisateur_asso')
 
     def end_access(self):
         """ Renvoie la date de fin normale d'accès (adhésion ou whiteliste)"""
-        if not self.end_connexion():
-            if not self.end_whitelist():
-                return None
-            else:
-                return self.end_whitelist()
-        else:
-            if not self.end_whitelist():
-                return self.end_connexion()
-            else:
-                return max(self.end_connexion(), self.end_whitelist())
+        return self.get_access_state().end_access()
 
     @cached_property
     def solde(self):
-        """ Renvoie le solde d'un user.
-        Somme les crédits de solde et retire les débit payés par solde"""
-        solde_objects = Paiement.objects.filter(is_balance=True)
-        somme_debit = Vente.objects.filter(
-            facture__in=Facture.objects.filter(
-                user=self,
-                paiement__in=solde_objects,
-                valid=True
-            )
-        ).aggregate(
-            total=models.Sum(
-                models.F('prix')*models.F('number'),
-                output_field=models.DecimalField()
-            )
-        )['total'] or 0
-        somme_credit = Vente.objects.filter(
-            facture__in=Facture.objects.filter(user=self, valid=True),
-            name='solde'
-        ).aggregate(
-            total=models.Sum(
-                models.F('prix')*models.F('number'),
-                output_field=models.DecimalField()
-            )
-        )['total'] or 0
-        return somme_credit - somme_debit
+        """ Renvoie le solde d'un user, tenu par son journal de solde
+        (cf cotisations.models.UserBalance)"""
+        return UserBalance.current(self.pk)
 
     @classmethod
     def users_interfaces(cls, users, active=True, all_interfaces=False):
@@ -550,8 +525,11 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
         #Force eval of queryset
         bool(users_list)
         users_list = users_list.all()
+        user_ids = list(users_list.values_list('pk', flat=True))
         cls.mass_unassign_ips(users_list)
         users_list.update(state=User.STATE_ARCHIVE)
+        from .ldap_sync import LdapSyncEngine
+        LdapSyncEngine().sync_users(User.objects.filter(pk__in=user_ids))
 
     @classmethod
     def mass_full_archive(cls, users_list):
@@ -581,6 +559,8 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
 
     def state_sync(self):
         """Archive, or unarchive, if the user was not active/or archived before"""
+        if self.__original_state != self.state:
+            self.log_interface_changes()
         if self.__original_state != self.STATE_ACTIVE  and self.state == self.STATE_ACTIVE:
             self.unarchive()
         elif self.__original_state != self.STATE_ARCHIVE and self.state == self.STATE_ARCHIVE:
@@ -588,6 +568,35 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
         elif self.__original_state != self.STATE_FULL_ARCHIVE and self.state == self.STATE_FULL_ARCHIVE:
             self.full_archive()
 
+    def ldap_base_attributes(self):
+        """ Renvoie les attributs de base de l'entrée ldap de l'user (nom,
+        prenom, mail, password, shell, home), indexés par champ de
+        LdapUser"""
+        attributes = {
+            'name': self.username,
+            'sn': self.username,
+            'home_directory': self.home_directory,
+            'mail': self.get_mail,
+            'given_name': self.surname.lower() + '_' + self.name.lower()[:3],
+            'gid': LDAP['user_gid'],
+            'sambat_nt_password': self.pwd_ntlm.upper(),
+            'shadowexpire': self.get_shadow_expire,
+        }
+        if '{SSHA}' in self.password or '{SMD5}' in self.password:
+            # We remove the extra $ added at import from ldap
+            attributes['user_password'] = self.password[:6] + \
+                self.password[7:]
+        elif '{crypt}' in self.password:
+            # depending on the length, we need to remove or not a $
+            if len(self.password) == 41:
+                attributes['user_password'] = self.password
+            else:
+                attributes['user_password'] = self.password[:7] + \
+                    self.password[8:]
+        if self.get_shell:
+            attributes['login_shell'] = str(self.get_shell)
+        return attributes
+
     def ldap_sync(self, base=True, access_refresh=True, mac_refresh=True,
                   group_refresh=False):
         """ Synchronisation du ldap. Synchronise dans le ldap les attributs de
@@ -609,30 +618,8 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
                 access_refresh = True
                 mac_refresh = True
             if base:
-                user_ldap.name = self.username
-                user_ldap.sn = self.username
-                user_ldap.dialupAccess = str(self.has_access())
-                user_ldap.home_directory = self.home_directory
-                user_ldap.mail = self.get_mail
-                user_ldap.given_name = self.surname.lower() + '_'\
-                    + self.name.lower()[:3]
-                user_ldap.gid = LDAP['user_gid']
-                if '{SSHA}' in self.password or '{SMD5}' in self.password:
-                    # We remove the extra $ added at import from ldap
-                    user_ldap.user_password = self.password[:6] + \
-                        self.password[7:]
-                elif '{crypt}' in self.password:
-                    # depending on the length, we need to remove or not a $
-                    if len(self.password) == 41:
-                        user_ldap.user_password = self.password
-                    else:
-                        user_ldap.user_password = self.password[:7] + \
-                            self.password[8:]
-
-                user_ldap.sambat_nt_password = self.pwd_ntlm.upper()
-                if self.get_shell:
-                    user_ldap.login_shell = str(self.get_shell)
-                user_ldap.shadowexpire = self.get_shadow_expire
+                for field, value in self.ldap_base_attributes().items():
+                    setattr(user_ldap, field, value)
             if access_refresh:
                 user_ldap.dialupAccess = str(self.has_access())
             if mac_refresh:
@@ -643,11 +630,24 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
                 # Need to refresh all groups because we don't know which groups
                 # were updated during edition of groups and the user may no longer
                 # be part of the updated group (case of group removal)
-                for group in Group.objects.all():
-                    if hasattr(group, 'listright'):
-                        group.listright.ldap_sync()
+                from .ldap_sync import LdapSyncEngine
+                LdapSyncEngine().sync_groups()
             user_ldap.save()
 
+    def ldap_sync_later(self, base=True, access_refresh=True,
+                        mac_refresh=True, group_refresh=False):
+        """ Met en file la synchronisation ldap de l'user, avec les mêmes
+        options que ldap_sync (cf re2o.models.Job)"""
+        Job.enqueue(
+            'users.tasks.ldap_sync_user',
+            'user:%d' % self.pk,
+            user_id=self.pk,
+            base=base,
+            access_refresh=access_refresh,
+            mac_refresh=mac_refresh,
+            group_refresh=group_refresh
+        )
+
     def ldap_del(self):
         """ Supprime la version ldap de l'user"""
         try:
@@ -695,28 +695,39 @@ class User(RevMixin, FieldPermissionModelMixin, AbstractBaseUser,
             return False, _("Re2o doesn't know wich machine type to assign.")
         machine_type_cible = nas_type.machine_type
         try:
-            machine_parent = Machine()
-            machine_parent.user = self
-            interface_cible = Interface()
-            interface_cible.mac_address = mac_address
-            interface_cible.type = machine_type_cible
-            interface_cible.clean()
-            machine_parent.clean()
-            domain = Domain()
-            domain.name = self.get_next_domain_name()
-            domain.interface_parent = interface_cible
-            domain.clean()
-            machine_parent.save()
-            interface_cible.machine = machine_parent
-            interface_cible.save()
-            domain.interface_parent = interface_cible
-            domain.clean()
-            domain.save()
+            with transaction.atomic():
+                interface_cible = self._autoregister_interface(
+                    mac_address,
+                    machine_type_cible
+                )
             self.notif_auto_newmachine(interface_cible)
         except Exception as error:
             return False,  traceback.format_exc()
         return interface_cible, _("OK")
 
+    def _autoregister_interface(self, mac_address, machine_type_cible):
+        """ Crée la machine, l'interface et le domaine d'une mac capturée.
+        A appeler dans une transaction : l'ip assignée par Interface.clean
+        reste verrouillée jusqu'à l'enregistrement de l'interface """
+        machine_parent = Machine()
+        machine_parent.user = self
+        interface_cible = Interface()
+        interface_cible.mac_address = mac_address
+        interface_cible.machine_type = machine_type_cible
+        interface_cible.clean()
+        machine_parent.clean()
+        domain = Domain()
+        domain.name = self.get_next_domain_name()
+        domain.interface_parent = interface_cible
+        domain.clean()
+        machine_parent.save()
+        interface_cible.machine = machine_parent
+        interface_cible.save()
+        domain.interface_parent = interface_cible
+        domain.clean()
+        domain.save()
+        return interface_cible
+
     def notif_auto_newmachine(self, interface):
         """Notification mail lorsque une machine est automatiquement
         ajoutée par le radius"""
@@ -1099,6 +1110,20 @@ class Adherent(User):
                     _("You don't have the right to create a user.")
                 )
 
+    @staticmethod
+    def can_import(user_request, *_args, **_kwargs):
+        """Check if an user can import members in bulk, with their
+        invoices (see `users.importer.UserImport`).
+
+        :param user_request: The user who wants to import members.
+        :return: a message and a boolean which is True if the user can
+            create users and invoices.
+        """
+        if (user_request.has_perm('users.add_user') and
+                user_request.has_perm('cotisations.add_facture')):
+            return True, None
+        return False, _("You don't have the right to import users.")
+
     def clean(self, *args, **kwargs):
         """Format the GPG fingerprint"""
         super(Adherent, self).clean(*args, **kwargs)
@@ -1193,9 +1218,13 @@ def user_post_save(**kwargs):
     EMailAddress.objects.get_or_create(
         local_part=user.username.lower(), user=user)
     if is_created:
-        user.notif_inscription()
+        Job.enqueue(
+            'users.tasks.notif_inscription',
+            'user:%d' % user.pk,
+            user_id=user.pk
+        )
     user.state_sync()
-    user.ldap_sync(
+    user.ldap_sync_later(
         base=True,
         access_refresh=True,
         mac_refresh=False,
@@ -1209,10 +1238,10 @@ def user_group_relation_changed(**kwargs):
     action = kwargs['action']
     if action in ('post_add', 'post_remove', 'post_clear'):
         user = kwargs['instance']
-        user.ldap_sync(base=False,
-                       access_refresh=False,
-                       mac_refresh=False,
-                       group_refresh=True)
+        user.ldap_sync_later(base=False,
+                             access_refresh=False,
+                             mac_refresh=False,
+                             group_refresh=True)
 
 
 @receiver(post_delete, sender=Adherent)
@@ -1499,10 +1528,11 @@ def ban_post_save(**kwargs):
     ban = kwargs['instance']
     is_created = kwargs['created']
     user = ban.user
-    user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+    user.refresh_access_state()
+    user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
     regen('mailing')
     if is_created:
-        ban.notif_ban()
+        Job.enqueue('users.tasks.notif_ban', 'ban:%d' % ban.pk, ban_id=ban.pk)
         regen('dhcp')
         regen('mac_ip_list')
     if user.has_access():
@@ -1514,7 +1544,8 @@ def ban_post_save(**kwargs):
 def ban_post_delete(**kwargs):
     """ Regen de tous les services après suppression d'un ban"""
     user = kwargs['instance'].user
-    user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+    user.refresh_access_state()
+    user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
     regen('mailing')
     regen('dhcp')
     regen('mac_ip_list')
@@ -1576,7 +1607,8 @@ def whitelist_post_save(**kwargs):
     et on lui permet d'avoir internet"""
     whitelist = kwargs['instance']
     user = whitelist.user
-    user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+    user.refresh_access_state()
+    user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
     is_created = kwargs['created']
     regen('mailing')
     if is_created:
@@ -1592,12 +1624,192 @@ def whitelist_post_delete(**kwargs):
     """Après suppression d'une whitelist, on supprime l'accès internet
     en forçant la régénration"""
     user = kwargs['instance'].user
-    user.ldap_sync(base=False, access_refresh=True, mac_refresh=False)
+    user.refresh_access_state()
+    user.ldap_sync_later(base=False, access_refresh=True, mac_refresh=False)
     regen('mailing')
     regen('dhcp')
     regen('mac_ip_list')
 
 
+def last_period(intervals):
+    """La dernière période continue d'intervalles (début, fin) : les
+    intervalles qui se chevauchent sont fusionnés. Renvoie (début, fin),
+    (None, None) s'il n'y a aucun intervalle"""
+    start = end = None
+    for interval_start, interval_end in sorted(intervals):
+        if end is None or interval_start > end:
+            start = interval_start
+        end = interval_end if end is None else max(end, interval_end)
+    return start, end
+
+
+class UserAccessState(models.Model):
+    """État d'accès dénormalisé d'un user : pour l'adhésion, la connexion,
+    les bans et les whitelists, le début et la fin de la dernière période
+    continue. Tenu à jour par les signaux des cotisations, factures, bans
+    et whitelists, pour que les tests d'accès se limitent à une lecture
+    par clef primaire.
+
+    La fin est celle de la dernière cotisation (ban, whitelist) ; le début
+    permet de ne pas compter une période future, ni un trou entre deux
+    périodes (cf re2o.utils.access_q)."""
+
+    KINDS = ('adhesion', 'connexion', 'ban', 'whitelist')
+    DATE_FIELDS = tuple(
+        prefix + kind for kind in KINDS for prefix in ('start_', 'end_')
+    )
+
+    user = models.OneToOneField(
+        'User',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='access_state',
+    )
+    start_adhesion = models.DateTimeField(null=True, db_index=True)
+    end_adhesion = models.DateTimeField(null=True, db_index=True)
+    start_connexion = models.DateTimeField(null=True, db_index=True)
+    end_connexion = models.DateTimeField(null=True, db_index=True)
+    start_ban = models.DateTimeField(null=True, db_index=True)
+    end_ban = models.DateTimeField(null=True, db_index=True)
+    start_whitelist = models.DateTimeField(null=True, db_index=True)
+    end_whitelist = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("user access state")
+        verbose_name_plural = _("user access states")
+
+    @classmethod
+    def refresh(cls, user):
+        """Recalcule les dates d'un user et les enregistre"""
+        dates = cls._ends([user.pk]).get(user.pk, {})
+        state, _created = cls.objects.update_or_create(
+            user=user,
+            defaults={
+                field: dates.get(field) for field in cls.DATE_FIELDS
+            }
+        )
+        return state
+
+    @classmethod
+    def _ends(cls, user_ids=None):
+        """Les dates de début et de fin par user (restreint à user_ids si
+        donné), avec une requête par type de période plutôt qu'une par
+        user"""
+        valid_cotisations = Cotisation.objects.filter(
+            vente__facture__facture__valid=True
+        )
+        bans = Ban.objects.all()
+        whitelists = Whitelist.objects.all()
+        if user_ids is not None:
+            valid_cotisations = valid_cotisations.filter(
+                vente__facture__facture__user__in=user_ids
+            )
+            bans = bans.filter(user__in=user_ids)
+            whitelists = whitelists.filter(user__in=user_ids)
+        ends = {}
+
+        def collect(kind, queryset, user_field):
+            """Range la dernière période continue de chaque user dans
+            ends"""
+            intervals = {}
+            for user_id, start, end in queryset.values_list(
+                    user_field, 'date_start', 'date_end').iterator():
+                intervals.setdefault(user_id, []).append((start, end))
+            for user_id, user_intervals in intervals.items():
+                start, end = last_period(user_intervals)
+                dates = ends.setdefault(user_id, {})
+                dates['start_' + kind] = start
+                dates['end_' + kind] = end
+
+        collect(
+            'adhesion',
+            valid_cotisations.filter(type_cotisation__in=['All', 'Adhesion']),
+            'vente__facture__facture__user'
+        )
+        collect(
+            'connexion',
+            valid_cotisations.filter(type_cotisation__in=['All', 'Connexion']),
+            'vente__facture__facture__user'
+        )
+        collect('ban', bans, 'user')
+        collect('whitelist', whitelists, 'user')
+        return ends
+
+    @classmethod
+    def bounds_between_q(cls, since, until, prefix='access_state__'):
+        """Condition sur les users dont une période a commencé ou fini
+        entre since et until : leur accès a changé sans aucun signal"""
+        condition = Q()
+        for field in cls.DATE_FIELDS:
+            condition |= Q(**{prefix + field + '__range': (since, until)})
+        return condition
+
+    @classmethod
+    def refresh_all(cls):
+        """Reconstruit la table pour tous les users. Les users sans
+        cotisation, ban ni whitelist n'ont pas de ligne, elle est créée à la
+        volée"""
+        ends = cls._ends()
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(
+                [
+                    cls(user_id=user_id, **dates)
+                    for user_id, dates in ends.items()
+                ],
+                batch_size=1000
+            )
+        return len(ends)
+
+    @classmethod
+    def refresh_users(cls, user_ids):
+        """Recalcule les dates de plusieurs users en quatre requêtes, au
+        lieu de refresh pour chacun"""
+        user_ids = list(user_ids)
+        ends = cls._ends(user_ids)
+        with transaction.atomic():
+            cls.objects.filter(user__in=user_ids).delete()
+            cls.objects.bulk_create(
+                [
+                    cls(user_id=user_id, **ends.get(user_id, {}))
+                    for user_id in user_ids
+                ],
+                batch_size=1000
+            )
+        return len(user_ids)
+
+    @staticmethod
+    def _is_future(date):
+        """ La date existe et n'est pas encore passée """
+        return bool(date) and date >= timezone.now()
+
+    def is_adherent(self):
+        """ L'adhésion est en cours """
+        return self._is_future(self.end_adhesion)
+
+    def is_connected(self):
+        """ L'adhésion et la connexion sont en cours """
+        return self._is_future(self.end_connexion) and self.is_adherent()
+
+    def is_ban(self):
+        """ Un ban est en cours """
+        return self._is_future(self.end_ban)
+
+    def is_whitelisted(self):
+        """ Une whitelist est en cours """
+        return self._is_future(self.end_whitelist)
+
+    def end_access(self):
+        """ Date de fin normale d'accès (connexion ou whitelist) """
+        ends = [
+            date for date in (self.end_connexion, self.end_whitelist) if date
+        ]
+        return max(ends) if ends else None
+
+    def __str__(self):
+        return str(self.user)
+
+
 class LdapUser(ldapdb.models.Model):
     """
     Class for representing an LDAP user entry.
@@ -0,0 +1,53 @@
+# -*- mode: python; coding: utf-8 -*-
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Copyright © 2017  Gabriel Détraz
+# Copyright © 2017  Goulven Kermarec
+# Copyright © 2017  Augustin Lemesle
+
+"""users.tasks
+Les jobs de l'application users, lancés par le worker (cf re2o.models.Job).
+Chaque job recharge ses objets et ne fait rien s'ils ont été supprimés
+entre temps.
+"""
+
+from __future__ import unicode_literals
+
+from .models import Ban, User
+
+
+def ldap_sync_user(user_id, **flags):
+    """Synchronise l'user dans le ldap, cf User.ldap_sync"""
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        user.ldap_sync(**flags)
+
+
+def ldap_sync_users(user_ids, mac_refresh=False):
+    """Synchronise plusieurs users dans le ldap en une passe, cf
+    users.ldap_sync.LdapSyncEngine"""
+    from .ldap_sync import LdapSyncEngine
+    LdapSyncEngine().sync_users(
+        User.objects.filter(pk__in=user_ids),
+        mac_refresh=mac_refresh
+    )
+
+
+def notif_inscription(user_id):
+    """Envoie le mail de bienvenue"""
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        user.notif_inscription()
+
+
+def notif_inscriptions(user_ids):
+    """Envoie le mail de bienvenue à plusieurs users (import en masse)"""
+    for user in User.objects.filter(pk__in=user_ids).order_by('pk'):
+        user.notif_inscription()
+
+
+def notif_ban(ban_id):
+    """Envoie le mail de notification d'un ban"""
+    ban = Ban.objects.filter(pk=ban_id).first()
+    if ban is not None:
+        ban.notif_ban()
@@ -10,9 +10,11 @@ The tests for the Users module.
 """
 
 import os.path
+from datetime import timedelta
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.conf import settings
+from django.utils import timezone
 from . import models
 
 import volatildap
@@ -30,6 +32,192 @@ class ListShellTestCase(TestCase):
         self.assertEqual(s.shell, "/bin/zsh")
 
 
+class UserAccessStateTestCase(TestCase):
+    def test_access_state_dates(self):
+        now = timezone.now()
+        state = models.UserAccessState(
+            end_adhesion=now + timedelta(days=30),
+            end_connexion=now - timedelta(days=1),
+            end_ban=None,
+            end_whitelist=now + timedelta(days=2),
+        )
+        self.assertTrue(state.is_adherent())
+        self.assertFalse(state.is_connected())
+        self.assertFalse(state.is_ban())
+        self.assertTrue(state.is_whitelisted())
+        self.assertEqual(state.end_access(), state.end_whitelist)
+
+    def test_empty_access_state(self):
+        state = models.UserAccessState()
+        self.assertFalse(state.is_adherent())
+        self.assertFalse(state.is_ban())
+        self.assertIsNone(state.end_access())
+
+
+class LastPeriodTestCase(TestCase):
+    def test_overlapping_intervals_are_merged(self):
+        now = timezone.now()
+        day = timedelta(days=1)
+        self.assertEqual(
+            models.last_period([
+                (now, now + 10 * day),
+                (now - 5 * day, now + day),
+            ]),
+            (now - 5 * day, now + 10 * day)
+        )
+
+    def test_gap_starts_a_new_period(self):
+        now = timezone.now()
+        day = timedelta(days=1)
+        self.assertEqual(
+            models.last_period([
+                (now - 10 * day, now - 5 * day),
+                (now + 5 * day, now + 10 * day),
+            ]),
+            (now + 5 * day, now + 10 * day)
+        )
+
+    def test_no_interval(self):
+        self.assertEqual(models.last_period([]), (None, None))
+
+
+class AccessListsTestCase(TestCase):
+    """The current access lists of re2o.utils, read on UserAccessState,
+    against periods starting in the future and gaps between periods"""
+
+    def setUp(self):
+        self.user = models.User.objects.create_user(
+            "accesslistsuser",
+            "accesslistsuser@example.net",
+            "accesslistsuser",
+            surname="accesslistsuser",
+        )
+        self.now = timezone.now()
+
+    def whitelist(self, start, end):
+        whitelist = models.Whitelist.objects.create(
+            user=self.user,
+            raison="test",
+            date_end=self.now + end
+        )
+        models.Whitelist.objects.filter(pk=whitelist.pk).update(
+            date_start=self.now + start
+        )
+        models.UserAccessState.refresh(self.user)
+
+    def test_future_whitelist_is_not_current(self):
+        from re2o.utils import all_whitelisted
+        self.whitelist(timedelta(days=5), timedelta(days=10))
+        self.assertNotIn(self.user, all_whitelisted())
+
+    def test_gap_between_whitelists(self):
+        from re2o.utils import all_whitelisted
+        self.whitelist(-timedelta(days=10), -timedelta(days=5))
+        self.whitelist(timedelta(days=5), timedelta(days=10))
+        self.assertNotIn(self.user, all_whitelisted())
+
+    def test_current_whitelist_before_a_future_one(self):
+        from re2o.utils import all_whitelisted
+        self.whitelist(-timedelta(days=1), timedelta(days=1))
+        self.whitelist(timedelta(days=5), timedelta(days=10))
+        self.assertIn(self.user, all_whitelisted())
+        self.assertEqual(
+            set(all_whitelisted()),
+            set(all_whitelisted(search_time=timezone.now()))
+        )
+
+
+# Les jobs (ldap, mails) sont mis en file au lieu d'être exécutés
+@override_settings(ASYNC_JOBS=True)
+class UserImportTestCase(TestCase):
+    """Import d'un lot csv : aller-retour complet, puis lots invalides
+    refusés sans rien écrire"""
+
+    HEADER = "username,name,surname,email,school,building,room,comment\n"
+
+    def setUp(self):
+        from topologie.models import Building, Dormitory
+        self.school = models.School.objects.create(name="import_school")
+        dormitory = Dormitory.objects.create(name="import_dormitory")
+        self.building = Building.objects.create(
+            name="import_building",
+            dormitory=dormitory
+        )
+
+    def importer(self, lines):
+        from io import StringIO
+        from users.importer import UserImport, read_rows
+        rows = read_rows(StringIO(self.HEADER + "\n".join(lines)), 'csv')
+        return UserImport(rows, mail=False)
+
+    def test_round_trip(self):
+        importer = self.importer([
+            "importa,Alice,Anders,alice@example.net,import_school,"
+            "import_building,A101,premier",
+            "importb,Bob,Brown,bob@example.net,,,,",
+        ])
+        self.assertTrue(importer.run(), importer.errors)
+        self.assertEqual(importer.summary()['created'], 2)
+        alice = models.Adherent.objects.get(username="importa")
+        self.assertEqual(alice.name, "Alice")
+        self.assertEqual(alice.surname, "Anders")
+        self.assertEqual(alice.school, self.school)
+        self.assertEqual(alice.comment, "premier")
+        self.assertEqual(alice.room.name, "A101")
+        self.assertEqual(alice.room.building, self.building)
+        self.assertTrue(models.EMailAddress.objects.filter(
+            user=alice,
+            local_part="importa"
+        ).exists())
+        # Les users et chambres importés sont dans l'index de recherche
+        from search.models import SearchDocument
+        self.assertIn(alice.pk, SearchDocument.matching(
+            SearchDocument.USERS, "Anders"
+        ).values_list('object_id', flat=True))
+        self.assertIn(alice.room.pk, SearchDocument.matching(
+            SearchDocument.ROOMS, "a101"
+        ).values_list('object_id', flat=True))
+        bob = models.Adherent.objects.get(username="importb")
+        self.assertIsNone(bob.room)
+        self.assertEqual(
+            len(set(models.User.objects.filter(
+                username__in=["importa", "importb"]
+            ).values_list('uid_number', flat=True))),
+            2
+        )
+        self.assertEqual(models.UserAccessState.objects.filter(
+            user__in=[alice, bob]
+        ).count(), 2)
+
+        # Le même lot une seconde fois : les usernames sont pris
+        importer = self.importer([
+            "importa,Alice,Anders,alice@example.net,,,,",
+        ])
+        self.assertFalse(importer.run())
+        self.assertEqual(importer.errors[0][0], 1)
+
+    def test_invalid_rows_import_nothing(self):
+        users = models.User.objects.count()
+        importer = self.importer([
+            "importc,Carol,%s,carol@example.net,,,," % ("x" * 256),
+            "importd,Dan,Doe,not-an-email,,,,",
+            "importe,Eve,Evans,eve@example.net,unknown_school,,,",
+            "importf,Fay,Fox,fay@example.net,,unknown_building,F1,",
+            ",Gus,Gray,gus@example.net,,,,",
+            "importh,Hal,Hill,hal@example.net,,,,",
+            "importh,Hal,Hill,hal2@example.net,,,,",
+            "Import-I,Ivy,Ives,ivy@example.net,,,,",
+        ])
+        self.assertFalse(importer.run())
+        self.assertEqual(
+            sorted(set(line for line, _message in importer.errors)),
+            [1, 2, 3, 4, 5, 7, 8]
+        )
+        self.assertIn("surname", dict(importer.errors)[1])
+        self.assertEqual(importer.created, [])
+        self.assertEqual(models.User.objects.count(), users)
+
+
 class LdapUserTestCase(TestCase):
     def test_create_ldap_user(self):
         g = models.LdapUser.objects.create(
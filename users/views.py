@@ -49,7 +49,8 @@ from re2o.acl import (
     can_delete,
     can_view,
     can_view_all,
-    can_change
+    can_change,
+    filter_viewable,
 )
 from cotisations.utils import find_payment_method
 from topologie.models import Port
@@ -632,7 +633,11 @@ def mon_profil(request):
 @can_view(User)
 def profil(request, users, **_kwargs):
     """ Affiche un profil, self or cableur, prend un userid en argument """
-    machines = Machine.objects.filter(user=users).select_related('user')\
+    machines = filter_viewable(
+        request.user,
+        Machine.objects.filter(user=users)
+    )
+    machines = machines.select_related('user')\
         .prefetch_related('interface_set__domain__extension')\
         .prefetch_related('interface_set__ipv4__ip_type__extension')\
         .prefetch_related('interface_set__machine_type')\
@@ -648,7 +653,10 @@ def profil(request, users, **_kwargs):
     )
     nb_machines = machines.count()
     machines = re2o_paginator(request, machines, pagination_large_number)
-    factures = Facture.objects.filter(user=users)
+    factures = filter_viewable(
+        request.user,
+        Facture.objects.filter(user=users)
+    )
     factures = SortTable.sort(
         factures,
         request.GET.get('col'),